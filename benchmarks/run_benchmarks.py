@@ -0,0 +1,211 @@
+"""Reproducible performance benchmark of the ENNGene pipeline on synthetic data.
+
+Times every Dataset stage (read_in_bed, apply_window, map_to_fasta, map_to_wig, fold_branch, encode_branches,
+save and load) and the train, predict and integrated gradients loops, and writes the results as JSON
+(together with the memory taken by the encoded inputs).
+
+Usage (from the repository root, within the enngene conda environment):
+    python benchmarks/run_benchmarks.py --scale small --out bench_small.json
+    python benchmarks/run_benchmarks.py --peaks 20000 --chrom-length 1000000 --no-model
+
+Stages requiring external tools (bedtools, RNAfold) are reported as skipped when the tool is not on the PATH.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'enngene'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic  # noqa: E402
+from lib.utils.dataset import Dataset  # noqa: E402
+from lib.utils.profiling import Profiler  # noqa: E402
+from lib.utils import sequence as seq  # noqa: E402
+
+SCALES = {'small': {'chromosomes': 2, 'chrom_length': 100000, 'peaks': 1000},
+          'medium': {'chromosomes': 4, 'chrom_length': 1000000, 'peaks': 10000},
+          'large': {'chromosomes': 8, 'chrom_length': 5000000, 'peaks': 100000}}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def benchmark_dataset(profiler, data, work_dir, branches, win, ncpu, skipped):
+    klass_dfs = []
+    with profiler.span('read_in_bed') as span:
+        for bed in data['beds']:
+            klass = os.path.basename(bed).replace('.bed', '')
+            dataset = Dataset(klass=klass, branches=branches)
+            klass_dfs.append(dataset.read_in_bed(bed))
+        df = Dataset.merge_dataframes([Dataset(branches=branches, df=klass_df) for klass_df in klass_dfs])
+        span.rows = len(df)
+
+    with profiler.span('apply_window', rows=len(df)):
+        df = Dataset.apply_window(df, win, 'center', 'bed')
+
+    dataset = Dataset(branches=branches, df=df).sort_datapoints()
+
+    if 'seq' in branches or 'fold' in branches:
+        if shutil.which('bedtools'):
+            with profiler.span('map_to_fasta', rows=len(dataset.df)):
+                dataset.df = Dataset.map_to_fasta(dataset.df, 'seq', True, data['fasta'], False)
+        else:
+            skipped.append('map_to_fasta')
+            genome = data['genome']
+            dataset.df['seq'] = [genome[chrom][start:end] for chrom, start, end in
+                                 zip(dataset.df['chrom_name'], dataset.df['seq_start'], dataset.df['seq_end'])]
+
+    if 'cons' in branches:
+        with profiler.span('map_to_wig', rows=len(dataset.df)):
+            dataset.df = Dataset.map_to_wig('cons', dataset.df, data['wig_dir'])
+
+    if 'fold' in branches:
+        if shutil.which('RNAfold'):
+            dataset.df['fold'] = dataset.df['seq']
+            key_cols = ['chrom_name', 'seq_start', 'seq_end', 'strand_sign']
+            with profiler.span('fold_branch', rows=len(dataset.df)):
+                dataset.df = Dataset.fold_branch(dataset.df, key_cols, 'seq' in branches, ncpu)
+        else:
+            skipped.append('fold_branch')
+            branches.remove('fold')
+
+    dataset.df.dropna(subset=branches, inplace=True)
+    dataset.df.reset_index(drop=True, inplace=True)
+
+    file_path = os.path.join(work_dir, 'merged_all.tsv')
+    with profiler.span('save', rows=len(dataset.df)):
+        dataset.save_to_file(file_path, ignore_cols=['name', 'score'], do_zip=True)
+
+    with profiler.span('load', rows=len(dataset.df)):
+        dataset = Dataset.load_from_file(f'{file_path}.zip')
+
+    klasses = sorted(dataset.df['klass'].unique())
+    encoded_labels = seq.onehot_encode_alphabet({klass: i for i, klass in enumerate(klasses)})
+    with profiler.span('encode_branches', rows=len(dataset.df)):
+        values = dataset.encode_branches(dataset, branches)
+    with profiler.span('labels', rows=len(dataset.df)):
+        labels = dataset.labels(encoding=encoded_labels)
+
+    return values, labels, encoded_labels
+
+
+def input_memory(values, branches):
+    # Memory of the encoded inputs as kept by the pipeline, compared to the float32 (and former float64) arrays
+    inputs = values if isinstance(values, list) else [values]
+    return {branch: {'dtype': str(x.dtype), 'shape': list(x.shape), 'bytes': int(x.nbytes),
+                     'float32_bytes': int(x.size * 4), 'float64_bytes': int(x.size * 8)}
+            for branch, x in zip(branches, inputs)}
+
+
+def benchmark_model(profiler, values, labels, encoded_labels, branches, epochs, batch_size, ig_samples):
+    import tensorflow as tf
+    from lib.train.model_builder import ModelBuilder
+    from lib.utils import ig
+
+    tf.random.set_seed(456)
+    inputs = values if isinstance(values, list) else [values]
+    branch_shapes = {branch: x.shape for branch, x in zip(branches, inputs)}
+    branches_layers = {branch: [{'name': 'Convolution layer', 'args': {'filters': 40, 'kernel': 4}}]
+                       for branch in branches}
+    common_layers = [{'name': 'Dense layer', 'args': {'units': 32}}]
+
+    model = ModelBuilder(branches, encoded_labels, branch_shapes, branches_layers, common_layers).build_model()
+    model.compile(optimizer='sgd', loss=['categorical_crossentropy'], metrics=['accuracy'])
+
+    with profiler.span('fit', rows=len(labels) * epochs):
+        model.fit(values, labels, batch_size=batch_size, epochs=epochs, verbose=0)
+
+    with profiler.span('predict', rows=len(labels)):
+        predicted = model.predict(values, batch_size=batch_size, verbose=0)
+
+    n = min(ig_samples, len(labels))
+    baselines = [tf.zeros(shape=x[0].shape) for x in inputs]
+    targets = np.argmax(predicted[:n], axis=1)
+    with profiler.span('integrated_gradients', rows=n):
+        for i in range(n):
+            sample = [tf.convert_to_tensor(np.asarray(x[i], dtype=np.float32)) for x in inputs]
+            ig.integrated_gradients(model, baselines, sample, int(targets[i]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=list(SCALES.keys()), default='small')
+    parser.add_argument('--chromosomes', type=int, help='Number of synthetic chromosomes (overrides the scale)')
+    parser.add_argument('--chrom-length', type=int, help='Length of each chromosome (overrides the scale)')
+    parser.add_argument('--peaks', type=int, help='Number of peaks per class (overrides the scale)')
+    parser.add_argument('--klasses', type=int, default=2)
+    parser.add_argument('--branches', default='seq,fold,cons')
+    parser.add_argument('--win', type=int, default=100)
+    parser.add_argument('--ncpu', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--ig-samples', type=int, default=20)
+    parser.add_argument('--no-model', action='store_true', help='Skip the train, predict and IG benchmarks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='Folder for the generated data (a temporary one by default)')
+    parser.add_argument('--out', default='benchmark_results.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    config = dict(SCALES[args.scale])
+    if args.chromosomes: config['chromosomes'] = args.chromosomes
+    if args.chrom_length: config['chrom_length'] = args.chrom_length
+    if args.peaks: config['peaks'] = args.peaks
+    config.update({'klasses': args.klasses, 'branches': args.branches.split(','), 'win': args.win,
+                   'epochs': args.epochs, 'batch_size': args.batch_size, 'ig_samples': args.ig_samples,
+                   'seed': args.seed})
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='enngene_bench_')
+    np.random.seed(args.seed)
+    profiler = Profiler()
+    skipped = []
+
+    with profiler.span('generate_synthetic_data') as span:
+        data = synthetic.generate(work_dir, config['chromosomes'], config['chrom_length'], config['klasses'],
+                                  config['peaks'], args.seed)
+        span.rows = config['klasses'] * config['peaks']
+
+    branches = list(config['branches'])
+    values, labels, encoded_labels = benchmark_dataset(profiler, data, work_dir, branches, args.win, args.ncpu, skipped)
+    memory = input_memory(values, branches)
+    if args.no_model:
+        skipped.extend(['fit', 'predict', 'integrated_gradients'])
+    else:
+        benchmark_model(profiler, values, labels, encoded_labels, branches, args.epochs, args.batch_size,
+                        args.ig_samples)
+
+    results = {'commit': git_commit(),
+               'timestamp': datetime.datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'config': config,
+               'mapped_branches': branches,
+               'skipped': skipped,
+               'input_memory': memory,
+               'stages': profiler.to_dicts()}
+    with open(args.out, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Benchmark results written to {args.out}')
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Cold start benchmark of the application modules.
+
+Imports the app entry point and each task module in a fresh interpreter, measures the import time, and checks which
+heavy libraries (TensorFlow, matplotlib, seaborn, sklearn, h5py) got loaded along. Results are written as JSON.
+
+Usage (from the repository root, within the enngene conda environment):
+    python benchmarks/startup.py --repeat 5 --out startup.json
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_DIR, 'enngene')
+
+HEAVY_MODULES = ['tensorflow', 'matplotlib', 'seaborn', 'sklearn', 'h5py']
+TARGETS = {'app': 'enngene',
+           'preprocess': 'lib.preprocess.preprocess',
+           'train': 'lib.train.train',
+           'evaluate': 'lib.evaluate.evaluate',
+           'predict': 'lib.predict.predict'}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'import_s': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module):
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=APP_DIR, stderr=subprocess.DEVNULL)
+    # Only the last line is ours, the imported modules may print something on their own
+    return json.loads(output.decode().strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default='startup_results.json')
+    args = parser.parse_args()
+
+    results = {}
+    for name, module in TARGETS.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        times = [run['import_s'] for run in runs]
+        results[name] = {'module': module,
+                         'median_import_s': statistics.median(times),
+                         'min_import_s': min(times),
+                         'heavy_modules_loaded': runs[-1]['heavy']}
+        print(f"{name}: {results[name]['median_import_s']:.2f} s (median of {args.repeat}), "
+              f"heavy modules loaded: {', '.join(results[name]['heavy_modules_loaded']) or '-'}")
+
+    with open(args.out, 'w') as file:
+        json.dump({'timestamp': datetime.datetime.now().isoformat(),
+                   'python': sys.version.split()[0],
+                   'repeat': args.repeat,
+                   'modules': results}, file, indent=2)
+    print(f'Startup results written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Generator of a synthetic reference genome, conservation tracks and class BED files for benchmarking.
+
+All the outputs are fully determined by the seed, so that the timings are comparable between commits.
+"""
+import os
+
+import numpy as np
+
+NUCLEOTIDES = np.array(list('ACGT'))
+
+
+def chromosome_names(no_chromosomes):
+    return [f'chr{i + 1}' for i in range(no_chromosomes)]
+
+
+def generate_genome(no_chromosomes, chrom_length, seed=0):
+    rng = np.random.RandomState(seed)
+    return {chrom: ''.join(rng.choice(NUCLEOTIDES, size=chrom_length)) for chrom in chromosome_names(no_chromosomes)}
+
+
+def write_fasta(genome, path, line_width=60):
+    with open(path, 'w') as file:
+        for chrom, sequence in genome.items():
+            file.write(f'>{chrom}\n')
+            for i in range(0, len(sequence), line_width):
+                file.write(sequence[i:(i + line_width)] + '\n')
+    return path
+
+
+def write_wig_dir(genome, folder, seed=0, gap=1000):
+    """Write one fixedStep wig file per chromosome, each split into two sections by a gap without a score."""
+    rng = np.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for chrom, sequence in genome.items():
+        length = len(sequence)
+        path = os.path.join(folder, f'{chrom}.phyloP.wig')
+        first_end = length // 2
+        sections = [(0, first_end), (min(first_end + gap, length), length)]
+        with open(path, 'w') as file:
+            for start, end in sections:
+                if end <= start: continue
+                file.write(f'fixedStep chrom={chrom} start={start + 1} step=1\n')
+                scores = np.round(rng.normal(0, 2, size=(end - start)), 3)
+                file.write('\n'.join(map(str, scores)) + '\n')
+        paths.append(path)
+    return paths
+
+
+def write_class_beds(genome, folder, no_klasses=2, peaks_per_klass=1000, min_length=50, max_length=300, seed=0):
+    rng = np.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    chroms = list(genome.keys())
+    paths = []
+    for k in range(no_klasses):
+        klass = f'klass{k}'
+        chrom_idx = rng.randint(0, len(chroms), size=peaks_per_klass)
+        lengths = rng.randint(min_length, max_length + 1, size=peaks_per_klass)
+        rows = []
+        for i, (c, length) in enumerate(zip(chrom_idx, lengths)):
+            chrom = chroms[c]
+            # keep a margin so that the window may be applied on both sides of the peak
+            start = rng.randint(max_length, len(genome[chrom]) - 2 * max_length)
+            strand = '+' if rng.rand() < 0.5 else '-'
+            rows.append((chrom, start, start + length, f'{klass}_{i}', 0, strand))
+        rows.sort(key=lambda row: (row[0], row[1]))
+        path = os.path.join(folder, f'{klass}.bed')
+        with open(path, 'w') as file:
+            file.write(''.join('\t'.join(map(str, row)) + '\n' for row in rows))
+        paths.append(path)
+    return paths
+
+
+def generate(out_dir, no_chromosomes=3, chrom_length=200000, no_klasses=2, peaks_per_klass=1000, seed=0):
+    os.makedirs(out_dir, exist_ok=True)
+    genome = generate_genome(no_chromosomes, chrom_length, seed)
+    fasta = write_fasta(genome, os.path.join(out_dir, 'genome.fa'))
+    wig_dir = os.path.join(out_dir, 'wig')
+    write_wig_dir(genome, wig_dir, seed)
+    beds = write_class_beds(genome, os.path.join(out_dir, 'beds'), no_klasses, peaks_per_klass, seed=seed)
+    return {'genome': genome, 'fasta': fasta, 'wig_dir': wig_dir, 'beds': beds}
@@ -7,7 +7,6 @@ import os
 import random as py_rand
 
 import tempfile
-import tensorflow as tf
 
 from lib.utils.exceptions import MyException
 
@@ -69,7 +68,10 @@ def enngene():
 
     np.random.seed(89)
     py_rand.seed(123)
-    tf.random.set_seed(456)
+    if subcommand != 'preprocess':
+        # TensorFlow takes seconds to load, import it only for the tasks working with a model
+        import tensorflow as tf
+        tf.random.set_seed(456)
 
     module_path = f'lib.{subcommand}.{subcommand}'
     subcommand_class = ''.join(x.title() for x in subcommand.split('_'))
@@ -7,9 +7,11 @@ import tensorflow as tf
 import yaml
 
 from ..utils.dataset import Dataset
+from ..utils.encoded_sequence import EncodedSequence
 from ..utils import sequence as seq
 from ..utils.subcommand import Subcommand
 from ..utils.exceptions import UserInputError
+from ..utils.profiling import Profiler
 
 logger = logging.getLogger('root')
 
@@ -17,7 +19,8 @@ logger = logging.getLogger('root')
 class Evaluate(Subcommand):
     SEQ_TYPES = {'BED file': 'bed',
                  'FASTA file': 'fasta',
-                 'Blackbox dataset': 'blackbox'}
+                 'Blackbox dataset': 'blackbox',
+                 'Pre-encoded dataset': 'encoded'}
     
     def __init__(self):
         # test module - either on already mapped blackbox dataset, or not encoded dataset, eg from different experiment to check transferbality of the results
@@ -26,8 +29,11 @@ class Evaluate(Subcommand):
         self.validation_hash = {'is_model_file': [],
                                 'is_bed': [],
                                 'is_blackbox': [],
+                                'is_encoded_dir': [],
                                 'is_fasta': [],
-                                'is_wig_dir': []}
+                                'is_cons_track': [],
+                                'is_signal_tracks': [],
+                                'is_signal_channels': []}
         self.params['model_folder'] = None
 
         st.markdown('# Evaluation')
@@ -47,14 +53,33 @@ class Evaluate(Subcommand):
             self.params['smoothgrad'] = st.checkbox('Apply smoothgrad method', self.defaults['smoothgrad'])
             st.markdown('###### **WARNING**: Calculating the integrated gradients is a time-consuming process, '
                         'it may take several minutes up to few hours (depending on the number of sequences). ' +
-                        'Smoothgrad increases time complexity of integrated gradients by a factor of 20.')
-
+                        'Smoothgrad computes the 20 noisy repetitions in one batched pass, it needs more memory than the plain IG.')
+            self.params['ig_scope'] = self.IG_SCOPES[st.radio(
+                'Calculate the integrated gradients for', list(self.IG_SCOPES.keys()),
+                index=self.get_dict_index(self.defaults['ig_scope'], self.IG_SCOPES))]
+            if self.params['ig_scope'] == 'top_k':
+                self.params['ig_top_k'] = int(st.number_input('Number of sequences per class (k)', min_value=1,
+                                                              value=self.defaults['ig_top_k']))
+            elif self.params['ig_scope'] == 'threshold':
+                self.params['ig_threshold'] = float(st.number_input('Score threshold', min_value=0.0, max_value=1.0,
+                                                                    value=self.defaults['ig_threshold']))
+            if not self.params['smoothgrad']:
+                self.params['adaptive_ig'] = st.checkbox('Adaptive number of IG steps', self.defaults['adaptive_ig'])
+                if self.params['adaptive_ig']:
+                    self.params['ig_tolerance'] = float(st.number_input(
+                        'Completeness tolerance', min_value=0.0001, max_value=1.0, value=self.defaults['ig_tolerance'], format='%.4f'))
+            self.params['ig_cache'] = st.checkbox('Reuse the attributions cached in the output folder', self.defaults['ig_cache'])
+            if self.params['ig_cache']:
+                self.params['ig_cache_size'] = int(st.number_input(
+                    'Maximal size of the cache (MB)', min_value=1, value=self.defaults['ig_cache_size']))
+        self.evaluation_options()
 
         self.validate_and_run(self.validation_hash)
 
     def run(self):
         status = st.empty()
         status.text('Preparing sequences...')
+        profiler = Profiler(logger)
 
         if self.previous_param_file:
             with open(self.previous_param_file, 'r') as file:
@@ -81,17 +106,38 @@ class Evaluate(Subcommand):
                 dataset = Dataset(fasta_file=self.params['seq_source'], branches=self.params['branches'], category='eval',
                                       win=self.params['win'], win_place=self.params['win_place'])
             dataset.map_to_branches(
-                self.references, self.params['strand'], prepared_file_path, status, predict=True, ncpu=self.ncpu)
+                self.references, self.params['strand'], prepared_file_path, status, predict=True, ncpu=self.ncpu,
+                profiler=profiler)
         elif self.params['seq_type'] == 'blackbox':
-            dataset = Dataset.load_from_file(self.params['seq_source'])
-            pass
+            with profiler.span('load_blackbox') as span:
+                dataset = Dataset.load_from_file(self.params['seq_source'])
+                span.rows = len(dataset.df)
+        elif self.params['seq_type'] == 'encoded':
+            with profiler.span('load_encoded') as span:
+                dataset, values, labels, encoded_klasses = Dataset.load_encoded(self.params['seq_source'])
+                span.rows = len(dataset.df)
 
-        eval_x = dataset.encode_branches(dataset, self.params['branches'])
-        eval_y = dataset.labels(encoding=encoded_labels)
+        model = tf.keras.models.load_model(self.params['model_file'])
+        # Labels must be encoded the same way as when training the model
+        sparse_labels = self.uses_sparse_labels(model)
+
+        if self.params['seq_type'] == 'encoded':
+            missing = [klass for klass in encoded_klasses if klass not in klasses]
+            if missing:
+                raise UserInputError(f"Classes {', '.join(missing)} of the pre-encoded dataset were not used for training the model.")
+            # Class indices of the dataset translated to the order used by the model
+            eval_y = np.array([klasses.index(klass) for klass in encoded_klasses])[labels]
+            eval_x = [values[branch] for branch in self.params['branches']]
+            eval_input = EncodedSequence(eval_x, eval_y, len(klasses), self.params['batch_size'], sparse=sparse_labels)
+        else:
+            with profiler.span('encode_branches', rows=len(dataset.df)):
+                eval_x = dataset.encode_branches(dataset, self.params['branches'])
+                eval_y = dataset.labels(encoding=encoded_labels, sparse=sparse_labels)
+            eval_input = eval_x
 
         status.text('Evaluating model...')
-        model = tf.keras.models.load_model(self.params['model_file'])
-        predicted = self.evaluate_model(encoded_labels, model, eval_x, eval_y, self.params, self.params['eval_dir'])
+        with profiler.span('evaluate', rows=len(eval_y)):
+            predicted = self.evaluate_model(encoded_labels, model, eval_input, eval_y, self.params, self.params['eval_dir'])
 
         for i, klass in enumerate(self.params['klasses']):
             dataset.df[klass] = [y[i] for y in predicted]
@@ -100,15 +146,21 @@ class Evaluate(Subcommand):
         placeholder = st.empty()
         if self.params['ig']:
             status.text('Calculating Integrated Gradients...')
-            self.calculate_ig(dataset, model, eval_x, self.params['klasses'], self.params['branches'], self.params['smoothgrad'])
+            with profiler.span('integrated_gradients', rows=len(dataset.df)):
+                self.calculate_ig(dataset, model, eval_x, self.params['klasses'], self.params['branches'], self.params['smoothgrad'],
+                                  self.params['eval_dir'], self.params.get('adaptive_ig', False), self.params.get('ig_tolerance', 0.01),
+                                  self.params['model_file'], self.params['output_folder'] if self.params['ig_cache'] else None,
+                                  self.params.get('ig_cache_size', 1024),
+                                  self.ig_rows(predicted, self.params['ig_scope'], self.params.get('ig_top_k', 10),
+                                               self.params.get('ig_threshold', 0.5)))
 
         placeholder.text('Exporting results...')
         result_file = os.path.join(self.params['eval_dir'], 'results.tsv')
-        ignore = ['seq_encoded', 'fold_encoded', 'seq', 'fold', 'cons']
+        ignore = ['seq', 'fold', 'cons', 'signal']
         dataset.save_to_file(ignore_cols=ignore, outfile_path=result_file)
 
-        header = self.eval_header()
-        row = self.eval_row(self.params)
+        header = self.eval_header() + profiler.header()
+        row = self.eval_row(self.params) + profiler.row()
 
         if self.previous_param_file:
             with open(self.previous_param_file, 'r') as file:
@@ -133,6 +185,7 @@ class Evaluate(Subcommand):
                 header += '\n'
                 row += '\n'
 
+        self.wait_for_plots()
         self.finalize_run(logger, self.params['eval_dir'], self.params, header, row, placeholder, self.previous_param_file)
         status.text('Finished!')
         logger.info('Finished!')
@@ -152,9 +205,21 @@ class Evaluate(Subcommand):
             'strand': True,
             'fasta_ref': '',
             'cons_dir': '',
+            'signal_tracks': [],
             'win_place': 'center',
+            'batch_size': 256,
             'ig': True,
             'smoothgrad': False,
+            'adaptive_ig': False,
+            'ig_tolerance': 0.01,
+            'ig_cache': True,
+            'ig_cache_size': 1024,
+            'ig_scope': 'top_k',
+            'ig_threshold': 0.5,
+            'ig_top_k': 10,
+            'bootstrap': False,
+            'bootstrap_samples': 1000,
+            'render_plots': True,
             'output_folder': os.path.join(os.path.expanduser('~'), 'enngene_output')
         }
 
@@ -9,6 +9,8 @@ import tensorflow as tf
 
 # TODO export the env when releasing, check pandas == 1.1.1
 from ..utils.dataset import Dataset
+from ..utils.encoded_sequence import EncodedSequence
+from ..utils.profiling import Profiler
 from ..utils.subcommand import Subcommand
 
 logger = logging.getLogger('root')
@@ -17,15 +19,19 @@ logger = logging.getLogger('root')
 class Predict(Subcommand):
     SEQ_TYPES = {'BED file': 'bed',
                  'FASTA file': 'fasta',
-                 'Text input': 'text'}
+                 'Text input': 'text',
+                 'Pre-encoded dataset': 'encoded'}
 
     def __init__(self):
         self.params = {'task': 'Predict'}
         self.validation_hash = {'is_model_file': [],
                                 'is_bed': [],
+                                'is_encoded_dir': [],
                                 'is_fasta': [],
                                 'is_multiline_text': [],
-                                'is_wig_dir': []}
+                                'is_cons_track': [],
+                                'is_signal_tracks': [],
+                                'is_signal_channels': []}
         self.params['model_folder'] = None
 
         st.markdown('# Prediction')
@@ -44,13 +50,32 @@ class Predict(Subcommand):
             self.params['smoothgrad'] = st.checkbox('Apply smoothgrad method', self.defaults['smoothgrad'])
             st.markdown('###### **WARNING**: Calculating the integrated gradients is a time-consuming process, '
                         'it may take several minutes up to few hours (depending on the number of sequences). ' +
-                        'Smoothgrad increases time consumption of integrated gradients by a factor of 20.')
+                        'Smoothgrad computes the 20 noisy repetitions in one batched pass, it needs more memory than the plain IG.')
+            self.params['ig_scope'] = self.IG_SCOPES[st.radio(
+                'Calculate the integrated gradients for', list(self.IG_SCOPES.keys()),
+                index=self.get_dict_index(self.defaults['ig_scope'], self.IG_SCOPES))]
+            if self.params['ig_scope'] == 'top_k':
+                self.params['ig_top_k'] = int(st.number_input('Number of sequences per class (k)', min_value=1,
+                                                              value=self.defaults['ig_top_k']))
+            elif self.params['ig_scope'] == 'threshold':
+                self.params['ig_threshold'] = float(st.number_input('Score threshold', min_value=0.0, max_value=1.0,
+                                                                    value=self.defaults['ig_threshold']))
+            if not self.params['smoothgrad']:
+                self.params['adaptive_ig'] = st.checkbox('Adaptive number of IG steps', self.defaults['adaptive_ig'])
+                if self.params['adaptive_ig']:
+                    self.params['ig_tolerance'] = float(st.number_input(
+                        'Completeness tolerance', min_value=0.0001, max_value=1.0, value=self.defaults['ig_tolerance'], format='%.4f'))
+            self.params['ig_cache'] = st.checkbox('Reuse the attributions cached in the output folder', self.defaults['ig_cache'])
+            if self.params['ig_cache']:
+                self.params['ig_cache_size'] = int(st.number_input(
+                    'Maximal size of the cache (MB)', min_value=1, value=self.defaults['ig_cache_size']))
 
         self.validate_and_run(self.validation_hash)
 
     def run(self):
         status = st.empty()
         status.text('Preparing sequences...')
+        profiler = Profiler(logger)
 
         self.params['predict_dir'] = os.path.join(self.params['output_folder'], 'prediction',
                                  f'{str(datetime.datetime.now().strftime("%Y%m%d-%H%M"))}')
@@ -70,18 +95,30 @@ class Predict(Subcommand):
             elif self.params['seq_type'] == 'text':
                 dataset = Dataset(text_input=self.params['seq_source'], branches=self.params['branches'], category='predict',
                                   win=self.params['win'], win_place=self.params['win_place'])
-
-        dataset.map_to_branches(
-            self.references, self.params['strand'], prepared_file_path, status, predict=True, ncpu=self.ncpu)
-
-        predict_x = dataset.encode_branches(dataset, self.params['branches'])
+        elif self.params['seq_type'] == 'encoded':
+            with profiler.span('load_encoded') as span:
+                dataset, values, _, _ = Dataset.load_encoded(self.params['seq_source'])
+                span.rows = len(dataset.df)
+
+        if self.params['seq_type'] == 'encoded':
+            predict_x = [values[branch] for branch in self.params['branches']]
+            predict_input = EncodedSequence(predict_x, batch_size=self.params['batch_size'])
+        else:
+            dataset.map_to_branches(
+                self.references, self.params['strand'], prepared_file_path, status, predict=True, ncpu=self.ncpu,
+                profiler=profiler)
+
+            with profiler.span('encode_branches', rows=len(dataset.df)):
+                predict_x = dataset.encode_branches(dataset, self.params['branches'])
+            predict_input = predict_x
 
         status.text('Calculating predictions...')
 
         model = tf.keras.models.load_model(self.params['model_file'])
-        predict_y = model.predict(
-            predict_x,
-            verbose=1)
+        with profiler.span('predict', rows=len(dataset.df)):
+            predict_y = model.predict(
+                predict_input,
+                verbose=1)
 
         for i, klass in enumerate(self.params['klasses']):
             dataset.df[klass] = [y[i] for y in predict_y]
@@ -91,15 +128,21 @@ class Predict(Subcommand):
 
         if self.params['ig']:
             status.text('Calculating Integrated Gradients...')
-            self.calculate_ig(dataset, model, eval_x, self.params['klasses'], self.params['branches'], self.params['smoothgrad'])
+            with profiler.span('integrated_gradients', rows=len(dataset.df)):
+                self.calculate_ig(dataset, model, predict_x, self.params['klasses'], self.params['branches'], self.params['smoothgrad'],
+                                  self.params['predict_dir'], self.params.get('adaptive_ig', False), self.params.get('ig_tolerance', 0.01),
+                                  self.params['model_file'], self.params['output_folder'] if self.params['ig_cache'] else None,
+                                  self.params.get('ig_cache_size', 1024),
+                                  self.ig_rows(predict_y, self.params['ig_scope'], self.params.get('ig_top_k', 10),
+                                               self.params.get('ig_threshold', 0.5)))
 
         placeholder.text('Exporting results...')
         result_file = os.path.join(self.params['predict_dir'], 'results.tsv')
-        ignore = ['name', 'score', 'klass', 'seq_encoded', 'fold_encoded', 'seq', 'fold', 'cons']
+        ignore = ['name', 'score', 'klass', 'seq', 'fold', 'cons', 'signal']
         dataset.save_to_file(ignore_cols=ignore, outfile_path=result_file)
 
-        header = self.predict_header()
-        row = self.predict_row(self.params)
+        header = self.predict_header() + profiler.header()
+        row = self.predict_row(self.params) + profiler.row()
 
         if self.previous_param_file:
             with open(self.previous_param_file, 'r') as file:
@@ -143,9 +186,18 @@ class Predict(Subcommand):
             'strand': True,
             'fasta_ref': '',
             'cons_dir': '',
+            'signal_tracks': [],
             'win_place': 'center',
+            'batch_size': 256,
             'ig': True,
             'smoothgrad': False,
+            'adaptive_ig': False,
+            'ig_tolerance': 0.01,
+            'ig_cache': True,
+            'ig_cache_size': 1024,
+            'ig_scope': 'top_k',
+            'ig_threshold': 0.5,
+            'ig_top_k': 10,
             'output_folder': os.path.join(os.path.expanduser('~'), 'enngene_output')
         }
 
@@ -1,15 +1,18 @@
 import datetime
+import hashlib
 import logging
 import os
-import re
+import pandas as pd
 import shutil
 import streamlit as st
 import subprocess
+import yaml
 
 from ..utils.dataset import Dataset
-from ..utils import file_utils as f
 from ..utils.exceptions import UserInputError
+from ..utils.profiling import Profiler
 from ..utils import sequence as seq
+from ..utils import tracks
 from ..utils.subcommand import Subcommand
 
 
@@ -18,12 +21,15 @@ logger = logging.getLogger('root')
 
 # noinspection DuplicatedCode
 class Preprocess(Subcommand):
+    MANIFEST = 'manifest.yaml'
 
     def __init__(self):
         self.params = {'task': 'Preprocess'}
         self.validation_hash = {'is_bed': [],
                                 'is_fasta': [],
-                                'is_wig_dir': [],
+                                'is_mapped_run_dir': [],
+                                'is_cons_track': [],
+                                'is_signal_tracks': [],
                                 'not_empty_branches': [],
                                 'is_full_dataset': [],
                                 'is_ratio': [],
@@ -70,15 +76,31 @@ class Preprocess(Subcommand):
             if 'cons' in self.params['branches']:
                 cons_warning.markdown('**WARNING**: Calculating the conservation score is a time-consuming process, '
                                       'it may take up to few hours (based on the size of the wig files).')
-                self.params['cons_dir'] = st.text_input('Path to folder containing reference conservation files',
+                self.params['cons_dir'] = st.text_input('Path to the reference conservation track (folder of wig files, bedGraph or bigWig file)',
                                                         value=self.defaults['cons_dir'])
                 self.references.update({'cons': self.params['cons_dir']})
-                self.validation_hash['is_wig_dir'].append(self.params['cons_dir'])
+                self.validation_hash['is_cons_track'].append(self.params['cons_dir'])
+            if 'signal' in self.params['branches']:
+                signal_tracks = st.text_area('Paths to the signal tracks (one per line, each a folder of wig files, bedGraph or bigWig file)',
+                                             value='\n'.join(self.defaults['signal_tracks']))
+                self.validation_hash['is_signal_tracks'].append(signal_tracks)
+                self.params['signal_tracks'] = [line.strip() for line in signal_tracks.strip().split('\n') if line.strip()]
+                self.references.update({'signal': self.params['signal_tracks']})
 
             self.params['win'] = int(st.number_input('Window size', min_value=3, value=self.defaults['win']))
             self.params['win_place'] = self.WIN_PLACEMENT[st.radio(
                 'Choose a way to place the window upon the sequence:',
                 list(self.WIN_PLACEMENT.keys()), index=self.get_dict_index(self.defaults['win_place'], self.WIN_PLACEMENT))]
+            self.params['reuse_mapped'] = st.checkbox(
+                'Reuse samples mapped in a previous run (only new or changed input files will be mapped)',
+                self.defaults['reuse_mapped'])
+            if self.params['reuse_mapped']:
+                self.params['reuse_dir'] = st.text_input(
+                    "Folder from the previous run of the task (must contain 'full_datasets' subfolder)",
+                    value=self.defaults['reuse_dir'])
+                self.validation_hash['is_mapped_run_dir'].append(self.params['reuse_dir'])
+                st.markdown('###### Note: Samples are reused only for input files with identical content, mapped with '
+                            'the same branches, window, strand and reference files.')
             st.markdown('## Input Coordinate Files')
 
             warning = st.empty()
@@ -172,20 +194,20 @@ class Preprocess(Subcommand):
                             raise UserInputError('Sorry, could not parse given fasta file. Please check the path.')
                     else:
                         st.markdown('**Fasta file with reference genome must be provided to infer available chromosomes.**')
-                elif 'cons' in self.params['branches']:
-                    st.markdown('###### WARNING: When conservation score branch selected only, the split is done based on separate wig files provided. '
-                                'Note that to be able to do that, the wig files must contain the chromosome name in the exact same form as your bed files and must not contain dots within the chromosome name.')
-                    if self.params['cons_dir']:
-                        chrom_files = f.list_files_in_dir(self.params['cons_dir'], 'wig')
-                        chromosomes = []
-                        for file in chrom_files:
-                            match = re.search(r'.*\.*.*(chr[^.]*)\..*', os.path.basename(file))
-                            if match and match.group(1):
-                                chromosomes.append(match.group(1))
-                        self.params['valid_chromosomes'] = list(set(chromosomes))
+                elif 'cons' in self.params['branches'] or 'signal' in self.params['branches']:
+                    track_path = self.params['cons_dir'] if 'cons' in self.params['branches'] else \
+                        next(iter(self.params.get('signal_tracks', [])), '')
+                    st.markdown('###### WARNING: When conservation score (or numeric signal) branch selected only, the split is done based on the chromosomes of the conservation (or the first signal) track. '
+                                'Note that to be able to do that with a folder of wig files, the wig files must contain the chromosome name in the exact same form as your bed files and must not contain dots within the chromosome name.')
+                    if track_path:
+                        try:
+                            with tracks.open_track(track_path) as track:
+                                self.params['valid_chromosomes'] = track.chromosomes()
+                        except Exception:
+                            raise UserInputError('Sorry, could not read the chromosomes of the given conservation track. Please check the path.')
                         chr_ready = True
                     else:
-                        st.markdown('**Folder with conservation score (wig) files must be provided to infer available chromosomes.**')
+                        st.markdown('**Conservation track (folder of wig files, bedGraph or bigWig file) must be provided to infer available chromosomes.**')
                 else:
                     st.markdown('**Please choose at least one branch, and provide necessary reference files to infer available chromosomes.**')
 
@@ -214,12 +236,24 @@ class Preprocess(Subcommand):
                 'List a target ratio between the categories (required format: train:validation:test:blackbox)',
                 value=self.defaults['split_ratio'])
             self.validation_hash['is_ratio'].append(self.params['split_ratio'])
+            self.params['stratify'] = st.checkbox('Stratify by class (keep the class ratio the same in all the categories)',
+                                                  value=self.defaults['stratify'])
             st.markdown('###### Note: If you do not want to use the blackbox dataset (for later evaluation), you can just set it\'s size to 0.')
 
+        st.markdown('## Export')
+        self.params['export_encoded'] = st.checkbox(
+            'Export also pre-encoded datasets (memory-mapped by the Evaluate and Predict modules, '
+            'useful for large blackbox datasets)', self.defaults['export_encoded'])
+
+        if self.params['split'] == 'rand' or self.params['reducelist']:
+            self.params['seed'] = int(st.number_input('Random seed (the same seed reproduces the same selection of samples)',
+                                                      min_value=0, value=self.defaults['seed']))
+
         self.validate_and_run(self.validation_hash)
 
     def run(self):
         status = st.empty()
+        profiler = Profiler(logger)
 
         self.params['datasets_dir'] = os.path.join(self.params['output_folder'], 'datasets', f'{str(datetime.datetime.now().strftime("%Y-%m-%d_%H:%M"))}')
         self.ensure_dir(self.params['datasets_dir'])
@@ -229,77 +263,161 @@ class Preprocess(Subcommand):
 
         if self.params['use_mapped']:
             status.text('Reading in already mapped file with all the samples...')
-            merged_dataset = Dataset.load_from_file(self.params['full_dataset_file'])
-            # FIXME copied file is broken
-            shutil.copyfile(self.params['full_dataset_file'], full_data_file_path)
+            with profiler.span('load_mapped') as span:
+                merged_dataset = Dataset.load_from_file(self.params['full_dataset_file'])
+                span.rows = len(merged_dataset.df)
+            shutil.copyfile(self.params['full_dataset_file'], f'{full_data_file_path}.zip')
+            previous_manifest = os.path.join(os.path.dirname(self.params['full_dataset_file']), self.MANIFEST)
+            if os.path.isfile(previous_manifest):
+                shutil.copyfile(previous_manifest, os.path.join(full_data_dir_path, self.MANIFEST))
             # Keep only selected branches
             cols = ['chrom_name', 'seq_start', 'seq_end', 'strand_sign', 'klass'] + self.params['branches']
             merged_dataset.df = merged_dataset.df[cols]
         else:
-            # Accept one file per class and create one Dataset per each
-            initial_datasets = set()
-            status.text('Reading in given interval files and applying window...')
-            for file in self.params['input_files']:
-                klass = os.path.basename(file)
-                for ext in self.allowed_extensions:
-                    if ext in klass:
-                        klass = klass.replace(ext, '')
-
-                initial_datasets.add(
-                    Dataset(klass=klass, branches=self.params['branches'], bed_file=file, win=self.params['win'],
-                            win_place=self.params['win_place']))
-
-            # Merging data from all klasses to map them more efficiently all together at once
-            merged_dataset = Dataset(branches=self.params['branches'], df=Dataset.merge_dataframes(initial_datasets))
-
-            # First ensure order of the data by chr_name and seq_start within, mainly for conservation
-            status.text(
-                f"Mapping all intervals from to {len(self.params['branches'])} branch(es) and exporting...")
-            merged_dataset.sort_datapoints().map_to_branches(
-                self.references, self.params['strand'], full_data_file_path, status, self.ncpu)
+            klass_files = {self.file_klass(file): file for file in self.params['input_files']}
+            manifest = {'signature': self.mapping_signature(),
+                        'files': {klass: {'file': file, 'sha256': self.file_hash(file)} for klass, file in klass_files.items()}}
+
+            reused_dfs = []
+            if self.params['reuse_mapped']:
+                status.text('Looking for samples already mapped in the previous run...')
+                with profiler.span('reuse_mapped') as span:
+                    reused_dfs = self.reuse_mapped(self.params['reuse_dir'], manifest)
+                    span.rows = sum(len(df) for df in reused_dfs)
+                for df in reused_dfs:
+                    klass_files.pop(df['klass'].iloc[0], None)
+
+            if klass_files:
+                # Accept one file per class and create one Dataset per each
+                initial_datasets = set()
+                status.text('Reading in given interval files and applying window...')
+                with profiler.span('read_in_bed') as span:
+                    for klass, file in klass_files.items():
+                        initial_datasets.add(
+                            Dataset(klass=klass, branches=self.params['branches'], bed_file=file, win=self.params['win'],
+                                    win_place=self.params['win_place']))
+
+                    # Merging data from all klasses to map them more efficiently all together at once
+                    merged_dataset = Dataset(branches=self.params['branches'], df=Dataset.merge_dataframes(initial_datasets))
+                    span.rows = len(merged_dataset.df)
+
+                # First ensure order of the data by chr_name and seq_start within, mainly for conservation
+                status.text(
+                    f"Mapping all intervals from to {len(self.params['branches'])} branch(es) and exporting...")
+                merged_dataset.sort_datapoints().map_to_branches(
+                    self.references, self.params['strand'], full_data_file_path, status, ncpu=self.ncpu, profiler=profiler)
+                mapped_dfs = [merged_dataset.df]
+            else:
+                mapped_dfs = []
 
-        status.text('Processing mapped samples...')
-        mapped_datasets = set()
-        for klass in self.params['klasses']:
-            df = merged_dataset.df[merged_dataset.df['klass'] == klass]
-            mapped_datasets.add(Dataset(klass=klass, branches=self.params['branches'], df=df))
+            if reused_dfs:
+                status.text('Merging reused and newly mapped samples and exporting...')
+                merged_df = pd.concat(reused_dfs + mapped_dfs, ignore_index=True, sort=False)
+                merged_dataset = Dataset(branches=self.params['branches'], df=merged_df).sort_datapoints()
+                with profiler.span('save_mapped', rows=len(merged_dataset.df)):
+                    merged_dataset.save_to_file(full_data_file_path, ignore_cols=['name', 'score'], do_zip=True)
+
+            with open(os.path.join(full_data_dir_path, self.MANIFEST), 'w') as file:
+                yaml.dump(manifest, file)
 
-        split_datasets = set()
-        for dataset in mapped_datasets:
+        status.text('Processing mapped samples...')
+        with profiler.span('split', rows=len(merged_dataset.df)):
             # Reduce size of selected klasses
-            if self.params['reducelist'] and (dataset.klass in self.params['reducelist']):
-                status.text(f'Reducing number of samples in klass {format(dataset.klass)}...')
-                ratio = self.params['reduceratio'][dataset.klass]
-                dataset.reduce(ratio)
+            if self.params['reducelist']:
+                status.text(f"Reducing number of samples in klasses {', '.join(self.params['reducelist'])}...")
+                ratios = {klass: self.params['reduceratio'][klass] for klass in self.params['reducelist']}
+                merged_dataset = Dataset.reduce_by_klass(merged_dataset, ratios, self.params['seed'])
 
-            # Split datasets into train, validation, test and blackbox datasets
+            # Split the dataset into train, validation, test and blackbox datasets (all the klasses at once)
+            status.text('Redistributing samples to categories and exporting into final files...')
             if self.params['split'] == 'by_chr':
-                split_subdatasets = Dataset.split_by_chr(dataset, self.params['chromosomes'])
+                final_datasets = Dataset.split_by_chr(merged_dataset, self.params['chromosomes'])
             elif self.params['split'] == 'rand':
-                split_subdatasets = Dataset.split_random(dataset, self.params['split_ratio'])
-            split_datasets = split_datasets.union(split_subdatasets)
-
-        # Merge datasets of the same category across all the branches (e.g. train = pos + neg)
-        status.text('Redistributing samples to categories and exporting into final files...')
-        final_datasets = Dataset.merge_by_category(split_datasets)
-
-        for dataset in final_datasets:
-            dir_path = os.path.join(self.params['datasets_dir'], 'final_datasets')
-            self.ensure_dir(dir_path)
-            file_path = os.path.join(dir_path, f'{dataset.category}.tsv')
-            dataset.save_to_file(file_path, ignore_cols=['name', 'score'], do_zip=True)
+                final_datasets = Dataset.split_random(merged_dataset, self.params['split_ratio'], self.params['seed'],
+                                                      self.params['stratify'])
+
+        with profiler.span('save_final', rows=len(merged_dataset.df)):
+            for dataset in final_datasets:
+                dir_path = os.path.join(self.params['datasets_dir'], 'final_datasets')
+                self.ensure_dir(dir_path)
+                file_path = os.path.join(dir_path, f'{dataset.category}.tsv')
+                dataset.save_to_file(file_path, ignore_cols=['name', 'score'], do_zip=True)
+
+        if self.params['export_encoded']:
+            status.text('Exporting pre-encoded datasets...')
+            with profiler.span('save_encoded', rows=len(merged_dataset.df)):
+                for dataset in final_datasets:
+                    if dataset.df.empty: continue
+                    dir_path = os.path.join(self.params['datasets_dir'], 'final_datasets', f'{dataset.category}_encoded')
+                    dataset.save_encoded(dir_path, klasses=self.params['klasses'])
 
         self.finalize_run(logger, self.params['datasets_dir'], self.params,
-                          f'{self.preprocess_header()} \n',
-                          f'{self.preprocess_row(self.params)} \n')
+                          f'{self.preprocess_header()}{profiler.header()} \n',
+                          f'{self.preprocess_row(self.params)}{profiler.row()} \n')
         status.text('Finished!')
         logger.info('Finished!')
 
+    def file_klass(self, file):
+        klass = os.path.basename(file)
+        for ext in self.allowed_extensions:
+            if ext in klass:
+                klass = klass.replace(ext, '')
+        return klass
+
+    @staticmethod
+    def file_hash(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def mapping_signature(self):
+        # Everything besides the input file content that affects the mapped rows
+        branches = sorted(self.params['branches'])
+        signature = {'branches': branches,
+                     'win': self.params['win'],
+                     'win_place': self.params['win_place'],
+                     'strand': self.params['strand'] if 'seq' in branches else None,
+                     'references': {branch: self.references[branch] for branch in branches}}
+        return hashlib.sha256(yaml.dump(signature).encode('utf-8')).hexdigest()
+
+    def reuse_mapped(self, run_dir, manifest):
+        full_dir = os.path.join(run_dir, 'full_datasets')
+        manifest_path = os.path.join(full_dir, self.MANIFEST)
+        if not os.path.isfile(manifest_path):
+            logger.warning(f'No {self.MANIFEST} found in {full_dir}, all the input files will be mapped.')
+            return []
+        with open(manifest_path, 'r') as file:
+            previous_manifest = yaml.safe_load(file)
+        if previous_manifest.get('signature') != manifest['signature']:
+            logger.info('The previous run used different branches, window or references, all the input files will be mapped.')
+            return []
+
+        previous_klasses = {entry['sha256']: klass for klass, entry in previous_manifest['files'].items()}
+        reusable = {klass: previous_klasses[entry['sha256']] for klass, entry in manifest['files'].items()
+                    if entry['sha256'] in previous_klasses}
+        if not reusable:
+            logger.info('None of the input files was mapped in the previous run.')
+            return []
+
+        previous_dataset = Dataset.load_from_file(os.path.join(full_dir, 'merged_all.tsv.zip'))
+        reused_dfs = []
+        for klass, previous_klass in reusable.items():
+            df = previous_dataset.df[previous_dataset.df['klass'] == previous_klass].copy()
+            if df.empty: continue
+            df['klass'] = klass
+            reused_dfs.append(df)
+            logger.info(f'Reusing {len(df)} samples of class {klass} mapped in the previous run.')
+
+        return reused_dfs
+
     @staticmethod
     def default_params():
         return {'branches': [],
                 'chromosomes': {'train': [], 'validation': [], 'test': [], 'blackbox': []},
                 'cons_dir': '',
+                'export_encoded': False,
                 'fasta': '',
                 'full_dataset_dir': '',
                 'full_dataset_file': '',
@@ -307,8 +425,13 @@ class Preprocess(Subcommand):
                 'output_folder': os.path.join(os.path.expanduser('~'), 'enngene_output'),
                 'reducelist': [],
                 'reduceratio': {},
+                'reuse_dir': '',
+                'reuse_mapped': False,
+                'seed': 42,
+                'signal_tracks': [],
                 'split': 'rand',
                 'split_ratio': '7:1:1:1',
+                'stratify': True,
                 'strand': True,
                 'use_mapped': False,
                 'valid_chromosomes': [],
@@ -1,39 +1,153 @@
+import datetime
 import logging
 import numpy as np
 import os
 import pandas as pd
+import pickle
+import queue
+import random
 import tensorflow as tf
+import threading
+import time
+
+try:
+    from streamlit.report_thread import add_report_ctx
+except ImportError:  # older Streamlit versions
+    from streamlit.ReportThread import add_report_ctx
 
 logger = logging.getLogger('root')
 
 
 class ProgressMonitor(tf.keras.callbacks.Callback):
+    """Reports the training progress to the Streamlit widgets from a background thread.
+
+    The training thread only puts the events to a queue, the reporter thread applies them to the widgets at most once
+    per min_interval seconds (the chart rows are collected in the meantime and added at once).
+    With batch_progress, the throughput (samples/s) and estimated remaining time are reported during each epoch.
+    """
 
-    def __init__(self, epochs, progress_bar=None, progress_status=None, chart=None, metrics=None):
+    def __init__(self, epochs, progress_bar=None, progress_status=None, chart=None, metrics=None, batch_progress=False,
+                 min_interval=0.5):
+        super(ProgressMonitor, self).__init__()
         self.epochs = epochs
         self.progress_bar = progress_bar
         self.progress_status = progress_status
         self.chart = chart
         self.metrics = metrics
+        self.batch_progress = batch_progress
+        self.min_interval = min_interval
+        self.events = queue.Queue()
+        self.reporter = None
+        self.epoch = 0
+        self.epoch_start = None
+        self.samples = 0
+        self.last_report = 0.
+
+    def on_train_begin(self, logs=None):
+        self.reporter = threading.Thread(target=self.report, daemon=True)
+        add_report_ctx(self.reporter)
+        self.reporter.start()
+
+    def on_train_end(self, logs=None):
+        self.events.put(None)
+        self.reporter.join()
 
     def on_epoch_begin(self, epoch, logs=None):
-        self.progress_bar.progress((epoch+1)/self.epochs)
-        self.progress_status.text(f'Epoch {epoch+1}/{self.epochs}')
+        self.epoch = epoch
+        self.epoch_start = time.perf_counter()
+        self.samples = 0
+        self.events.put(('status', (epoch+1)/self.epochs, f'Epoch {epoch+1}/{self.epochs}'))
+
+    def on_train_batch_end(self, batch, logs=None):
+        if not self.batch_progress:
+            return
+        self.samples += (logs or {}).get('size', 0)
+        now = time.perf_counter()
+        if now - self.last_report < self.min_interval:
+            return
+        self.last_report = now
+        elapsed = now - self.epoch_start
+        steps = self.params.get('steps') or batch + 1
+        # Remaining batches of this epoch and of all the following ones, assuming a constant speed
+        remaining = (steps - batch - 1) + (self.epochs - self.epoch - 1) * steps
+        eta = remaining * elapsed / (batch + 1)
+        self.events.put(('status', (self.epoch + (batch+1)/steps)/self.epochs,
+                         f'Epoch {self.epoch+1}/{self.epochs}, batch {batch+1}/{steps}: '
+                         f'{self.samples/elapsed:.0f} samples/s, ETA {datetime.timedelta(seconds=int(eta))}'))
 
     def on_epoch_end(self, epoch, logs=None):
-        epoch_data = pd.DataFrame([['Training loss', round(logs['loss'], 2), epoch+1],
-                                   ['Validation loss', round(logs['val_loss'], 2), epoch+1]],
-                                  columns=['Metric', 'Metric value', 'Epoch'])
+        rows = [['Training loss', round(logs['loss'], 2), epoch+1],
+                ['Validation loss', round(logs['val_loss'], 2), epoch+1]]
         for metric in self.metrics:
             # For now plot only acc and auc during the training
             metric_name = metric if metric == 'accuracy' else metric.name
             if metric_name == 'auc' or metric_name == 'accuracy':
-                metric_df = pd.DataFrame([[f'Training {metric_name}', round(logs[metric_name], 2), epoch+1],
-                                          [f'Validation {metric_name}', round(logs[f'val_{metric_name}'], 2), epoch+1]],
-                                         columns=['Metric', 'Metric value', 'Epoch'])
-                epoch_data = epoch_data.append(metric_df, ignore_index=True)
+                rows.append([f'Training {metric_name}', round(logs[metric_name], 2), epoch+1])
+                rows.append([f'Validation {metric_name}', round(logs[f'val_{metric_name}'], 2), epoch+1])
+        self.events.put(('rows', rows))
+
+    def report(self):
+        status = None
+        rows = []
+        finished = False
+        while not finished:
+            try:
+                event = self.events.get(timeout=self.min_interval)
+            except queue.Empty:
+                event = ()
+            # Everything queued meanwhile is merged, only the latest status is shown
+            while event is not None:
+                if event and event[0] == 'status':
+                    status = event[1:]
+                elif event:
+                    rows.extend(event[1])
+                try:
+                    event = self.events.get_nowait()
+                except queue.Empty:
+                    break
+            finished = event is None
+
+            if status:
+                self.progress_bar.progress(min(status[0], 1.0))
+                self.progress_status.text(status[1])
+                status = None
+            if rows:
+                self.chart.add_rows(pd.DataFrame(rows, columns=['Metric', 'Metric value', 'Epoch']))
+                rows = []
+            if not finished:
+                time.sleep(self.min_interval)
+
+
+class StepRate(tf.keras.callbacks.Callback):
+    # Measures training steps (batches) per second of each epoch, the validation at the epoch end is not included
+
+    def __init__(self):
+        super(StepRate, self).__init__()
+        self.rates = []
+        self.steps = 0
+        self.start = None
+        self.elapsed = 0.
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.elapsed = 0.
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.elapsed += time.perf_counter() - self.start
+        self.steps += 1
 
-        self.chart.add_rows(epoch_data)
+    def on_epoch_end(self, epoch, logs=None):
+        if self.elapsed:
+            self.rates.append(self.steps / self.elapsed)
+            logger.info(f'Epoch {epoch + 1}: {self.rates[-1]:.1f} steps/s')
+
+    def steps_per_sec(self):
+        # Median over the epochs, the first one is skipped (if possible) as it includes the graph tracing
+        rates = self.rates[1:] if len(self.rates) > 1 else self.rates
+        return float(np.median(rates)) if rates else None
 
 
 # Code is authored by https://github.com/titu1994/keras-one-cycle, originally ported from https://github.com/fastai/fastai
@@ -226,6 +340,13 @@ class OneCycleLR(tf.keras.callbacks.Callback):
         for k, v in logs.items():
             self.history.setdefault(k, []).append(v)
 
+    def restore(self, clr_iterations):
+        # Continue the cycle from the given iteration (when resuming the training)
+        self.clr_iterations = clr_iterations
+        tf.keras.backend.set_value(self.model.optimizer.lr, self.compute_lr())
+        if self._update_momentum:
+            tf.keras.backend.set_value(self.model.optimizer.momentum, self.compute_momentum())
+
     def on_epoch_end(self, epoch, logs=None):
         if self.verbose:
             if self._update_momentum:
@@ -286,9 +407,9 @@ class LRFinder(tf.keras.callbacks.Callback):
                 validation set to compute the loss metrics. Else uses the training
                 batch loss. Will warn if not provided to alert the user.
             validation_sample_rate: Positive or Negative Integer. Number of batches to sample from the
-                validation set per iteration of the LRFinder. Larger number of
-                samples will reduce the variance but will take longer time to execute
-                per batch.
+                validation set. The sample is drawn once and evaluated as a single
+                batch after every training batch. Larger number of samples will reduce
+                the variance but will take longer time to execute per batch.
 
                 If Positive > 0, will sample from the validation dataset
                 If Megative, will use the entire dataset
@@ -315,7 +436,6 @@ class LRFinder(tf.keras.callbacks.Callback):
             raise ValueError("`lr_scale` must be one of ['exp', 'linear']")
 
         if validation_data is not None:
-            self.validation_data = validation_data
             self.use_validation_set = True
 
             if validation_sample_rate > 0 or validation_sample_rate < 0:
@@ -347,9 +467,16 @@ class LRFinder(tf.keras.callbacks.Callback):
             self.lr_multiplier_ = np.linspace(
                 minimum_lr, maximum_lr, num=self.num_batches_ + extra_batch)
 
-        # If negative, use entire validation set
-        if self.validation_sample_rate < 0:
-            self.validation_sample_rate = self.validation_data[0].shape[0] // batch_size
+        # The validation sample is drawn (and copied) just once, Keras models in TF2 do not have the validation_data
+        self.sample_data = None
+        if self.use_validation_set:
+            X, Y = validation_data
+            size = len(Y)
+            if self.validation_sample_rate > 0:
+                size = min(batch_size * self.validation_sample_rate, size)
+            idx = np.sort(np.random.choice(len(Y), size, replace=False))
+            x = [branch[idx] for branch in X] if isinstance(X, list) else X[idx]
+            self.sample_data = (x, Y[idx])
 
         self.current_batch_ = 0
         self.current_epoch_ = 0
@@ -379,37 +506,27 @@ class LRFinder(tf.keras.callbacks.Callback):
             return
 
         if self.use_validation_set:
-            X, Y = self.validation_data[0], self.validation_data[1]
-
-            # use 5 random batches from test set for fast approximate of loss
-            num_samples = self.batch_size * self.validation_sample_rate
-
-            if num_samples > X.shape[0]:
-                num_samples = X.shape[0]
-
-            idx = np.random.choice(X.shape[0], num_samples, replace=False)
-            x = X[idx]
-            y = Y[idx]
-
-            values = self.model.evaluate(x, y, batch_size=self.batch_size, verbose=False)
-            loss = values[0]
+            # A single forward pass over the cached sample, without the callbacks and data adapters of evaluate()
+            values = self.model.test_on_batch(*self.sample_data)
+            loss = values[0] if isinstance(values, list) else values
         else:
             loss = logs['loss']
 
-        # smooth the loss value and bias correct
-        running_loss = self.loss_smoothing_beta * loss + (
+        # smooth the loss value (exponential moving average) and bias correct
+        self.running_loss_ = self.loss_smoothing_beta * self.running_loss_ + (
                 1. - self.loss_smoothing_beta) * loss
-        running_loss = running_loss / (
+        running_loss = self.running_loss_ / (
                 1. - self.loss_smoothing_beta**self.current_batch_)
 
-        # stop logging if loss is too large
+        # stop the test if loss is too large, higher learning rates would only diverge further
         if self.current_batch_ > 1 and self.stopping_criterion_factor is not None and (
                 running_loss >
                 self.stopping_criterion_factor * self.best_loss_):
 
             if self.verbose:
-                logger.info(" - LRFinder: Skipping iteration since loss is %d times as large as best loss (%0.4f)"
+                logger.info(" - LRFinder: Stopping since loss is %d times as large as best loss (%0.4f)"
                       % (self.stopping_criterion_factor, self.best_loss_))
+            self.model.stop_training = True
             return
 
         if running_loss < self.best_loss_ or self.current_batch_ == 1:
@@ -438,12 +555,16 @@ class LRFinder(tf.keras.callbacks.Callback):
         if self.verbose:
             if self.use_validation_set:
                 logger.info(" - LRFinder: val_loss: %1.4f - lr = %1.8f " %
-                      (values[0], current_lr))
+                      (loss, current_lr))
             else:
                 logger.info(" - LRFinder: lr = %1.8f " % current_lr)
 
     def on_epoch_end(self, epoch, logs=None):
-        if self.save_dir is not None and self.current_epoch_ <= 1:
+        self.current_epoch_ += 1
+
+    def on_train_end(self, logs=None):
+        # Saved also when the test was stopped early due to the diverging loss
+        if self.save_dir is not None and self.history:
             if not os.path.exists(self.save_dir):
                 os.makedirs(self.save_dir)
 
@@ -456,7 +577,27 @@ class LRFinder(tf.keras.callbacks.Callback):
             if self.verbose:
                 logger.info("\tLR Finder : Saved the losses and learning rate values in path : {%s}" % (self.save_dir))
 
-        self.current_epoch_ += 1
+    @staticmethod
+    def suggest_lr(lrs, losses, lr_scale='exp', skip_beginning=5):
+        """
+        Suggests the maximum learning rate for the OneCycleLR callback, as one tenth of the learning rate
+        with the lowest smoothed loss (the loss starts to diverge at a higher rate shortly after).
+
+        # Arguments:
+            lrs: Array of the learning rates (log10 values for the 'exp' scale), as saved by the callback.
+            losses: Array of the corresponding smoothed losses.
+            lr_scale: Scale used during the test, one of ['exp', 'linear'].
+            skip_beginning: Number of first values ignored, the loss is still noisy there.
+
+        Returns:
+            Suggested learning rate, or None if no values were recorded.
+        """
+        if lrs is None or len(lrs) == 0:
+            return None
+        skip = skip_beginning if len(losses) > 2 * skip_beginning else 0
+        best = skip + int(np.argmin(losses[skip:]))
+        lr = 10 ** lrs[best] if lr_scale == 'exp' else lrs[best]
+        return float(lr) / 10.
 
     def plot_schedule(self, clip_beginning=None, clip_endding=None):
         """
@@ -590,7 +731,7 @@ class LRFinder(tf.keras.callbacks.Callback):
             plt.xlabel('learning rate')
             plt.ylabel('loss')
             plt.savefig(directory + '/lr_finder', dpi=300)
-            plt.clf()
+            plt.close()
 
     @property
     def lrs(self):
@@ -599,3 +740,84 @@ class LRFinder(tf.keras.callbacks.Callback):
     @property
     def losses(self):
         return np.array(self.history['running_loss_'])
+
+
+class TrainingCheckpoint(tf.keras.callbacks.Callback):
+    """Periodically saves everything needed to resume the training exactly where it stopped.
+
+    The model is saved including the optimizer state, while the epoch, python and numpy RNG states, training parameters
+    and the state of the other callbacks (one cycle position, best values of the model checkpoint and early stopping)
+    are pickled alongside. Must be the last of the callbacks, so that it restores their state after their own reset.
+    """
+    DIR = 'checkpoint'
+    MODEL = 'model.h5'
+    STATE = 'state.pkl'
+
+    def __init__(self, out_dir, params, callbacks, period=1, resume_state=None):
+        super(TrainingCheckpoint, self).__init__()
+        self.dir = os.path.join(out_dir, self.DIR)
+        self.params_to_save = params
+        self.callbacks = callbacks
+        self.period = period
+        self.resume_state = resume_state
+
+    @classmethod
+    def load_state(cls, out_dir):
+        with open(os.path.join(out_dir, cls.DIR, cls.STATE), 'rb') as file:
+            return pickle.load(file)
+
+    @classmethod
+    def load_model(cls, out_dir):
+        return tf.keras.models.load_model(os.path.join(out_dir, cls.DIR, cls.MODEL))
+
+    @staticmethod
+    def restore_rng(state):
+        np.random.set_state(state['numpy_rng'])
+        random.setstate(state['python_rng'])
+        # The TensorFlow global generator can not be restored, it is re-seeded deterministically instead
+        tf.random.set_seed(state['tf_seed'] + state['epoch'])
+
+    def callback_states(self):
+        states = []
+        for callback in self.callbacks:
+            if isinstance(callback, OneCycleLR):
+                states.append({'clr_iterations': callback.clr_iterations})
+            elif isinstance(callback, tf.keras.callbacks.EarlyStopping):
+                states.append({'best': callback.best, 'wait': callback.wait, 'stopped_epoch': callback.stopped_epoch})
+            elif isinstance(callback, tf.keras.callbacks.ModelCheckpoint):
+                states.append({'best': callback.best})
+            else:
+                states.append(None)
+        return states
+
+    def on_train_begin(self, logs=None):
+        if not self.resume_state:
+            return
+        for callback, state in zip(self.callbacks, self.resume_state['callbacks']):
+            if not state: continue
+            if isinstance(callback, OneCycleLR):
+                callback.restore(state['clr_iterations'])
+            else:
+                for attr, value in state.items():
+                    setattr(callback, attr, value)
+        logger.info(f"Resuming the training from epoch {self.resume_state['epoch'] + 1}.")
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.period != 0:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        state = {'epoch': epoch + 1,
+                 'numpy_rng': np.random.get_state(),
+                 'python_rng': random.getstate(),
+                 'tf_seed': self.params_to_save.get('seed', 456),
+                 'callbacks': self.callback_states(),
+                 'params': self.params_to_save}
+
+        # Written to temporary files first, so that a kill while saving does not corrupt the previous checkpoint
+        model_path = os.path.join(self.dir, self.MODEL)
+        state_path = os.path.join(self.dir, self.STATE)
+        self.model.save(f'{model_path}.tmp.h5', include_optimizer=True)
+        with open(f'{state_path}.tmp', 'wb') as file:
+            pickle.dump(state, file)
+        os.replace(f'{model_path}.tmp.h5', model_path)
+        os.replace(f'{state_path}.tmp', state_path)
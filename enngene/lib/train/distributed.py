@@ -0,0 +1,225 @@
+"""Data-parallel training of one model in multiple worker processes (tf.distribute MultiWorkerMirroredStrategy).
+
+Each worker trains on its shard of every batch, the gradients are all-reduced among the workers after each step.
+The workers are listed (as host:port) in the 'workers' Train parameter of the parameters.yaml file, the first one is
+the chief that exports the model, logs and evaluation.
+
+Usage (from the enngene folder of the repository):
+    # on each of the hosts listed in the parameters file
+    python -m lib.train.distributed --params /path/to/training/run/parameters.yaml --index 0
+    # or all the workers on the local machine (free ports are assigned automatically)
+    python -m lib.train.distributed --params /path/to/training/run/parameters.yaml --local 4
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+logger = logging.getLogger('root')
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LOCAL_HOSTS = ['localhost', '127.0.0.1']
+PORT_TAKEN = 3  # exit code of a worker that could not bind its port
+
+
+def is_local(workers):
+    return all(worker.split(':')[0] in LOCAL_HOSTS for worker in workers)
+
+
+def free_ports(count):
+    # The ports are released before the workers bind them, another process may take one in between,
+    # such worker exits with the PORT_TAKEN code and launch_local retries with new ports
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('localhost', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def port_taken(worker):
+    host, port = worker.rsplit(':', 1)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind((host, int(port)))
+        except OSError:
+            return True
+    return False
+
+
+def worker_command(param_file, index):
+    return [sys.executable, '-m', 'lib.train.distributed', '--params', param_file, '--index', str(index)]
+
+
+def wait_for_workers(processes):
+    # Once a worker can not bind its port the others would wait for it forever, they are terminated
+    while any(process.poll() is None for process in processes):
+        if any(process.poll() == PORT_TAKEN for process in processes):
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+        time.sleep(1)
+    return [process.returncode for process in processes]
+
+
+def launch_local(param_file, no_workers=None, attempts=3):
+    # Starts all the workers on the local machine and waits for them, returns their exit codes
+    with open(param_file, 'r') as file:
+        params = yaml.safe_load(file)
+    for attempt in range(attempts):
+        if no_workers:
+            params['Train']['workers'] = [f'localhost:{port}' for port in free_ports(no_workers)]
+            with open(param_file, 'w') as file:
+                yaml.dump(params, file)
+
+        processes = [subprocess.Popen(worker_command(param_file, i), cwd=APP_DIR)
+                     for i in range(len(params['Train']['workers']))]
+        exit_codes = wait_for_workers(processes)
+        if PORT_TAKEN not in exit_codes or not no_workers:
+            break
+        logger.warning(f'A port assigned to the workers was taken meanwhile, retrying ({attempt + 1}/{attempts}).')
+    return exit_codes
+
+
+def distribute(tf, dataset, batch_size):
+    # Batches are split among the workers (the DATA policy, as the data are not read from multiple files)
+    dataset = dataset.batch(batch_size)
+    options = tf.data.Options()
+    try:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    except AttributeError:  # TF < 2.1
+        options.experimental_distribute.auto_shard = True
+    return dataset.with_options(options)
+
+
+def run_worker(param_file, index):
+    with open(param_file, 'r') as file:
+        all_params = yaml.safe_load(file)
+    params = all_params['Train']
+    workers = params['workers']
+    chief = (index == 0)
+    if is_local(workers) and port_taken(workers[index]):
+        logger.error(f'The port of the worker {workers[index]} is already in use.')
+        sys.exit(PORT_TAKEN)
+
+    # The cluster must be described before TensorFlow creates the strategy
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': index}})
+    from .performance import configure_cpu, onednn_env
+    if params['cpu_mode'] and params['onednn']:
+        os.environ.update(onednn_env(params['intra_threads']))
+    import tensorflow as tf
+    from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, CSVLogger
+    if params['cpu_mode']:
+        configure_cpu(params['intra_threads'], params['inter_threads'], params['xla'], params['onednn'])
+    from .callbacks import OneCycleLR
+    from .model_builder import ModelBuilder
+    from .train import Train
+    from ..utils import eval_plots
+    from ..utils import sequence as seq
+
+    # Experimental API in TF 2.0, the gradients are all-reduced by the collective ops
+    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    np.random.seed(89)
+    tf.random.set_seed(456)
+
+    klasses = all_params['Preprocess']['klasses']
+    encoded_labels = seq.onehot_encode_alphabet({klass: i for i, klass in enumerate(klasses)})
+    train_x, valid_x, test_x, train_y, valid_y, test_y = Train.parse_data(
+        Train.dataset_files(params['input_folder']), params['branches'], encoded_labels, params['sparse_labels'])
+    branch_shapes = Train.get_shapes(train_x, params['branches'])
+
+    def to_dataset(x, y):
+        x = tuple(x) if isinstance(x, list) else x
+        return tf.data.Dataset.from_tensor_slices((x, y))
+
+    # The batch size set in the app is per worker
+    global_batch_size = params['batch_size'] * len(workers)
+    train_data = distribute(tf, to_dataset(train_x, train_y).shuffle(len(train_y), seed=456), global_batch_size)
+    valid_data = distribute(tf, to_dataset(valid_x, valid_y), global_batch_size)
+
+    with strategy.scope():
+        model = ModelBuilder(params['branches'], encoded_labels, branch_shapes, params['branches_layers'],
+                             params['common_layers']).build_model()
+        model.compile(optimizer=Train.create_optimizer(params['optimizer'], params['lr']),
+                      loss=[Train.loss(params['sparse_labels'])],
+                      metrics=list(Train.TRAIN_METRICS.keys()))
+
+    # Only the chief writes to the training folder, the other workers save their copies to a temporary folder
+    out_dir = params['train_dir'] if chief else tempfile.mkdtemp(prefix=f'enngene_worker{index}_')
+    try:
+        callbacks = [ModelCheckpoint(filepath=os.path.join(out_dir, 'model.hdf5'), verbose=0, save_best_only=True)]
+        if chief:
+            callbacks.append(CSVLogger(os.path.join(out_dir, 'log.csv'), append=True, separator='\t'))
+        if params['early_stop']:
+            early_stopper = EarlyStopping(monitor='val_loss', patience=10, min_delta=0.01, verbose=1, mode='auto')
+            callbacks.append(early_stopper)
+        if params['lr_optim'] in ['one_cycle', 'lr_finder']:
+            callbacks.append(OneCycleLR(max_lr=params['lr'], end_percentage=0.1, scale_percentage=None,
+                                        maximum_momentum=0.95, minimum_momentum=0.85, verbose=chief))
+        elif params['lr_optim'] == 'lr_scheduler':
+            callbacks.append(Train.step_decay_schedule(initial_lr=params['lr']))
+
+        history = model.fit(train_data, epochs=params['epochs'], validation_data=valid_data, callbacks=callbacks,
+                            verbose=2 if chief else 0).history
+    finally:
+        if not chief:
+            shutil.rmtree(out_dir, ignore_errors=True)
+    if not chief:
+        return
+
+    # Evaluated by the chief alone, thus on a copy of the best model outside of the strategy (no collective ops)
+    model = tf.keras.models.load_model(os.path.join(out_dir, 'model.hdf5'))
+    test_results = model.evaluate(to_dataset(test_x, test_y).batch(params['batch_size']), verbose=0)
+    y_pred = model.predict(test_x, batch_size=params['batch_size'], verbose=0)
+    test_y = np.eye(len(klasses))[test_y] if test_y.ndim == 1 else test_y
+    plot_dir = os.path.join(out_dir, 'plots', 'evaluation_metrics')
+    os.makedirs(plot_dir, exist_ok=True)
+    aucs = eval_plots.plot_multiclass_roc_curve(test_y, y_pred, encoded_labels, plot_dir, 'sync')
+    avg_precisions = eval_plots.plot_multiclass_prec_recall_curve(test_y, y_pred, encoded_labels, plot_dir, 'sync')
+
+    # Results are written back to the parameters file, to be picked up by the app (or read by the user)
+    params.update({'eval_loss': str(round(test_results[0], 4)),
+                   'eval_acc': str(round(test_results[1], 4)),
+                   'auc': ', '.join(f'{klass}: {value}' for klass, value in aucs.items()),
+                   'avg_precision': ', '.join(f'{klass}: {value}' for klass, value in avg_precisions.items()),
+                   'train_loss': str(round(history['loss'][-1], 4)),
+                   'train_acc': str(round(history['accuracy'][-1], 4)),
+                   'val_loss': str(round(history['val_loss'][-1], 4)),
+                   'val_acc': str(round(history['val_accuracy'][-1], 4))})
+    if params['early_stop'] and early_stopper.stopped_epoch != 0:
+        params['epochs'] = early_stopper.stopped_epoch
+    with open(param_file, 'w') as file:
+        yaml.dump(all_params, file)
+    logger.info(f"Distributed training finished, results exported to {params['train_dir']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--params', required=True, help='parameters.yaml file with the Train (and Preprocess) parameters')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--index', type=int, help='Index of this worker within the workers list')
+    group.add_argument('--local', type=int, help='Launch given number of workers on the local machine')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.local:
+        exit_codes = launch_local(args.params, args.local)
+        sys.exit(max(exit_codes, key=abs))
+    else:
+        run_worker(args.params, args.index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import logging
+import os
+
+logger = logging.getLogger('root')
+
+
+def onednn_env(threads=0):
+    # OpenMP settings for the oneDNN (MKL) builds of TensorFlow, read only when the runtime starts,
+    # thus effective only when set before TensorFlow is imported (i.e. in a newly started worker process)
+    return {'OMP_NUM_THREADS': str(threads or os.cpu_count() or 1),
+            'KMP_BLOCKTIME': '1',
+            'KMP_AFFINITY': 'granularity=fine,compact,1,0'}
+
+
+def configure_cpu(intra_threads=0, inter_threads=0, xla=False, onednn=False):
+    """Configures TensorFlow thread pools and XLA JIT compilation for CPU training, reports the oneDNN (MKL) settings.
+
+    Zero number of threads leaves the choice to TensorFlow. The thread pools can be set only before the TensorFlow
+    runtime is initialized (i.e. before the first model is built within the process), otherwise a warning is logged
+    and the previous setting stays in place. Returns the configuration actually applied.
+    """
+    import tensorflow as tf
+    applied = {}
+
+    if onednn:
+        # Only reported, setting them now would have no effect on the already imported TensorFlow
+        env = {key: os.environ[key] for key in onednn_env() if key in os.environ}
+        if len(env) < len(onednn_env()):
+            logger.warning('The oneDNN settings are applied to the sweep and distributed workers only, '
+                           'set the OMP_NUM_THREADS, KMP_BLOCKTIME and KMP_AFFINITY variables before starting the application.')
+        applied.update(env)
+
+    try:
+        if intra_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+        if inter_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    except RuntimeError as err:
+        logger.warning(f'Could not set the thread pools, TensorFlow runtime is already initialized ({err}). '
+                       'Restart the application to apply the new number of threads.')
+    applied['intra_op_threads'] = tf.config.threading.get_intra_op_parallelism_threads()
+    applied['inter_op_threads'] = tf.config.threading.get_inter_op_parallelism_threads()
+
+    try:
+        tf.config.optimizer.set_jit(xla)
+    except RuntimeError as err:
+        logger.warning(f'Could not {"enable" if xla else "disable"} XLA JIT compilation ({err}).')
+    applied['xla'] = bool(tf.config.optimizer.get_jit())
+
+    logger.info('CPU configuration: ' + ', '.join(f'{key}={value}' for key, value in applied.items()))
+    return applied
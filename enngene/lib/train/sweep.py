@@ -0,0 +1,178 @@
+"""Sweep mode of the Train module: training of multiple network configurations in parallel worker processes.
+
+The encoded datasets are saved just once as .npy files and memory-mapped by all the workers, so that the data are
+shared via the page cache instead of being loaded and encoded again per each configuration.
+"""
+import copy
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+
+import numpy as np
+import yaml
+
+logger = logging.getLogger('root')
+
+SWEEP_KEYS = ['lr', 'optimizer', 'batch_size', 'branches_layers', 'common_layers']
+SEARCH_TYPES = ['grid', 'random']
+DEFAULT_SPEC = """# Each parameter takes a list of values to be tried, parameters not listed are taken from the options above.
+# Use 'search: random' together with 'samples: N' to train only N randomly selected configurations.
+search: grid
+lr: [0.001, 0.005]
+optimizer: [sgd, adam]
+batch_size: [256]
+# common_layers:
+#   - [{name: Dense layer, args: {units: 32}}]
+#   - [{name: Dense layer, args: {units: 64, dropout: 0.2}}, {name: Dense layer, args: {units: 32}}]
+"""
+
+
+def parse_spec(text):
+    spec = yaml.safe_load(text)
+    if not isinstance(spec, dict):
+        raise ValueError('The sweep specification must be a yaml dictionary.')
+    if isinstance(spec.get('lr'), list):
+        # YAML 1.1 reads the scientific notation without a dot (e.g. 1e-3) as a string
+        spec['lr'] = [to_number(lr) for lr in spec['lr']]
+    return spec
+
+
+def to_number(value):
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def configurations(spec, params, seed=None):
+    # Parameters missing in the specification keep the value chosen in the UI
+    space = {key: spec[key] if key in spec else [params[key]] for key in SWEEP_KEYS}
+    configs = [dict(zip(space.keys(), values)) for values in itertools.product(*space.values())]
+    if spec.get('search', 'grid') == 'random':
+        samples = min(int(spec.get('samples', len(configs))), len(configs))
+        configs = random.Random(seed).sample(configs, samples)
+
+    for config in configs:
+        for layers in list(config['branches_layers'].values()) + [config['common_layers']]:
+            for layer in layers:
+                layer.setdefault('args', {})
+    return [copy.deepcopy(config) for config in configs]
+
+
+def config_params(params, config):
+    config_params = copy.deepcopy(params)
+    config_params.update(copy.deepcopy(config))
+    config_params['branches_layers'] = {branch: layers for branch, layers in config_params['branches_layers'].items()
+                                        if branch in params['branches']}
+    config_params['no_branches_layers'] = max(len(layers) for layers in config_params['branches_layers'].values())
+    config_params['no_common_layers'] = len(config_params['common_layers'])
+    if config_params['optimizer'] != 'sgd':
+        config_params['lr_optim'] = 'fixed'
+    return config_params
+
+
+def save_data(data_dir, branches, values, labels):
+    # values and labels are dicts by category, the values keep their compact dtype, the labels are stored as class indices
+    os.makedirs(data_dir, exist_ok=True)
+    for category in values.keys():
+        category_values = values[category] if len(branches) > 1 else [values[category]]
+        for branch, value in zip(branches, category_values):
+            np.save(os.path.join(data_dir, f'{category}_{branch}.npy'), value)
+        codes = labels[category] if labels[category].ndim == 1 else np.argmax(labels[category], axis=1)
+        np.save(os.path.join(data_dir, f'{category}_labels.npy'), codes.astype(np.int32))
+
+
+def load_data(data_dir, branches, category):
+    values = [np.load(os.path.join(data_dir, f'{category}_{branch}.npy'), mmap_mode='r') for branch in branches]
+    labels = np.load(os.path.join(data_dir, f'{category}_labels.npy'), mmap_mode='r')
+    return values, labels
+
+
+def train_configuration(task):
+    # Runs in a separate process, thread pools must be limited before TensorFlow initializes them
+    params = task['params']
+    from .performance import configure_cpu, onednn_env
+    os.environ['OMP_NUM_THREADS'] = str(task['threads'])
+    if params['cpu_mode'] and params['onednn']:
+        os.environ.update(onednn_env(task['threads']))
+    import tensorflow as tf
+    configure_cpu(task['threads'], 1, xla=params['cpu_mode'] and params['xla'], onednn=params['cpu_mode'] and params['onednn'])
+
+    from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, CSVLogger
+    from .callbacks import OneCycleLR
+    from .model_builder import ModelBuilder
+    from .train import Train
+    from ..utils import eval_plots
+    from ..utils import sequence as seq
+    from ..utils.encoded_sequence import EncodedSequence
+
+    try:
+        np.random.seed(task['seed'])
+        tf.random.set_seed(task['seed'])
+        branches = params['branches']
+        klasses = task['klasses']
+        encoded_labels = seq.onehot_encode_alphabet({klass: i for i, klass in enumerate(klasses)})
+        data = {category: load_data(task['data_dir'], branches, category) for category in ['train', 'validation', 'test']}
+
+        def sequence(category, shuffle=False):
+            values, labels = data[category]
+            return EncodedSequence(values, labels, len(klasses), params['batch_size'], sparse=params['sparse_labels'],
+                                   shuffle=shuffle, seed=task['seed'])
+
+        branch_shapes = {branch: value.shape for branch, value in zip(branches, data['train'][0])}
+        model = ModelBuilder(branches, encoded_labels, branch_shapes, params['branches_layers'],
+                             params['common_layers']).build_model()
+        model.compile(optimizer=Train.create_optimizer(params['optimizer'], params['lr']),
+                      loss=[Train.loss(params['sparse_labels'])],
+                      metrics=list(Train.TRAIN_METRICS.keys()))
+
+        out_dir = params['train_dir']
+        callbacks = [ModelCheckpoint(filepath=os.path.join(out_dir, 'model.hdf5'), verbose=0, save_best_only=True),
+                     CSVLogger(os.path.join(out_dir, 'log.csv'), append=True, separator='\t')]
+        if params['early_stop']:
+            early_stopper = EarlyStopping(monitor='val_loss', patience=10, min_delta=0.01, verbose=0, mode='auto')
+            callbacks.append(early_stopper)
+        if params['lr_optim'] in ['one_cycle', 'lr_finder']:
+            callbacks.append(OneCycleLR(max_lr=params['lr'], end_percentage=0.1, scale_percentage=None,
+                                        maximum_momentum=0.95, minimum_momentum=0.85, verbose=False))
+        elif params['lr_optim'] == 'lr_scheduler':
+            callbacks.append(Train.step_decay_schedule(initial_lr=params['lr']))
+
+        history = model.fit(sequence('train', shuffle=True), epochs=params['epochs'], verbose=0,
+                            validation_data=sequence('validation'), callbacks=callbacks).history
+
+        test_sequence = sequence('test')
+        test_results = model.evaluate(test_sequence, verbose=0)
+        y_pred = model.predict(test_sequence.inputs_only(), verbose=0)
+        test_y = np.eye(len(klasses))[np.asarray(data['test'][1])]
+
+        plot_dir = os.path.join(out_dir, 'plots', 'evaluation_metrics')
+        os.makedirs(plot_dir, exist_ok=True)
+        aucs = eval_plots.plot_multiclass_roc_curve(test_y, y_pred, encoded_labels, plot_dir, 'sync')
+        avg_precisions = eval_plots.plot_multiclass_prec_recall_curve(test_y, y_pred, encoded_labels, plot_dir, 'sync')
+
+        metrics = {'eval_loss': str(round(test_results[0], 4)),
+                   'eval_acc': str(round(test_results[1], 4)),
+                   'auc': ', '.join(f'{klass}: {value}' for klass, value in aucs.items()),
+                   'avg_precision': ', '.join(f'{klass}: {value}' for klass, value in avg_precisions.items()),
+                   'train_loss': str(round(history['loss'][-1], 4)),
+                   'train_acc': str(round(history['accuracy'][-1], 4)),
+                   'val_loss': str(round(history['val_loss'][-1], 4)),
+                   'val_acc': str(round(history['val_accuracy'][-1], 4))}
+        if params['early_stop'] and early_stopper.stopped_epoch != 0:
+            metrics['epochs'] = early_stopper.stopped_epoch
+        return {'index': task['index'], 'metrics': metrics}
+    except Exception as err:
+        return {'index': task['index'], 'error': f'{err.__class__.__name__}: {err}'}
+
+
+def run_tasks(tasks, workers):
+    # A fresh (spawned) process per configuration, so that each one gets its own TensorFlow runtime and memory
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=workers, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(train_configuration, tasks):
+            yield result
@@ -7,6 +7,7 @@ import math
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import shutil
 import streamlit as st
 import tensorflow as tf
 import yaml
@@ -14,11 +15,15 @@ import yaml
 from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, CSVLogger, LearningRateScheduler, TensorBoard
 from tensorflow.keras.optimizers import SGD, RMSprop, Adam
 
-from .callbacks import ProgressMonitor, LRFinder, OneCycleLR
+from .callbacks import ProgressMonitor, LRFinder, OneCycleLR, StepRate, TrainingCheckpoint
 from .layers import BRANCH_LAYERS, COMMON_LAYERS
 from .model_builder import ModelBuilder
+from .performance import configure_cpu
+from . import distributed
+from . import sweep
 from ..utils.dataset import Dataset
-from ..utils.exceptions import UserInputError
+from ..utils.exceptions import UserInputError, ProcessError
+from ..utils.profiling import Profiler
 from ..utils import file_utils as f
 from ..utils import sequence as seq
 from ..utils.subcommand import Subcommand
@@ -35,7 +40,10 @@ class Train(Subcommand):
     def __init__(self):
         self.params = {'task': 'Train'}
         self.validation_hash = {'not_empty_branches': [],
-                                'is_dataset_dir': []}
+                                'is_dataset_dir': [],
+                                'is_sweep_spec': [],
+                                'is_checkpoint_dir': [],
+                                'is_worker_list': []}
 
         st.markdown('# Training')
         st.markdown('')
@@ -73,19 +81,47 @@ class Train(Subcommand):
         self.validation_hash['not_empty_branches'].append(self.params['branches'])
 
         self.params['tb'] = st.checkbox('Output TensorBoard log files', value=self.defaults['tb'])
+        self.params['batch_progress'] = st.checkbox('Show training speed (samples/s) and remaining time during the epochs',
+                                                    value=self.defaults['batch_progress'])
+
+        self.params['cpu_mode'] = st.checkbox('CPU performance mode (tune thread pools and XLA compilation when training on CPU)',
+                                              value=self.defaults['cpu_mode'])
+        if self.params['cpu_mode']:
+            max_cpu = os.cpu_count() or 1
+            self.params['intra_threads'] = int(st.number_input(
+                'Threads used within an operation (intra-op threads, 0 = chosen by TensorFlow)',
+                min_value=0, max_value=max_cpu, value=min(self.defaults['intra_threads'], max_cpu)))
+            self.params['inter_threads'] = int(st.number_input(
+                'Operations run in parallel (inter-op threads, 0 = chosen by TensorFlow)',
+                min_value=0, max_value=max_cpu, value=min(self.defaults['inter_threads'], max_cpu)))
+            self.params['xla'] = st.checkbox('Compile the model with XLA', value=self.defaults['xla'])
+            st.markdown('###### Note: The number of threads can be changed only before the first model '
+                        'is built, i.e. restart the application to change them. Steps per second are reported after the training, '
+                        'so that the fastest setting can be chosen per machine.')
 
         st.markdown('## Training Options')
+        self.params['resume'] = st.checkbox('Resume an interrupted training', value=self.defaults['resume'])
+        if self.params['resume']:
+            self.params['resume_dir'] = st.text_input('Folder of the interrupted training (containing the checkpoint subfolder)',
+                                                      value=self.defaults['resume_dir'])
+            self.validation_hash['is_checkpoint_dir'].append(self.params['resume_dir'])
+            st.markdown('###### Note: The training continues with the model, optimizer and parameters saved in the checkpoint, '
+                        'the options below are ignored.')
         # TODO make sure batch size is smaller than dataset size
         self.params['batch_size'] = st.number_input('Batch size', min_value=1, value=self.defaults['batch_size'])
         self.params['epochs'] = st.number_input('No. of training epochs', min_value=1, value=self.defaults['epochs'])
+        self.params['sparse_labels'] = st.checkbox(
+            'Use sparse (integer) class labels (saves memory when training on large datasets)', value=self.defaults['sparse_labels'])
+        self.params['checkpoint_period'] = int(st.number_input(
+            'Save a checkpoint to resume the training from every N epochs', min_value=1, value=self.defaults['checkpoint_period']))
         self.params['early_stop'] = st.checkbox('Apply early stopping (patience 10, delta 0.01)', value=self.defaults['early_stop'])
+        self.evaluation_options()
         self.params['optimizer'] = self.OPTIMIZERS[st.selectbox(
             'Optimizer', list(self.OPTIMIZERS.keys()), index=self.get_dict_index(self.defaults['optimizer'], self.OPTIMIZERS))]
         if self.params['optimizer'] == 'sgd':
-            # TODO move lr finder to hyperparam tuning, runs one epoch on small sample, does not need valid and test data
             lr_options = {'Use fixed learning rate (applies learning rate value throughout whole training)': 'fixed',
                           'Use learning rate scheduler (gradually decreasing from the learning rate value)': 'lr_scheduler',
-                          # 'Use learning rate finder (beta)': 'lr_finder',
+                          'Use learning rate finder (range test, then one cycle policy with the suggested learning rate)': 'lr_finder',
                           'Apply one cycle policy (uses the learning rate value as max)': 'one_cycle'}
             self.params['lr_optim'] = lr_options[st.radio('Learning rate options',
                                                           list(lr_options.keys()),
@@ -176,6 +212,41 @@ class Train(Subcommand):
             else:
                 self.params['common_layers'].append(layer)
 
+        st.markdown('## Sweep')
+        self.params['sweep'] = st.checkbox('Train multiple configurations in parallel (sweep mode)', value=self.defaults['sweep'])
+        if self.params['sweep']:
+            st.markdown('###### Specify lists of values to be tried for the learning rate, optimizer, batch size, '
+                        'branches and common layers (in the same form as stored in the parameters.yaml file). '
+                        'Parameters not listed are taken from the options above.')
+            self.params['sweep_spec'] = st.text_area('Sweep specification (yaml)', value=self.defaults['sweep_spec'], height=250)
+            self.validation_hash['is_sweep_spec'].append({'text': self.params['sweep_spec'], 'branches': self.params['branches']})
+            max_cpu = os.cpu_count() or 1
+            self.params['sweep_workers'] = int(st.number_input(
+                'Number of configurations trained in parallel', min_value=1, max_value=max_cpu,
+                value=min(self.defaults['sweep_workers'], max_cpu)))
+            self.params['sweep_threads'] = int(st.number_input(
+                'Number of CPU threads per each configuration', min_value=1, max_value=max_cpu,
+                value=max(1, min(self.defaults['sweep_threads'] or max_cpu // self.params['sweep_workers'], max_cpu))))
+
+        st.markdown('## Distributed training')
+        self.params['distributed'] = st.checkbox('Train the model in multiple worker processes (data-parallel)',
+                                                 value=self.defaults['distributed'])
+        if self.params['distributed']:
+            st.markdown('###### Each worker trains on its part of every batch (the batch size above is per worker). '
+                        'Workers on localhost are started by the app, for workers on other machines the commands '
+                        'to be run there are displayed.')
+            workers = st.text_area('Workers (one per line, as host:port, the first one being the chief)',
+                                   value='\n'.join(self.defaults['workers']))
+            self.validation_hash['is_worker_list'].append(workers)
+            self.params['workers'] = [line.strip() for line in workers.strip().split('\n') if line.strip()]
+
+        if self.params['cpu_mode'] and (self.params['sweep'] or self.params['distributed']):
+            # Read by TensorFlow only when it starts, thus applicable only to the newly started worker processes
+            self.params['onednn'] = st.checkbox('Apply oneDNN (MKL) optimized settings in the worker processes',
+                                                value=self.defaults['onednn'])
+        else:
+            self.params['onednn'] = False
+
         self.validate_and_run(self.validation_hash)
 
     # TODO adjust when stateful ops enabled
@@ -200,7 +271,13 @@ class Train(Subcommand):
         return layer
 
     @staticmethod
-    def parse_data(dataset_files, branches, label_encoding):
+    def dataset_files(input_folder):
+        candidate_files = f.list_files_in_dir(input_folder, 'zip')
+        categories = ['train', 'validation', 'test', 'blackbox']
+        return [file for file in candidate_files if any(category in os.path.basename(file) for category in categories)]
+
+    @staticmethod
+    def parse_data(dataset_files, branches, label_encoding, sparse_labels=False):
         dictionary = {}
         for file in dataset_files:
             dataset = Dataset.load_from_file(file)
@@ -209,7 +286,7 @@ class Train(Subcommand):
 
             values = dataset.encode_branches(dataset, branches)
             dictionary[dataset.category].update({'values': values})
-            dictionary[dataset.category].update({'labels': dataset.labels(encoding=label_encoding)})
+            dictionary[dataset.category].update({'labels': dataset.labels(encoding=label_encoding, sparse=sparse_labels)})
 
         return [dictionary['train']['values'], dictionary['validation']['values'], dictionary['test']['values'],
                 dictionary['train']['labels'], dictionary['validation']['labels'], dictionary['test']['labels']]
@@ -230,10 +307,20 @@ class Train(Subcommand):
     def run(self):
         status = st.empty()
         status.text('Initializing network...')
+        profiler = Profiler(logger)
 
-        candidate_files = f.list_files_in_dir(self.params['input_folder'], 'zip')
-        categories = ['train', 'validation', 'test', 'blackbox']
-        dataset_files = [file for file in candidate_files if any(category in os.path.basename(file) for category in categories)]
+        if self.params['cpu_mode']:
+            configure_cpu(self.params['intra_threads'], self.params['inter_threads'], self.params['xla'], self.params['onednn'])
+
+        resume_state = None
+        if self.params['resume']:
+            resume_state = TrainingCheckpoint.load_state(self.params['resume_dir'])
+            # The interrupted run continues with its own parameters (and data)
+            self.params.update({key: value for key, value in resume_state['params'].items()
+                                if key not in ['resume', 'resume_dir']})
+            self.previous_param_file = os.path.join(self.params['input_folder'], 'parameters.yaml')
+
+        dataset_files = self.dataset_files(self.params['input_folder'])
 
         if self.previous_param_file:
             with open(self.previous_param_file, 'r') as file:
@@ -243,19 +330,60 @@ class Train(Subcommand):
                 encoded_labels = seq.onehot_encode_alphabet(klass_alphabet)
         else:
             raise UserInputError('Could not read class labels from parameters.yaml file).')
-        train_x, valid_x, test_x, train_y, valid_y, test_y = self.parse_data(dataset_files, self.params['branches'], encoded_labels)
+        if 'signal' in self.params['branches']:
+            # The tracks define the input channels, kept with the model to be checked by the Evaluate and Predict modules
+            self.params['signal_tracks'] = previous_params['Preprocess'].get('signal_tracks', [])
+
+        if self.params['distributed'] and not self.params['sweep'] and not resume_state:
+            self.run_distributed(status, profiler, previous_params)
+            return
+
+        with profiler.span('parse_data') as span:
+            train_x, valid_x, test_x, train_y, valid_y, test_y = self.parse_data(
+                dataset_files, self.params['branches'], encoded_labels, self.params['sparse_labels'])
+            span.rows = len(train_y) + len(valid_y) + len(test_y)
         branch_shapes = self.get_shapes(train_x, self.params['branches'])
-
-        self.params['train_dir'] = os.path.join(self.params['output_folder'], 'training',
-                                 f'{str(datetime.datetime.now().strftime("%Y%m%d-%H%M"))}')
-        self.ensure_dir(self.params['train_dir'])
-
-        model = ModelBuilder(self.params['branches'], encoded_labels, branch_shapes, self.params['branches_layers'], self.params['common_layers']).build_model()
-        optimizer = self.create_optimizer(self.params['optimizer'], self.params['lr'])
-        model.compile(
-            optimizer=optimizer,
-            loss=['categorical_crossentropy'],
-            metrics=[list(self.TRAIN_METRICS.keys())])
+        input_bytes = sum(x.nbytes for data in [train_x, valid_x, test_x] for x in (data if isinstance(data, list) else [data]))
+        logger.info(f'Encoded inputs take {input_bytes / 2**20:.1f} MB of memory.')
+
+        if self.params['sweep']:
+            self.run_sweep(status, profiler, klasses, previous_params,
+                           {'train': train_x, 'validation': valid_x, 'test': test_x},
+                           {'train': train_y, 'validation': valid_y, 'test': test_y})
+            return
+
+        if resume_state:
+            # Model restored including the optimizer state, the train_dir is the one of the interrupted run
+            model = TrainingCheckpoint.load_model(self.params['train_dir'])
+            initial_epoch = resume_state['epoch']
+            self.truncate_log(self.params['train_dir'], initial_epoch)
+            TrainingCheckpoint.restore_rng(resume_state)
+        else:
+            self.params['train_dir'] = os.path.join(self.params['output_folder'], 'training',
+                                     f'{str(datetime.datetime.now().strftime("%Y%m%d-%H%M"))}')
+            self.ensure_dir(self.params['train_dir'])
+
+            model = ModelBuilder(self.params['branches'], encoded_labels, branch_shapes, self.params['branches_layers'], self.params['common_layers']).build_model()
+            optimizer = self.create_optimizer(self.params['optimizer'], self.params['lr'])
+            model.compile(
+                optimizer=optimizer,
+                loss=[self.loss(self.params['sparse_labels'])],
+                metrics=[list(self.TRAIN_METRICS.keys())])
+            initial_epoch = 0
+
+            if self.params['lr_optim'] == 'lr_finder':
+                status.text('Running the learning rate range test...')
+                with profiler.span('lr_range_test'):
+                    lr = self.lr_range_test(model, self.params['optimizer'], self.loss(self.params['sparse_labels']),
+                                            train_x, train_y, valid_x, valid_y, self.params['batch_size'],
+                                            os.path.join(self.params['train_dir'], 'lr_finder'))
+                if lr:
+                    self.params['lr'] = round(lr, 6)
+                    tf.keras.backend.set_value(model.optimizer.lr, self.params['lr'])
+                    logger.info(f"LR finder: suggested learning rate {self.params['lr']}")
+                    st.text(f"Suggested learning rate (maximum of the one cycle policy): {self.params['lr']}")
+                else:
+                    logger.warning('LR finder did not record any losses, the given learning rate is used.')
 
         # Train the model
         status.text('Training the network...')
@@ -266,11 +394,23 @@ class Train(Subcommand):
 
         callbacks = self.create_callbacks(
             self.params['train_dir'], self.params['lr_optim'], self.params['tb'], self.params['epochs'], progress_bar, progress_status, chart, self.params['early_stop'],
-            self.params['lr'], branch_shapes[self.params['branches'][0]][0])
-
-        history = self.train(model, self.params['epochs'], self.params['batch_size'], callbacks, train_x, valid_x, train_y, valid_y).history
-        # if self.params['lr_optim'] == 'lr_finder': self.params['epochs'] = 1
-        # if self.params['lr_optim'] == 'lr_finder': LRFinder.plot_schedule_from_file(self.params['train_dir'])
+            self.params['lr'], branch_shapes[self.params['branches'][0]][0], self.params['batch_progress'])
+        # Must come last, to restore the state of the callbacks above when resuming
+        callbacks.append(TrainingCheckpoint(self.params['train_dir'], self.params, list(callbacks),
+                                            self.params['checkpoint_period'], resume_state))
+
+        with profiler.span('fit') as span:
+            history = self.train(model, self.params['epochs'], self.params['batch_size'], callbacks, train_x, valid_x,
+                                 train_y, valid_y, initial_epoch).history
+            span.rows = len(train_y) * len(history['loss'])
+        if resume_state:
+            # Metrics of the epochs before the interruption are read back from the log
+            history = self.read_history(self.params['train_dir'])
+        steps_per_sec = [callback for callback in callbacks if type(callback) == StepRate][0].steps_per_sec()
+        if steps_per_sec:
+            self.params['steps_per_sec'] = round(steps_per_sec, 2)
+            logger.info(f"Training speed: {self.params['steps_per_sec']} steps/s")
+            st.text(f"Training speed: {self.params['steps_per_sec']} steps/s (batch size {self.params['batch_size']})")
 
         if self.params['early_stop']:
             early_epochs = [callback for callback in callbacks if type(callback) == EarlyStopping][0]
@@ -280,7 +420,6 @@ class Train(Subcommand):
         self.log_train_val_metrics(history, self.params)
 
         # Plot training metrics
-        # if self.params['lr_optim'] != 'lr_finder':
         train_plot_dir = os.path.join(self.params['train_dir'], 'plots', 'training_metrics')
         self.ensure_dir(train_plot_dir)
         for metric, title in self.TRAIN_METRICS.items():
@@ -300,11 +439,13 @@ class Train(Subcommand):
         status.text('Evaluating model...')
         eval_plot_dir = os.path.join(self.params['train_dir'], 'plots', 'evaluation_metrics')
         self.ensure_dir(eval_plot_dir)
-        self.evaluate_model(encoded_labels, model, test_x, test_y, self.params, eval_plot_dir)
+        with profiler.span('evaluate', rows=len(test_y)):
+            self.evaluate_model(encoded_labels, model, test_x, test_y, self.params, eval_plot_dir)
+        self.wait_for_plots()
 
         # Prepare tsv row content
-        header = self.train_header()
-        row = self.train_row(self.params)
+        header = self.train_header() + profiler.header()
+        row = self.train_row(self.params) + profiler.row()
         if 'Preprocess' in previous_params.keys():
             # Parameters missing in older versions of the code
             novel_params = {'win_place': 'rand'}  # It's always been 'random' for the previous versions
@@ -320,6 +461,107 @@ class Train(Subcommand):
         status.text('Finished!')
         logger.info('Finished!')
 
+    def run_sweep(self, status, profiler, klasses, previous_params, values, labels):
+        sweep_dir = os.path.join(self.params['output_folder'], 'training',
+                                 f'{str(datetime.datetime.now().strftime("%Y%m%d-%H%M"))}-sweep')
+        self.ensure_dir(sweep_dir)
+        data_dir = os.path.join(sweep_dir, 'data')
+
+        status.text('Saving the encoded datasets to be shared by the workers...')
+        with profiler.span('save_shared_data', rows=sum(len(y) for y in labels.values())):
+            sweep.save_data(data_dir, self.params['branches'], values, labels)
+
+        configs = sweep.configurations(sweep.parse_spec(self.params['sweep_spec']), self.params, seed=456)
+        tasks = []
+        for i, config in enumerate(configs):
+            params = sweep.config_params(self.params, config)
+            params['train_dir'] = os.path.join(sweep_dir, f'config_{i + 1}')
+            self.ensure_dir(params['train_dir'])
+            tasks.append({'index': i, 'params': params, 'klasses': klasses, 'data_dir': data_dir,
+                          'threads': self.params['sweep_threads'], 'seed': 456})
+        logger.info(f"Sweep: training {len(tasks)} configurations, {self.params['sweep_workers']} in parallel, "
+                    f"{self.params['sweep_threads']} thread(s) each.")
+
+        status.text(f'Training {len(tasks)} configurations...')
+        progress_bar = st.progress(0)
+        results_text = st.empty()
+        finished = []
+        with profiler.span('sweep', rows=len(tasks)):
+            for done, result in enumerate(sweep.run_tasks(tasks, self.params['sweep_workers'])):
+                params = tasks[result['index']]['params']
+                if 'error' in result:
+                    logger.warning(f"Sweep: configuration {os.path.basename(params['train_dir'])} failed: {result['error']}")
+                    finished.append(f"{os.path.basename(params['train_dir'])}: failed ({result['error']})")
+                else:
+                    params.update(result['metrics'])
+                    self.save_params(params['train_dir'], params, self.previous_param_file)
+                    header = self.train_header()
+                    row = self.train_row(params)
+                    if 'Preprocess' in previous_params.keys():
+                        parameters = {'win_place': 'rand'}  # It's always been 'random' for the previous versions
+                        parameters.update(previous_params['Preprocess'])
+                        header += f'{self.preprocess_header()}\n'
+                        row += f"{self.preprocess_row(parameters)}\n"
+                    else:
+                        header += '\n'
+                        row += '\n'
+                    self.append_to_table(params['train_dir'], header, row)
+                    finished.append(f"{os.path.basename(params['train_dir'])}: evaluation accuracy {params['eval_acc']}, "
+                                    f"loss {params['eval_loss']} (optimizer {params['optimizer']}, lr {params['lr']}, "
+                                    f"batch size {params['batch_size']})")
+                progress_bar.progress((done + 1) / len(tasks))
+                results_text.text('\n'.join(finished))
+
+        shutil.rmtree(data_dir, ignore_errors=True)
+        # Rows of the individual configurations were already written to the sweep folder's parameters.tsv
+        self.finalize_run(logger, sweep_dir, self.params, None, None, previous_param_file=self.previous_param_file)
+        status.text('Finished!')
+        logger.info('Finished!')
+
+    def run_distributed(self, status, profiler, previous_params):
+        # The workers read the data and parameters on their own, from the parameters.yaml file in the train_dir
+        self.params['train_dir'] = os.path.join(self.params['output_folder'], 'training',
+                                                f'{str(datetime.datetime.now().strftime("%Y%m%d-%H%M"))}-distributed')
+        self.ensure_dir(self.params['train_dir'])
+        self.save_params(self.params['train_dir'], self.params, self.previous_param_file)
+        param_file = os.path.join(self.params['train_dir'], 'parameters.yaml')
+
+        if not distributed.is_local(self.params['workers']):
+            commands = [' '.join(distributed.worker_command(param_file, i)) for i in range(len(self.params['workers']))]
+            st.markdown('###### Run the following commands (from the enngene folder of the repository) on the respective '
+                        'workers. The chief (first worker) exports the results to the training folder.')
+            st.text('\n'.join(f'{worker}: {command}' for worker, command in zip(self.params['workers'], commands)))
+            logger.info('Distributed training prepared, worker commands:\n' + '\n'.join(commands))
+            return
+
+        status.text(f"Training the network in {len(self.params['workers'])} local worker processes...")
+        with profiler.span('distributed_fit'):
+            exit_codes = distributed.launch_local(param_file)
+        if any(exit_codes):
+            raise ProcessError(f'Distributed training failed (worker exit codes: {exit_codes}), see the log for details.')
+
+        with open(param_file, 'r') as file:
+            self.params = yaml.safe_load(file)['Train']
+        header = self.train_header() + profiler.header()
+        row = self.train_row(self.params) + profiler.row()
+        if 'Preprocess' in previous_params.keys():
+            parameters = {'win_place': 'rand'}  # It's always been 'random' for the previous versions
+            parameters.update(previous_params['Preprocess'])
+            header += f'{self.preprocess_header()}\n'
+            row += f"{self.preprocess_row(parameters)}\n"
+        else:
+            header += '\n'
+            row += '\n'
+
+        self.finalize_run(logger, self.params['train_dir'], self.params, header, row, previous_param_file=self.previous_param_file)
+        status.text('Finished!')
+        logger.info('Finished!')
+
+    @staticmethod
+    def loss(sparse_labels):
+        # The integer labels spare allocating the one-hot label matrix
+        return 'sparse_categorical_crossentropy' if sparse_labels else 'categorical_crossentropy'
+
     @staticmethod
     def step_decay_schedule(initial_lr, drop=0.5, epochs_drop=10.0):
         def schedule(epoch):
@@ -327,7 +569,8 @@ class Train(Subcommand):
         return LearningRateScheduler(schedule)
 
     @staticmethod
-    def create_callbacks(out_dir, lr_optim, tb, epochs, progress_bar, progress_status, chart, early_stop, lr, sample):
+    def create_callbacks(out_dir, lr_optim, tb, epochs, progress_bar, progress_status, chart, early_stop, lr, sample,
+                         batch_progress=False):
         mcp = ModelCheckpoint(filepath=out_dir + '/model.hdf5',
                               verbose=0,
                               save_best_only=True)
@@ -336,9 +579,9 @@ class Train(Subcommand):
                                append=True,
                                separator='\t')
 
-        progress = ProgressMonitor(epochs, progress_bar, progress_status, chart, Train.TRAIN_METRICS.keys())
+        progress = ProgressMonitor(epochs, progress_bar, progress_status, chart, Train.TRAIN_METRICS.keys(), batch_progress)
 
-        callbacks = [mcp, csv_logger, progress]
+        callbacks = [mcp, csv_logger, progress, StepRate()]
 
         if early_stop:
             earlystopper = EarlyStopping(monitor='val_loss',
@@ -349,14 +592,8 @@ class Train(Subcommand):
             callbacks.append(earlystopper)
 
         if lr_optim != 'fixed':
-            # if lr_optim == 'lr_finder':
-            #     callbacks.append(LRFinder(num_samples=sample,
-            #                               batch_size=sample//30,
-            #                               minimum_lr=1e-5,
-            #                               maximum_lr=1e0,
-            #                               lr_scale='exp',
-            #                               save_dir=out_dir))
-            if lr_optim == 'one_cycle':
+            # The lr found by the range test is used as the maximum of the one cycle policy
+            if lr_optim in ['one_cycle', 'lr_finder']:
                 callbacks.append(OneCycleLR(max_lr=lr,
                                             end_percentage=0.1,
                                             scale_percentage=None,
@@ -372,6 +609,25 @@ class Train(Subcommand):
 
         return callbacks
 
+    @staticmethod
+    def lr_range_test(model, optimizer, loss, train_x, train_y, valid_x, valid_y, batch_size, out_dir, steps=100):
+        # A fixed number of steps on a training sample, run on a copy of the model not to alter its initial weights
+        test_model = tf.keras.models.clone_model(model)
+        test_model.set_weights(model.get_weights())
+        test_model.compile(optimizer=Train.create_optimizer(optimizer, 1e-5), loss=[loss])
+
+        idx = np.sort(np.random.choice(len(train_y), min(len(train_y), steps * batch_size), replace=False))
+        x = [branch[idx] for branch in train_x] if isinstance(train_x, list) else train_x[idx]
+        lr_finder = LRFinder(num_samples=len(idx), batch_size=batch_size, minimum_lr=1e-5, maximum_lr=1e0,
+                             lr_scale='exp', validation_data=(valid_x, valid_y), validation_sample_rate=5,
+                             save_dir=out_dir, verbose=False)
+        test_model.fit(x, train_y[idx], batch_size=batch_size, epochs=1, shuffle=True, verbose=0, callbacks=[lr_finder])
+        if not lr_finder.history:
+            return None
+
+        LRFinder.plot_schedule_from_file(out_dir)
+        return LRFinder.suggest_lr(lr_finder.lrs, lr_finder.losses)
+
     @staticmethod
     def create_optimizer(chosen, learning_rate):
         if chosen == 'sgd':
@@ -391,7 +647,7 @@ class Train(Subcommand):
         return optimizer
 
     @staticmethod
-    def train(model, epochs, batch_size, callbacks, train_x, valid_x, train_y, valid_y):
+    def train(model, epochs, batch_size, callbacks, train_x, valid_x, train_y, valid_y, initial_epoch=0):
         history = model.fit(
             train_x,
             train_y,
@@ -399,10 +655,24 @@ class Train(Subcommand):
             epochs=epochs,
             verbose=1,
             validation_data=(valid_x, valid_y),
-            callbacks=callbacks)
+            callbacks=callbacks,
+            initial_epoch=initial_epoch)
 
         return history
 
+    @staticmethod
+    def truncate_log(out_dir, epochs):
+        # Drop the epochs logged after the last checkpoint, they are going to be trained again
+        log_file = os.path.join(out_dir, 'log.csv')
+        if os.path.isfile(log_file):
+            log = pd.read_csv(log_file, sep='\t')
+            log[log['epoch'] < epochs].to_csv(log_file, sep='\t', index=False)
+
+    @staticmethod
+    def read_history(out_dir):
+        log = pd.read_csv(os.path.join(out_dir, 'log.csv'), sep='\t')
+        return {column: log[column].tolist() for column in log.columns if column != 'epoch'}
+
     @staticmethod
     def log_train_val_metrics(history, params):
         st.text('Final metric values:')
@@ -449,7 +719,7 @@ class Train(Subcommand):
         plt.xlabel('Epoch')
         plt.legend(loc='lower right')
         plt.savefig(file_path, format='png', dpi=300)
-        plt.clf()
+        plt.close()
 
     @staticmethod
     def initialize_altair_chart():
@@ -465,17 +735,36 @@ class Train(Subcommand):
 
     @staticmethod
     def default_params():
-        return {'batch_size': 256,
+        return {'batch_progress': False,
+                'batch_size': 256,
+                'bootstrap': False,
+                'bootstrap_samples': 1000,
                 'branches': [],
-                'branches_layers': {'seq': [], 'fold': [], 'cons': []},
+                'branches_layers': {'seq': [], 'fold': [], 'cons': [], 'signal': []},
+                'checkpoint_period': 1,
                 'common_layers': [],
+                'cpu_mode': False,
+                'distributed': False,
                 'early_stop': True,
                 'epochs': 100,
                 'input_folder': '',
+                'inter_threads': 0,
+                'intra_threads': 0,
                 'lr': 0.005,
                 'lr_optim': 'fixed',
                 'no_branches_layers': 1,
                 'no_common_layers': 1,
+                'onednn': False,
                 'optimizer': 'sgd',
                 'output_folder': os.path.join(os.path.expanduser('~'), 'enngene_output'),
-                'tb': True}
+                'render_plots': True,
+                'resume': False,
+                'resume_dir': '',
+                'sparse_labels': False,
+                'sweep': False,
+                'sweep_spec': sweep.DEFAULT_SPEC,
+                'sweep_threads': 0,
+                'sweep_workers': 2,
+                'tb': True,
+                'workers': ['localhost:12345', 'localhost:12346'],
+                'xla': False}
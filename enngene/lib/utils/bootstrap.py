@@ -0,0 +1,130 @@
+"""Bootstrap confidence intervals of the evaluation metrics (accuracy, per class AUC and average precision).
+
+All the resamples of a chunk are evaluated at once: the index matrix of the resamples is turned into a matrix
+of sample counts, and the rank based metrics are computed from the counts accumulated over the distinct scores.
+The resamples per chunk are limited by the number of samples (ELEMENT_BUDGET), and the chunks are spread across
+a process pool of as many workers as fit into the free memory.
+"""
+import logging
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+
+logger = logging.getLogger('root')
+
+# Elements of the (resamples, samples) matrices of a chunk, the number of resamples per chunk is derived from it
+ELEMENT_BUDGET = 2 ** 22
+# Approximate peak memory per element of a chunk (the int32 counts and the float64 cumulative sums of a class)
+BYTES_PER_ELEMENT = 80
+
+# Data of the evaluated samples, sent to each worker process just once
+_data = {}
+
+
+def resample_counts(idx, n):
+    # Matrix (resamples, samples) of how many times each sample was drawn to the resample
+    offsets = (np.arange(len(idx), dtype=np.int32) * n)[:, np.newaxis]
+    counts = np.bincount((idx + offsets).ravel(), minlength=len(idx) * n)
+    return counts.astype(np.int32).reshape((len(idx), n))
+
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def score_groups(scores):
+    # Samples ordered by descending score, and the starts of the groups of equal (tied) scores
+    order = np.argsort(-scores, kind='mergesort')
+    sorted_scores = scores[order]
+    starts = np.flatnonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1]])
+    return order, starts
+
+
+def auc_and_ap(counts, positive, order, starts):
+    # counts: (resamples, samples), positive: boolean vector of the samples of the class
+    ordered = counts[:, order]
+    pos = np.add.reduceat(ordered * positive[order], starts, axis=1).astype(np.float64)
+    neg = np.add.reduceat(ordered, starts, axis=1).astype(np.float64) - pos
+    del ordered
+    total_pos = pos.sum(axis=1)
+    total_neg = neg.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Mann-Whitney statistic, ties counted by half
+        lower_neg = total_neg[:, np.newaxis] - np.cumsum(neg, axis=1)
+        auc = (pos * (lower_neg + 0.5 * neg)).sum(axis=1) / (total_pos * total_neg)
+        del lower_neg
+
+        # Step-wise average precision, as in sklearn.metrics.average_precision_score
+        tp = np.cumsum(pos, axis=1)
+        fp = np.cumsum(neg, axis=1)
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.)
+        ap = (pos * precision).sum(axis=1) / total_pos
+    return auc, ap
+
+
+def init_worker(true_codes, y_pred):
+    # The score groups of the classes are shared by all the chunks of the worker
+    _data['true_codes'] = true_codes
+    _data['correct'] = (np.argmax(y_pred, axis=1) == true_codes).astype(np.int32)
+    _data['groups'] = [score_groups(y_pred[:, klass]) for klass in range(y_pred.shape[1])]
+
+
+def bootstrap_chunk(args):
+    resamples, seed = args
+    true_codes, correct, groups = _data['true_codes'], _data['correct'], _data['groups']
+    n = len(true_codes)
+    idx = np.random.RandomState(seed).randint(0, n, size=(resamples, n), dtype=np.int32)
+    counts = resample_counts(idx, n)
+    del idx
+
+    acc = (counts @ correct) / n
+    aucs = np.empty((resamples, len(groups)))
+    aps = np.empty((resamples, len(groups)))
+    for klass, (order, starts) in enumerate(groups):
+        aucs[:, klass], aps[:, klass] = auc_and_ap(counts, true_codes == klass, order, starts)
+    return acc, aucs, aps
+
+
+def confidence_intervals(true_codes, y_pred, resamples=1000, confidence=0.95, seed=42, workers=None):
+    """Returns the (lower, upper) bounds of the accuracy, and lists of the bounds of AUC and AP per class.
+
+    A resample missing the positive (or negative) samples of a class is skipped for its AUC and AP.
+    """
+    true_codes = np.asarray(true_codes)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    n = len(y_pred)
+    chunk_size = max(1, ELEMENT_BUDGET // max(n, 1))
+    chunks = [(min(chunk_size, resamples - start), seed + i) for i, start in enumerate(range(0, resamples, chunk_size))]
+
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    memory = available_memory()
+    if memory:
+        # As many chunks at once as fit into the free memory
+        workers = max(1, min(workers, int(memory // (min(chunk_size, resamples) * n * BYTES_PER_ELEMENT))))
+
+    if workers > 1:
+        # Spawned, not forked, not to copy the state of the already running TensorFlow runtime
+        with multiprocessing.get_context('spawn').Pool(processes=workers, initializer=init_worker,
+                                                       initargs=(true_codes, y_pred)) as pool:
+            results = pool.map(bootstrap_chunk, chunks)
+    else:
+        init_worker(true_codes, y_pred)
+        results = [bootstrap_chunk(chunk) for chunk in chunks]
+        _data.clear()
+
+    acc = np.concatenate([result[0] for result in results])
+    aucs = np.concatenate([result[1] for result in results])
+    aps = np.concatenate([result[2] for result in results])
+    percentiles = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+    with warnings.catch_warnings():
+        # All-nan slices of the classes too rare to be drawn
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return (tuple(np.percentile(acc, percentiles)),
+                [tuple(bounds) for bounds in np.nanpercentile(aucs, percentiles, axis=0).T],
+                [tuple(bounds) for bounds in np.nanpercentile(aps, percentiles, axis=0).T])
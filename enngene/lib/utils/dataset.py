@@ -8,18 +8,25 @@ import re
 import streamlit as st
 import subprocess
 import tempfile
+import yaml
 
 from functools import reduce
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from .exceptions import UserInputError, ProcessError
+from .profiling import Profiler
 from . import file_utils as f
 from . import sequence as seq
+from . import tracks
 
 logger = logging.getLogger('root')
 
 
 class Dataset:
+    # Files of a pre-encoded dataset folder (besides one {branch}.npy file per branch)
+    ENCODED_INFO = 'encoded.yaml'
+    ENCODED_META = 'meta.tsv'
+    ENCODED_LABELS = 'labels.npy'
 
     @classmethod
     @st.cache(hash_funcs={_io.TextIOWrapper: lambda _: None}, suppress_st_warning=True)
@@ -43,6 +50,19 @@ class Dataset:
 
         return cls(branches=branches, category=category, df=df)
 
+    @classmethod
+    def load_encoded(cls, dir_path):
+        # The encoded branches are memory-mapped, only the batches actually used are read from the disk
+        with open(os.path.join(dir_path, cls.ENCODED_INFO), 'r') as file:
+            info = yaml.safe_load(file)
+        df = pd.read_csv(os.path.join(dir_path, cls.ENCODED_META), sep='\t', header=0)
+        values = {branch: np.load(os.path.join(dir_path, f'{branch}.npy'), mmap_mode='r') for branch in info['branches']}
+        labels_path = os.path.join(dir_path, cls.ENCODED_LABELS)
+        labels = np.load(labels_path) if os.path.isfile(labels_path) else None
+
+        dataset = cls(branches=info['branches'], category=info.get('category'), df=df)
+        return dataset, values, labels, info.get('klasses')
+
     @classmethod
     def split_by_chr(cls, dataset, chrs_by_category):
         split_datasets = set()
@@ -53,52 +73,70 @@ class Dataset:
 
         return split_datasets
 
+    @staticmethod
+    def random_ranks(klasses, rng, stratify=True):
+        # Draws a random order of all the rows at once. Returns the permutation together with the rank of each
+        # permuted row within its klass (or within the whole dataset if not stratified) and the size of that group.
+        size = len(klasses)
+        order = rng.permutation(size)
+        if stratify:
+            codes, uniques = pd.factorize(klasses)
+            # stable sort groups the rows by klass while keeping the random order within each klass
+            order = order[np.argsort(codes[order], kind='mergesort')]
+            counts = np.bincount(codes, minlength=len(uniques))
+            ranks = np.arange(size) - np.repeat(np.cumsum(counts) - counts, counts)
+            group_sizes = np.repeat(counts, counts)
+        else:
+            ranks = np.arange(size)
+            group_sizes = np.full(size, size)
+        return order, ranks, group_sizes
+
     @classmethod
-    def split_random(cls, dataset, ratio):
+    def split_random(cls, dataset, ratio, seed=None, stratify=True):
         # so far the categories are fixed, not sure if there would be need for custom categories
         ratio_list = ratio.split(':')
         ratio_list = [float(x) for x in ratio_list]
-        dataset_size = dataset.df.shape[0]
         total = sum(ratio_list)
-        np.random.shuffle(dataset.df.values)
-        split_datasets = set()
+        rng = np.random.RandomState(seed)
+        order, ranks, group_sizes = cls.random_ranks(dataset.df['klass'].values, rng, stratify)
 
-        validation_size = int(dataset_size * ratio_list[1] / total)
-        test_size = (int(dataset_size * ratio_list[2] / total))
-        blackbox_size = (int(dataset_size * ratio_list[3] / total))
-        dfs = {'validation': dataset.df[:validation_size]}
-        dfs.update({'test': dataset.df[validation_size:(validation_size + test_size)]})
-        dfs.update({'blackbox': dataset.df[(validation_size + test_size):(validation_size + test_size + blackbox_size)]})
-        dfs.update({'train': dataset.df[(validation_size + test_size + blackbox_size):]})
+        # Within each group, first ranks go to validation, then test, blackbox, and the rest to train
+        categories = ['validation', 'test', 'blackbox', 'train']
+        category_codes = np.zeros(len(order), dtype=np.int8)
+        bound = np.zeros(len(order), dtype=np.int64)
+        for ratio_part in ratio_list[1:]:
+            bound += (group_sizes * ratio_part / total).astype(np.int64)
+            category_codes += (ranks >= bound)
 
-        for category, df in dfs.items():
+        split_datasets = set()
+        for code, category in enumerate(categories):
+            # Sorted positions keep the original order of the rows (and the rows are taken from the frame just once)
+            positions = np.sort(order[category_codes == code])
             split_datasets.add(
-                Dataset(klass=dataset.klass, branches=dataset.branches, category=category, df=df))
+                Dataset(klass=dataset.klass, branches=dataset.branches, category=category, df=dataset.df.iloc[positions]))
 
         return split_datasets
 
+    @classmethod
+    def reduce_by_klass(cls, dataset, ratios, seed=None):
+        # Reduces all the klasses given in ratios dict (klass: ratio or final size) in one pass
+        rng = np.random.RandomState(seed)
+        klasses = dataset.df['klass'].values
+        order, ranks, _ = cls.random_ranks(klasses, rng, stratify=True)
+
+        codes, uniques = pd.factorize(klasses)
+        counts = np.bincount(codes, minlength=len(uniques))
+        klass_limits = np.array([cls.reduced_size(count, ratios[klass]) if klass in ratios else count
+                                 for klass, count in zip(uniques, counts)], dtype=np.int64)
+        positions = np.sort(order[ranks < klass_limits[codes[order]]])
+        return cls(klass=dataset.klass, branches=dataset.branches, category=dataset.category, df=dataset.df.iloc[positions])
+
     @classmethod
     def merge_dataframes(cls, dataset_list):
         dataframes = [dataset.df for dataset in dataset_list]
         merged_df = reduce(lambda left, right: pd.merge(left, right, how='outer'), dataframes)
         return merged_df
 
-    @classmethod
-    def merge_by_category(cls, set_of_datasets):
-        datasets_by_category = {}
-        for dataset in set_of_datasets:
-            if dataset.category not in datasets_by_category.keys():
-                datasets_by_category.update({dataset.category: []})
-            datasets_by_category[dataset.category].append(dataset)
-
-        merged_datasets = set()
-        for category, datasets in datasets_by_category.items():
-            branches = datasets[0].branches
-            merged_df = cls.merge_dataframes(datasets)
-            merged_datasets.add(cls(branches=branches, category=category, df=merged_df))
-
-        return merged_datasets
-
     def __init__(self, klass=None, branches=None, category=None, win=None, win_place=None,
                  bed_file=None, fasta_file=None, text_input=None, df=None):
         self.branches = branches  # list of seq, cons or fold branches
@@ -154,29 +192,36 @@ class Dataset:
 
         return df
 
-    def reduce(self, ratio):
-        np.random.shuffle(self.df.values)
+    @staticmethod
+    def reduced_size(size, ratio):
         if ratio <= 1:
             # handle as a ratio
-            last = int(self.df.shape[0] * ratio)
-        elif ratio < len(self.df.values):
+            return int(size * ratio)
+        elif ratio < size:
             # handle as a final size
-            last = int(ratio)
-        elif ratio >= len(self.df.values):
+            return int(ratio)
+        else:
             # keep the full dataset
-            last = len(self.df.values)-1
-        self.df = self.df[:last]
-        return self
+            return size
 
-    def labels(self, encoding=None):
+    def labels(self, encoding=None, sparse=False):
         labels = self.df['klass']
         if encoding:
-            encoded_labels = [seq.translate(item, encoding) for item in labels]
-            return np.array(encoded_labels)
+            # Classes ordered by the position of 1 in their one-hot encoding
+            klasses = sorted(encoding.keys(), key=lambda klass: np.argmax(encoding[klass]))
+            codes = pd.Categorical(labels, categories=klasses).codes
+            if (codes < 0).any():
+                unknown = labels[codes < 0].iloc[0]
+                raise UserInputError(f"Invalid class '{unknown}' found, given encoding {encoding}. "
+                                     f"Class names must correspond to those used when training the model.")
+            if sparse:
+                return codes.astype(np.int32)
+            return np.eye(len(klasses))[codes]
         else:
             return np.array(labels)
 
-    def map_to_branches(self, references, strand, outfile_path, status, predict=False, ncpu=1):
+    def map_to_branches(self, references, strand, outfile_path, status, predict=False, ncpu=1, profiler=None):
+        profiler = profiler or Profiler()
         mapped = False
         # map seq branch first so that we can replace the df without loosing anny information
         branches = sorted(self.branches, key=lambda x: (x != 'seq', x != 'fold'))
@@ -185,26 +230,35 @@ class Dataset:
             if branch == 'seq':
                 if 'seq' not in self.df.columns:
                     status.text(f'Mapping intervals to the fasta reference...')
-                    self.df = self.map_to_fasta(self.df, branch, strand, references[branch], predict)
+                    with profiler.span('map_to_fasta', rows=len(self.df)):
+                        self.df = self.map_to_fasta(self.df, branch, strand, references[branch], predict)
                 mapped = True
             elif branch == 'cons':
                 status.text(f'Mapping intervals to the wig reference... \n'
                             f'Note: This is rather slow process, it may take a while.')
-                self.df = Dataset.map_to_wig(branch, self.df, references[branch])
+                with profiler.span('map_to_wig', rows=len(self.df)):
+                    self.df = Dataset.map_to_wig(branch, self.df, references[branch])
+            elif branch == 'signal':
+                status.text(f'Mapping intervals to the signal tracks...')
+                with profiler.span('map_to_tracks', rows=len(self.df)):
+                    self.df = Dataset.map_to_tracks(branch, self.df, references[branch])
             elif branch == 'fold':
                 status.text(f'Folding the sequences...')
                 if mapped:
                     self.df['fold'] = self.df['seq']  # already finished above
                 else:
-                    self.df = self.map_to_fasta(self.df, branch, strand, references[branch], predict)
+                    with profiler.span('map_to_fasta', rows=len(self.df)):
+                        self.df = self.map_to_fasta(self.df, branch, strand, references[branch], predict)
                 # TODO for prediction/evaluation key_cols = seq pravdepodobne
                 key_cols = ['chrom_name', 'seq_start', 'seq_end', 'strand_sign']
 
                 seq_branch = 'seq' in branches
-                self.df = self.fold_branch(self.df, key_cols, seq_branch, ncpu)
+                with profiler.span('fold_branch', rows=len(self.df)):
+                    self.df = self.fold_branch(self.df, key_cols, seq_branch, ncpu)
 
         self.df.dropna(subset=branches, inplace=True)
-        self.save_to_file(outfile_path, ignore_cols=['name', 'score'], do_zip=True)
+        with profiler.span('save_mapped', rows=len(self.df)):
+            self.save_to_file(outfile_path, ignore_cols=['name', 'score'], do_zip=True)
         return self
 
     def sort_datapoints(self):
@@ -223,6 +277,35 @@ class Dataset:
             zipped.close()
             os.remove(outfile_path)
 
+    def save_encoded(self, out_dir, klasses=None, chunk_size=10000):
+        # Encodes the branches chunk by chunk straight into .npy files, so that the encoded dataset is never held
+        # in memory as a whole, and can be later memory-mapped by the Evaluate and Predict modules
+        os.makedirs(out_dir, exist_ok=True)
+        size = len(self.df)
+        arrays = {}
+        for start in range(0, size, chunk_size):
+            chunk = Dataset(branches=self.branches, df=self.df.iloc[start:(start + chunk_size)].reset_index(drop=True))
+            values = self.encode_branches(chunk, self.branches)
+            if len(self.branches) == 1:
+                values = [values]
+            for branch, value in zip(self.branches, values):
+                if branch not in arrays:
+                    arrays[branch] = np.lib.format.open_memmap(os.path.join(out_dir, f'{branch}.npy'), mode='w+',
+                                                               dtype=value.dtype, shape=((size,) + value.shape[1:]))
+                arrays[branch][start:(start + len(value))] = value
+        for array in arrays.values():
+            array.flush()
+
+        if klasses and 'klass' in self.df.columns:
+            # Labels are stored as indices of the given class list
+            codes = pd.Categorical(self.df['klass'], categories=klasses).codes.astype(np.int16)
+            np.save(os.path.join(out_dir, self.ENCODED_LABELS), codes)
+
+        self.save_to_file(os.path.join(out_dir, self.ENCODED_META), ignore_cols=['name', 'score'])
+        info = {'branches': list(self.branches), 'category': self.category, 'klasses': klasses, 'size': size}
+        with open(os.path.join(out_dir, self.ENCODED_INFO), 'w') as file:
+            yaml.dump(info, file)
+
     def encode_col(self, col, new_col, encoding):
         def map(row):
             sequence = row[col]
@@ -245,16 +328,13 @@ class Dataset:
                 values.append(np.array(value))
         else:
             for branch in branches:
+                # One-hot branches are kept in float16 (exact for the encoded values), scores in float32
                 if branch in ['seq', 'fold']:
                     alphabet = seq.ALPHABET if branch == 'seq' else seq.FOLDING
                     branch_encoding = seq.onehot_encode_alphabet(alphabet)
-                    dataset.encode_col(branch, f'{branch}_encoded', branch_encoding)
-                    np_col = [np.array(value) for value in dataset.df[f'{branch}_encoded']]
-                    values.append(np.array(np_col))
-                elif branch == 'cons':
-                    dataset.df[branch] = dataset.df.apply(lambda x: [float(n) for n in x[branch].split(',')], axis=1)
-                    np_col = [np.array([np.array([float(v)]) for v in value]) for value in dataset.df[branch].to_list()]
-                    values.append(np.array(np_col))
+                    values.append(seq.encode_strings(dataset.df[branch], branch_encoding, dtype=np.float16))
+                elif branch in ['cons', 'signal']:
+                    values.append(seq.parse_scores(dataset.df[branch], dtype=np.float32))
         # Do not return data in an extra array if there's only one branch
         if len(values) == 1:
             values = values[0]
@@ -403,129 +483,34 @@ class Dataset:
 
     @staticmethod
     def map_to_wig(branch, df, ref_folder):
-        not_found_chrs = set()
-        chrom_files = f.list_files_in_dir(ref_folder, 'wig')
-
-        current_file = None
-        zipped = None
-        current_chr = None
-        current_header = {}
-        parsed_line = {}
-        df_copy = df.copy()
-
-        for i, row in df_copy.iterrows():
-            score = []
-
-            if row['chrom_name'] and row['chrom_name'] == current_chr:
-                result = Dataset.map_datapoint_to_wig(
-                    score, zipped, row['seq_start'], row['seq_end'], current_file, current_header, parsed_line)
-                if result:
-                    score, current_header, parsed_line = result
-                else:
-                    # Covering the case when we reach end of reference file while still having some samples with current_chr not mapped
-                    not_found_chrs.add(current_chr)
-                    continue
-            elif row['chrom_name'] in not_found_chrs:
-                continue
-            else:
-                # When reading from new reference file
-                files = list(filter(lambda f: f"{row['chrom_name']}." in os.path.basename(f), chrom_files))
-                if len(files) == 1:
-                    if current_file:
-                        current_file.close()
-                    current_chr = row['chrom_name']
-
-                    current_file, zipped = f.unzip_if_zipped(files[0])
-
-                    line = f.read_decoded_line(current_file, zipped)
-                    # Expecting first line of the file to be a header
-                    if 'chrom' in line:
-                        current_header = seq.parse_wig_header(line)
-                    else:
-                        raise UserInputError('File not starting with a proper wig header.')
-                    result = Dataset.map_datapoint_to_wig(
-                        score, zipped, row['seq_start'], row['seq_end'], current_file, current_header,
-                        parsed_line)
-                    if result:
-                        score, current_header, parsed_line = result
-                    else:  # should not happen here, as it's beginning of the file
-                        not_found_chrs.add(current_chr)
-                        continue
-                else:
-                    not_found_chrs.add(row['chrom_name'])
-                    if len(files) == 0:
-                        # TODO or rather raise an exception to let user fix it?
-                        # Anyway, let the user know if none were found, thus the path given is wrong (currently it looks like it went through)
-                        logger.warning(
-                            f"Didn\'t find appropriate conservation file for {row['chrom_name']}, skipping the chromosome.")
-                    else:  # len(files) > 1
-                        logger.warning(f"Found multiple conservation files for {row['chrom_name']}, skipping the chromosome.")
-                    continue
-
-            if score and len(score) == (row['seq_end'] - row['seq_start']):
-                # Score may be fully or partially missing if the coordinates are not part of the reference
-                str_score = [str(num) for num in score]
-                df.loc[i, branch] = ','.join(str_score)
+        # ref_folder: any track supported by tracks.open_track (folder of wig files, bedGraph or bigWig file)
+        return Dataset.map_to_tracks(branch, df, [ref_folder])
+
+    @staticmethod
+    def map_to_tracks(branch, df, track_paths):
+        # All the tracks mapped in one pass over the chromosomes, the channels (tracks) of a row separated by ';'
+        scores = pd.Series(None, index=df.index, dtype=object)
 
+        opened = [tracks.open_track(path) for path in track_paths]
+        try:
+            groups = dict(list(df.groupby('chrom_name', sort=False)))
+            # In the order of the chromosomes in the (first) track file, so that the files are read forward only
+            for chrom in sorted(groups, key=lambda chrom: [track.offset(chrom) for track in opened]):
+                rows = groups[chrom]
+                channels = [track.values(chrom, rows['seq_start'].values, rows['seq_end'].values) for track in opened]
+                scores[rows.index] = [None if any(score is None for score in row_channels) else
+                                      ';'.join(','.join(str(value) for value in score.tolist()) for score in row_channels)
+                                      for row_channels in zip(*channels)]
+        finally:
+            for track in opened:
+                track.close()
+
+        # Score may be fully or partially missing if the coordinates are not part of the reference
+        df[branch] = scores
         unmapped = df[branch].isna().sum()
-        logger.info(f'Conservation score: mapped {round(((len(df)-unmapped)/len(df)*100), 1)}% of the intervals ({(len(df)-unmapped)} out of {len(df)}).')
+        logger.info(f'{"Conservation score" if branch == "cons" else "Numeric signal"}: mapped {round(((len(df)-unmapped)/len(df)*100), 1)}% of the intervals ({(len(df)-unmapped)} out of {len(df)}).')
         return df
 
-    @staticmethod
-    def map_datapoint_to_wig(score, zipped, dp_start, dp_end, current_file, current_header, parsed_line):
-        # TODO check the logic of passing on the parsed line
-        # FIXME not covered: when the end of ref file is reached while there are still some samples from that file
-        # unmapped - it reads empty lines - break with first empty line read as expecting it to be EOF? and move to
-        # next chromosome somehow
-
-        line = f.read_decoded_line(current_file, zipped)
-        new_score = []
-        if not line: return None
-
-        if 'chrom' in line:
-            current_header = seq.parse_wig_header(line)
-            result = Dataset.map_datapoint_to_wig(score, zipped, dp_start, dp_end, current_file, current_header, parsed_line)
-            if result:
-                new_score, current_header, parsed_line = result
-            else:
-                return None
-        else:
-            if dp_start < current_header['start']:
-                # Missed beginning of the datapoint while reading through the reference (should not happen)
-                pass
-            else:
-                current_header, parsed_line = seq.parse_wig_line(line, current_header)
-                while dp_start not in parsed_line.keys():
-                    line = f.read_decoded_line(current_file, zipped)
-                    if not line: return None
-                    if 'chrom' in line:
-                        current_header = seq.parse_wig_header(line)
-                    else:
-                        current_header, parsed_line = seq.parse_wig_line(line, current_header)
-                    if current_header['start'] > dp_end:
-                        # Did not find datapoint coordinates in reference file, might happen
-                        break
-                else:
-                    for i in range(0, (dp_end - dp_start)):
-                        coord = dp_start + i
-                        if coord in parsed_line.keys():
-                            score.append(parsed_line[coord])
-                        else:
-                            line = f.read_decoded_line(current_file, zipped)
-                            if not line: return None
-                            if 'chrom' in line:
-                                current_header = seq.parse_wig_header(line)
-                                line = f.read_decoded_line(current_file, zipped)
-                                if not line: return None
-                            current_header, parsed_line = seq.parse_wig_line(line, current_header)
-                            try:
-                                score.append(parsed_line[coord])
-                            except:
-                                # Lost the score in the reference in the middle of a datapoint, might happen
-                                break
-
-        return [score + new_score, current_header, parsed_line]
-
     @staticmethod
     def fold_branch(df, key_cols, seq_branch=True, ncpu=1):
         tmp_dir = tempfile.gettempdir()
@@ -0,0 +1,48 @@
+import numpy as np
+import tensorflow as tf
+
+
+class EncodedSequence(tf.keras.utils.Sequence):
+    """Feeds memory-mapped encoded branches (see Dataset.save_encoded) to the model batch by batch.
+
+    Only the current batch is copied into memory, so that the RSS stays roughly constant regardless of the dataset size.
+    Labels are given as class indices and one-hot encoded per batch (unless the model was trained with sparse labels).
+    When shuffled (for training), the samples are reordered after each epoch, each batch still read in the disk order.
+    """
+
+    def __init__(self, values, labels=None, no_klasses=None, batch_size=256, sparse=False, shuffle=False, seed=None):
+        self.values = values if isinstance(values, list) else [values]
+        self.labels = labels
+        self.no_klasses = no_klasses
+        self.batch_size = batch_size
+        self.sparse = sparse
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.order = np.arange(len(self.values[0]))
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return int(np.ceil(len(self.values[0]) / self.batch_size))
+
+    def __getitem__(self, index):
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        if self.shuffle:
+            batch = np.sort(self.order[batch])
+        # Kept in the stored dtype (float16 for the one-hot branches), the model casts the inputs itself
+        x = [np.asarray(value[batch]) for value in self.values]
+        if len(x) == 1:
+            x = x[0]
+        if self.labels is None:
+            return x
+        if self.sparse:
+            return x, np.asarray(self.labels[batch])
+        y = np.eye(self.no_klasses, dtype=np.float32)[self.labels[batch]]
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def inputs_only(self):
+        return EncodedSequence(self.values, batch_size=self.batch_size)
@@ -1,15 +1,58 @@
-import matplotlib.pyplot as plt
+"""Evaluation metrics and plots for 2 and more classes: confusion matrix, precision recall curve and ROC curve.
+
+The curves are computed right away and saved as compact numpy arrays (roc_curves.npz, precision_recall_curves.npz),
+the figures are rendered from them either in a background thread, synchronously, or later on demand:
+    python -m lib.utils.eval_plots /path/to/plots/evaluation_metrics
+Figures are created without pyplot (thus without its global state), and closed once saved.
+"""
+import logging
 import numpy as np
 import os
 import pandas as pd
-import seaborn
-import tensorflow as tf
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from sklearn.metrics import average_precision_score, auc, confusion_matrix, precision_recall_curve, roc_curve
 
+logger = logging.getLogger('root')
 
-# three functions that return evaluation plots for 2 and more classes
-# evaluation confusion matrix, precision recall curve and ROC curve
+DPI = 150
+ROC_FILE = 'roc_curves.npz'
+PR_FILE = 'precision_recall_curves.npz'
+
+# Shared by all the sessions of the application, each run waits only for its own renders (see render)
+renderer = ThreadPoolExecutor(max_workers=1)
+
+
+def new_figure(figsize):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(111)
+
+
+def save_figure(fig, file_path):
+    fig.savefig(file_path, format='png', dpi=DPI)
+    fig.clf()
+
+
+def render(function, *args, mode='background', pending=None):
+    # The future of a background render is added to the pending list of the caller, to be waited for
+    if mode == 'background':
+        future = renderer.submit(function, *args)
+        if pending is not None:
+            pending.append(future)
+    elif mode == 'sync':
+        function(*args)
+
+
+def wait_for_rendering(pending):
+    # Called before the results are reported to the user, so that all the figures of the run exist by then
+    while pending:
+        error = pending.pop(0).exception()
+        if error:
+            logger.warning(f'Could not render an evaluation plot: {error.__class__.__name__}: {error}')
 
 
 def plot_eval_cfm(y_true, y_pred, labels_dict, output_dir_path):
@@ -17,7 +60,8 @@ def plot_eval_cfm(y_true, y_pred, labels_dict, output_dir_path):
     klass_names = list(labels_dict.keys())
     model_cfm = confusion_matrix(y_true, y_pred, labels=list(labels_dict.values()))
 
-    figsize = (36, 30)
+    # Scaled by the number of classes, with room for the labels
+    figsize = (max(6, 1.5 * len(klass_names) + 3), max(5, 1.2 * len(klass_names) + 3))
 
     cfm_sum = np.sum(model_cfm, axis=1, keepdims=True)
     cfm_perc = model_cfm / cfm_sum.astype(float) * 100
@@ -34,48 +78,46 @@ def plot_eval_cfm(y_true, y_pred, labels_dict, output_dir_path):
                 annot[i, j] = ''
             else:
                 annot[i, j] = '%.1f%%\n%d' % (p, c)
-                
+
+    import seaborn
     cfm = pd.DataFrame(model_cfm)
     cfm.index.name = 'True'
     cfm.columns.name = 'Predicted'
-    fig, ax = plt.subplots(figsize=figsize)
-    seaborn.heatmap(cfm, cmap='Reds', annot=annot, fmt='', ax=ax, annot_kws={"fontsize": 14})
-    ax.set_xlabel('Highest scoring predicted class', fontsize=20)
-    ax.xaxis.set_label_position('top') 
-    ax.set_xticklabels(klass_names, fontsize=18)
+    fig, ax = new_figure(figsize)
+    seaborn.heatmap(cfm, cmap='Reds', annot=annot, fmt='', ax=ax, annot_kws={"fontsize": 10})
+    ax.set_xlabel('Highest scoring predicted class', fontsize=14)
+    ax.xaxis.set_label_position('top')
+    ax.set_xticklabels(klass_names, fontsize=12)
     ax.xaxis.tick_top()
-    ax.set_ylabel('True class', fontsize=20)
-    ax.set_yticklabels(klass_names, fontsize=18)
-    
-    plt.savefig(file_path, format='png', dpi=300)
-    plt.clf()
-    
-                                            
-def plot_multiclass_prec_recall_curve(y_test, y_pred, labels_dict, output_dir_path):
-    # y_pred = np.around(y_pred)
-    file_path = os.path.join(output_dir_path, 'precision_recall')
-    precision = dict()
-    recall = dict()
-    average_precision = dict()
-    klass_labels = list(labels_dict.keys())
-    n_classes = len(klass_labels)
+    ax.set_ylabel('True class', fontsize=14)
+    ax.set_yticklabels(klass_names, fontsize=12)
+
+    save_figure(fig, file_path)
 
-    for i in range(n_classes):
-        precision[i], recall[i], _ = precision_recall_curve(y_test[:, i], y_pred[:, i])
-        average_precision[i] = average_precision_score(y_test[:, i], y_pred[:, i])
-        to_export = {'precision': precision[i], 'recall': recall[i]}
-        pr_rec_df = pd.DataFrame.from_dict(to_export)
-        pr_rec_df.to_csv(os.path.join(output_dir_path, f'precision_recall_{klass_labels[i]}.tsv'), sep='\t', index=False)
+
+def prec_recall_curves(y_test, y_pred, klass_labels):
+    curves = {'klasses': np.array(klass_labels)}
+    average_precision = []
+    for i in range(len(klass_labels)):
+        curves[f'precision_{i}'], curves[f'recall_{i}'], _ = precision_recall_curve(y_test[:, i], y_pred[:, i])
+        average_precision.append(average_precision_score(y_test[:, i], y_pred[:, i]))
+    curves['average_precision'] = np.array(average_precision)
 
     # A "micro-average": quantifying score on all classes jointly
-    precision["micro"], recall["micro"], _ = precision_recall_curve(y_test.ravel(), y_pred.ravel())
-    average_precision["micro"] = average_precision_score(y_test, y_pred, average="micro")
+    curves['precision_micro'], curves['recall_micro'], _ = precision_recall_curve(y_test.ravel(), y_pred.ravel())
+    curves['average_precision_micro'] = average_precision_score(y_test, y_pred, average="micro")
 
     # A macro-average # TODO
     # precision["macro"], recall["macro"], _ = precision_recall_curve(y_test.ravel(), y_score.ravel())
     # average_precision["macro"] = average_precision_score(y_test, y_score, average="macro")
+    return curves
+
 
-    plt.figure(figsize=(12, 12))
+def render_prec_recall_curve(curves_file, file_path):
+    with np.load(curves_file) as data:
+        curves = dict(data)
+    klass_labels = list(curves['klasses'])
+    fig, ax = new_figure((12, 12))
 
     f_scores = np.linspace(0.2, 0.8, num=4)
     lines = []
@@ -84,100 +126,114 @@ def plot_multiclass_prec_recall_curve(y_test, y_pred, labels_dict, output_dir_pa
         f_score = round(f_score, 1)  # for some reason 0.6 was showing as 0.6000000000001
         x = np.linspace(0.01, 1)
         y = f_score * x / (2 * x - f_score)
-        l,  = plt.plot(x[y >= 0], y[y >= 0], color='gray', alpha=0.2)
-        plt.annotate(f'f1 = {f_score}', xy=(0.9, y[45] + 0.02))
+        l,  = ax.plot(x[y >= 0], y[y >= 0], color='gray', alpha=0.2)
+        ax.annotate(f'f1 = {f_score}', xy=(0.9, y[45] + 0.02))
 
     lines.append(l)
     labels.append('iso-f1 curves')
 
-    l, = plt.plot(recall["micro"], precision["micro"], color='gold', lw=3)
+    l, = ax.plot(curves['recall_micro'], curves['precision_micro'], color='gold', lw=3)
     lines.append(l)
-    labels.append(f'Micro-average precision-recall (AP = {round(average_precision["micro"], 4)})')
+    labels.append(f'Micro-average precision-recall (AP = {round(float(curves["average_precision_micro"]), 4)})')
 
-    # l, = plt.plot(recall["macro"], precision["macro"], color='gold', lw=3)
-    # lines.append(l)
-    # labels.append(f'Macro-average precision-recall (auc = {average_precision["macro"]})')
-
-    avg_precisions = {}
-    for i in range(n_classes):
-        l, = plt.plot(recall[i], precision[i], lw=2)
+    for i, klass in enumerate(klass_labels):
+        l, = ax.plot(curves[f'recall_{i}'], curves[f'precision_{i}'], lw=2)
         lines.append(l)
-        labels.append(f'Precision-recall for {klass_labels[i]} (AP = {round(average_precision[i], 4)})')
-        avg_precisions.update({klass_labels[i]: round(average_precision[i], 4)})
-
-    plt.xlim([-0.05, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('Recall', fontsize=14)
-    plt.ylabel('Precision', fontsize=14)
-    plt.title('Precision-Recall curve', fontsize=16)
-    plt.legend(lines, labels, loc='lower left', prop=dict(size=14))
-    plt.savefig(file_path, format='png', dpi=300)
-    plt.clf()
-
-    return avg_precisions
-
-
-def plot_multiclass_roc_curve(test_y, y_pred, labels_dict, output_dir_path):
-    # Compute ROC curve and ROC area for each class
-    # y_pred = np.around(y_pred)
-    file_path = os.path.join(output_dir_path, 'roc')
-    fpr = dict()
-    tpr = dict()
-    roc_auc = dict()
-    roc_auc2 = dict()
-    # keras_auc = tf.keras.metrics.AUC(num_thresholds=200, curve='ROC')
+        labels.append(f'Precision-recall for {klass} (AP = {round(curves["average_precision"][i], 4)})')
+
+    ax.set_xlim([-0.05, 1.0])
+    ax.set_ylim([0.0, 1.05])
+    ax.set_xlabel('Recall', fontsize=14)
+    ax.set_ylabel('Precision', fontsize=14)
+    ax.set_title('Precision-Recall curve', fontsize=16)
+    ax.legend(lines, labels, loc='lower left', prop=dict(size=14))
+    save_figure(fig, file_path)
+
+
+def plot_multiclass_prec_recall_curve(y_test, y_pred, labels_dict, output_dir_path, render_mode='background', pending=None):
     klass_labels = list(labels_dict.keys())
-    n_classes = len(klass_labels)
+    curves = prec_recall_curves(y_test, y_pred, klass_labels)
+    curves_file = os.path.join(output_dir_path, PR_FILE)
+    np.savez_compressed(curves_file, **curves)
+    render(render_prec_recall_curve, curves_file, os.path.join(output_dir_path, 'precision_recall'), mode=render_mode,
+           pending=pending)
+
+    return {klass: round(float(curves['average_precision'][i]), 4) for i, klass in enumerate(klass_labels)}
 
+
+def roc_curves(test_y, y_pred, klass_labels):
+    n_classes = len(klass_labels)
+    curves = {'klasses': np.array(klass_labels)}
+    roc_auc = []
     for i in range(n_classes):
-        fpr[i], tpr[i], _ = roc_curve(test_y[:, i], y_pred[:, i])
-        roc_auc[i] = auc(fpr[i], tpr[i])
-        # keras_auc.update_state(test_y[:, i], y_pred[:, i])
-        # roc_auc2[i] = keras_auc.result().numpy()
-        to_export = {'fpr': fpr[i], 'tpr': tpr[i]}
-        pr_rec_df = pd.DataFrame.from_dict(to_export)
-        pr_rec_df.to_csv(os.path.join(output_dir_path, f'fpr_tpr_{klass_labels[i]}.tsv'), sep='\t', index=False)
+        curves[f'fpr_{i}'], curves[f'tpr_{i}'], _ = roc_curve(test_y[:, i], y_pred[:, i])
+        roc_auc.append(auc(curves[f'fpr_{i}'], curves[f'tpr_{i}']))
+    curves['auc'] = np.array(roc_auc)
 
     # Compute micro-average ROC curve and ROC area
-    fpr["micro"], tpr["micro"], _ = roc_curve(test_y.ravel(), y_pred.ravel())
-    roc_auc["micro"] = auc(fpr["micro"], tpr["micro"])
+    curves['fpr_micro'], curves['tpr_micro'], _ = roc_curve(test_y.ravel(), y_pred.ravel())
+    curves['auc_micro'] = auc(curves['fpr_micro'], curves['tpr_micro'])
 
     # Compute macro-average ROC and ROC curve
     # First aggregate all false positive rates
-    all_fpr = np.unique(np.concatenate([fpr[i] for i in range(n_classes)]))
+    all_fpr = np.unique(np.concatenate([curves[f'fpr_{i}'] for i in range(n_classes)]))
 
     # Then interpolate all ROC curves at this points
     mean_tpr = np.zeros_like(all_fpr)
     for i in range(n_classes):
-        mean_tpr += np.interp(all_fpr, fpr[i], tpr[i])
+        mean_tpr += np.interp(all_fpr, curves[f'fpr_{i}'], curves[f'tpr_{i}'])
 
     # Finally average it and compute AUC
     mean_tpr /= n_classes
 
-    fpr["macro"] = all_fpr
-    tpr["macro"] = mean_tpr
-    roc_auc["macro"] = auc(fpr["macro"], tpr["macro"])
+    curves['fpr_macro'] = all_fpr
+    curves['tpr_macro'] = mean_tpr
+    curves['auc_macro'] = auc(all_fpr, mean_tpr)
+    return curves
 
-    # Plot all ROC curves
-    plt.figure(figsize=(12, 12))
-    plt.plot(fpr["micro"], tpr["micro"], label=f'Micro-average ROC curve (auc = {round(roc_auc["micro"], 4)})', linestyle=':')
-    plt.plot(fpr["macro"], tpr["macro"], label=f'Macro-average ROC curve (auc = {round(roc_auc["macro"], 4)})', linestyle=':')
 
-    aucs = {}
-    for i in range(n_classes):
-        plt.plot(fpr[i], tpr[i], lw=3, label=f'ROC curve of {klass_labels[i]} (auc = {round(roc_auc[i], 4)})')
-                                             # f', keras auc = {round(roc_auc2[i], 4)})')
-        aucs.update({klass_labels[i]: round(roc_auc[i], 4)})
-        # aucs.update({f'{klass_labels[i]} KERAS': round(roc_auc2[i], 4)})
-
-    plt.plot([0, 1], [0, 1], 'k--', lw=3, alpha=0.2)
-    plt.xlim([-0.05, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('False Positive Rate (1-specifity)', fontsize=14)
-    plt.ylabel('True Positive Rate (sensitivity)', fontsize=14)
-    plt.title('Multiclass Receiver operating characteristic', fontsize=16)
-    plt.legend(loc="lower right", prop=dict(size=14))
-    plt.savefig(file_path, format='png', dpi=300)
-    plt.clf()
-
-    return aucs
+def render_roc_curve(curves_file, file_path):
+    with np.load(curves_file) as data:
+        curves = dict(data)
+    klass_labels = list(curves['klasses'])
+    fig, ax = new_figure((12, 12))
+
+    ax.plot(curves['fpr_micro'], curves['tpr_micro'], linestyle=':',
+            label=f'Micro-average ROC curve (auc = {round(float(curves["auc_micro"]), 4)})')
+    ax.plot(curves['fpr_macro'], curves['tpr_macro'], linestyle=':',
+            label=f'Macro-average ROC curve (auc = {round(float(curves["auc_macro"]), 4)})')
+    for i, klass in enumerate(klass_labels):
+        ax.plot(curves[f'fpr_{i}'], curves[f'tpr_{i}'], lw=3, label=f'ROC curve of {klass} (auc = {round(curves["auc"][i], 4)})')
+
+    ax.plot([0, 1], [0, 1], 'k--', lw=3, alpha=0.2)
+    ax.set_xlim([-0.05, 1.0])
+    ax.set_ylim([0.0, 1.05])
+    ax.set_xlabel('False Positive Rate (1-specifity)', fontsize=14)
+    ax.set_ylabel('True Positive Rate (sensitivity)', fontsize=14)
+    ax.set_title('Multiclass Receiver operating characteristic', fontsize=16)
+    ax.legend(loc="lower right", prop=dict(size=14))
+    save_figure(fig, file_path)
+
+
+def plot_multiclass_roc_curve(test_y, y_pred, labels_dict, output_dir_path, render_mode='background', pending=None):
+    klass_labels = list(labels_dict.keys())
+    curves = roc_curves(test_y, y_pred, klass_labels)
+    curves_file = os.path.join(output_dir_path, ROC_FILE)
+    np.savez_compressed(curves_file, **curves)
+    render(render_roc_curve, curves_file, os.path.join(output_dir_path, 'roc'), mode=render_mode,
+           pending=pending)
+
+    return {klass: round(float(curves['auc'][i]), 4) for i, klass in enumerate(klass_labels)}
+
+
+def render_dir(plot_dir):
+    # On demand rendering of the plots from the saved curves
+    for curves_file, function, name in [(ROC_FILE, render_roc_curve, 'roc'),
+                                        (PR_FILE, render_prec_recall_curve, 'precision_recall')]:
+        if os.path.isfile(os.path.join(plot_dir, curves_file)):
+            function(os.path.join(plot_dir, curves_file), os.path.join(plot_dir, name))
+
+
+if __name__ == '__main__':
+    for directory in sys.argv[1:]:
+        render_dir(directory)
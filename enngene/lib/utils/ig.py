@@ -1,11 +1,11 @@
 #@title Licensed under the Apache License, Version 2.0
 #https://www.apache.org/licenses/LICENSE-2.0
 
+import inspect
 from os import path
 from numpy.lib.function_base import diff
 import tensorflow as tf
 import numpy as np
-import matplotlib as mpl
 import matplotlib.cm as cm
 
 import logging
@@ -48,16 +48,19 @@ def compute_gradients(model, path_inputs, target_class=0):
     :param path_inputs: interpolated tensors, shape: (alphas_len, win, width)
     :return: shape: (alphas_len, win, width)
     """
+    _, gradients = _path_gradients(model, path_inputs, tf.constant(target_class))
+    return gradients
+
+
+@tf.function(experimental_relax_shapes=True)
+def _path_gradients(model, path_inputs, target_class):
+    # Compiled once per model (and input shapes), the target class is a tensor not to retrace per class
     with tf.GradientTape() as tape:
         tape.watch(path_inputs)
         predictions = model(path_inputs)
-        outputs = tf.convert_to_tensor(
-            [envelope[target_class] for envelope in predictions], 
-            dtype=tf.float32
-        )
+        outputs = predictions[:, target_class]
 
-    gradients = tape.gradient(outputs, path_inputs)
-    return gradients
+    return outputs, tape.gradient(outputs, path_inputs)
 
 
 def generate_alphas(m_steps=50, method='riemann_trapezoidal'):
@@ -186,20 +189,101 @@ def integrated_gradients(model, baselines, inputs, target_class,
 
 def smoothgrad(model, baselines, inputs, target_class,
                          m_steps=50, method='riemann_trapezoidal', batch_size=50, 
-                         stddev=0.15, smoothing_repetitions=20):
-    
-    results = []
-    input_maxes = [np.max(_input) for _input in inputs]
-    input_mins = [np.min(_input) for _input in inputs]
-    gauss_bases = [max_ - min_ for max_, min_ in zip(input_maxes, input_mins)]    
-    
-    for _ in range(smoothing_repetitions):
-        stddev_list = [np.random.normal(scale=stddev*(gauss_base), size=input_.shape) for input_, gauss_base in zip(inputs, gauss_bases)]
-        inputs_plus_stddev = [sum(x) for x in zip(inputs, stddev_list)]
-        results.append(integrated_gradients(model, baselines, inputs_plus_stddev, target_class, m_steps, method, batch_size))
-        
-    
-    return [sum(i) / smoothing_repetitions for i in zip(*results)]
+                         stddev=0.15, smoothing_repetitions=20, seed=(42, 0), max_batch=1024):
+    """
+    Integrated gradients of the inputs with a gaussian noise added, averaged over the repetitions.
+
+    The noise repetitions are folded into the batch dimension together with the interpolation steps, thus the
+    gradients of up to max_batch path inputs are computed in a single pass (instead of one IG per repetition).
+    The noise is drawn by the stateless TF RNG from the given seed (e.g. (seed, sample index)), the attributions
+    are thus reproducible. The batch_size is kept for compatibility with integrated_gradients.
+    """
+    alphas = generate_alphas(m_steps=m_steps, method=method)
+    no_alphas = int(alphas.shape[0])
+    inputs = [tf.convert_to_tensor(input_, dtype=tf.float32) for input_ in inputs]
+    baselines = [tf.cast(baseline, tf.float32) for baseline in baselines]
+
+    noisy_inputs = []
+    for i, input_ in enumerate(inputs):
+        scale = stddev * (tf.reduce_max(input_) - tf.reduce_min(input_))
+        noise = tf.random.stateless_normal((smoothing_repetitions,) + tuple(input_.shape), seed=[seed[0] + i, seed[1]])
+        noisy_inputs.append(input_[tf.newaxis] + scale * noise)
+
+    repetitions_per_pass = max(1, max_batch // no_alphas)
+    totals = [tf.zeros_like(input_) for input_ in inputs]
+    for start in range(0, smoothing_repetitions, repetitions_per_pass):
+        repetitions = [noisy[start:(start + repetitions_per_pass)] for noisy in noisy_inputs]
+        size = int(repetitions[0].shape[0])
+
+        # Paths of all the repetitions (size, alphas, win, width) folded into a single batch (size * alphas, win, width)
+        path_inputs = [tf.reshape(baseline + alphas[tf.newaxis, :, tf.newaxis, tf.newaxis] * (noisy[:, tf.newaxis] - baseline),
+                                  (size * no_alphas,) + tuple(noisy.shape[1:]))
+                       for baseline, noisy in zip(baselines, repetitions)]
+        _, gradients = _path_gradients(model, path_inputs, tf.constant(target_class))
+
+        for i, (gradient, noisy, baseline) in enumerate(zip(gradients, repetitions, baselines)):
+            # Integral approximation over the alphas (moved to the first axis), per repetition
+            gradient = tf.transpose(tf.reshape(gradient, (size, no_alphas) + tuple(noisy.shape[1:])), perm=[1, 0, 2, 3])
+            avg_gradients = integral_approximation(gradients=gradient, method=method)
+            totals[i] += tf.reduce_sum((noisy - baseline) * avg_gradients, axis=0)
+
+    return [total / smoothing_repetitions for total in totals]
+
+
+def adaptive_integrated_gradients(model, baselines, inputs, target_class,
+                                  start_steps=16, max_steps=256, tolerance=0.01, batch_size=128):
+    """
+    Integrated gradients (trapezoidal rule) with the number of steps chosen per sample by the completeness check.
+
+    Starting from start_steps, the steps are doubled until the sum of the attributions matches
+    f(input) - f(baseline) within the tolerance (absolute, in the units of the predicted score), or max_steps is reached.
+    The gradients of the previous steps are reused, each refinement computes only the new midpoints.
+
+    Returns the attributions (as integrated_gradients), the number of steps used and the final residual.
+    """
+    inputs = [tf.convert_to_tensor(input_, dtype=tf.float32) for input_ in inputs]
+    baselines = [tf.cast(baseline, tf.float32) for baseline in baselines]
+
+    def path_gradients(alphas):
+        outputs = []
+        gradients = [[] for _ in inputs]
+        for start in range(0, len(alphas), batch_size):
+            alpha_batch = tf.constant(alphas[start:(start + batch_size)], dtype=tf.float32)
+            path_inputs = generate_path_inputs(baselines, inputs, alpha_batch[:, tf.newaxis, tf.newaxis])
+            batch_outputs, batch_gradients = _path_gradients(model, path_inputs, tf.constant(target_class))
+            outputs.append(batch_outputs)
+            for branch, batch_gradient in zip(gradients, batch_gradients):
+                branch.append(batch_gradient)
+        return tf.concat(outputs, axis=0), [tf.concat(branch, axis=0) for branch in gradients]
+
+    steps = start_steps
+    outputs, gradients = path_gradients(np.linspace(0.0, 1.0, steps + 1))
+    # The path starts at the baseline and ends at the input
+    difference = float(outputs[-1] - outputs[0])
+
+    while True:
+        avg_gradients = [integral_approximation(gradients=gradient, method='riemann_trapezoidal') for gradient in gradients]
+        attributions = [(input_ - baseline) * avg_gradient
+                        for input_, baseline, avg_gradient in zip(inputs, baselines, avg_gradients)]
+        residual = abs(float(sum(tf.reduce_sum(attribution) for attribution in attributions)) - difference)
+        if residual <= tolerance or steps * 2 > max_steps:
+            break
+
+        _, mid_gradients = path_gradients((np.arange(steps) + 0.5) / steps)
+        # Interleave the midpoints with the already computed points: (steps + 1) -> (2 * steps + 1)
+        gradients = [tf.concat([tf.reshape(tf.stack([gradient[:-1], mid], axis=1), (2 * steps,) + tuple(mid.shape[1:])),
+                                gradient[-1:]], axis=0)
+                     for gradient, mid in zip(gradients, mid_gradients)]
+        steps *= 2
+
+    return attributions, steps, residual
+
+
+def default_parameters(function):
+    # Keyword parameters of the attribution method with their default values, as applied by the application
+    return {name: parameter.default for name, parameter in inspect.signature(function).parameters.items()
+            if parameter.default is not inspect.Parameter.empty}
+
 
 def _absmax(a, axis=1):
     amax = np.max(a, axis)
@@ -217,29 +301,44 @@ def choose_validation_points(integrated_gradients_list):
     return [_absmax(x) for x in integrated_gradients_list]
 
 
-def visualize_token_attrs(sequence, attrs, _min, _max, cmap=cm.coolwarm):
+TOKEN_HTML = "<span style='font-weight:bold;background-color:rgb(%d,%d,%d)'>%s </span>"
+
+
+def attribution_colors(attrs, mins, maxs, cmap=cm.coolwarm):
+    """
+    Colors of the attributions of all the given rows, by a single colormap lookup.
+
+    Args:
+    - attrs: 2D array of attributions (rows, positions)
+    - mins, maxs: arrays of the bounds of each row the colormap is normalized to
+
+    Returns:
+    - array of rgb values (rows, positions, 3) within 0-255
+    """
+    attrs = np.asarray(attrs, dtype=np.float64)
+    mins = np.asarray(mins, dtype=np.float64)[:, np.newaxis]
+    ranges = (np.asarray(maxs, dtype=np.float64)[:, np.newaxis] - mins)
+    # A constant row maps to the lowest color, as with matplotlib Normalize
+    normalized = np.divide(attrs - mins, ranges, out=np.zeros_like(attrs), where=ranges > 0)
+    return (cmap(normalized)[..., :3] * 255).astype(np.uint8)
+
+
+def visualize_token_attrs(sequence, colors):
     """
     Visualize attributions for given set of tokens.
     Args:
-    - tokens: An array of tokens
-    - attrs: An array of attributions, of same size as 'tokens',
-      with attrs[i] being the attribution to tokens[i]
+    - sequence: An array of tokens
+    - colors: An array of rgb colors (see attribution_colors), of same size as 'sequence',
+      with colors[i] being the color of the attribution to sequence[i]
 
     Returns:
-    - visualization: HTML text with colorful representation of DNA sequence
+    - visualization: list of HTML spans with colorful representation of DNA sequence
         build on model prediction
     """
-    norm = mpl.colors.Normalize(vmin=_min, vmax=_max)
-    m = cm.ScalarMappable(norm=norm, cmap=cmap)
-    
-    html_text = []
-    
-    for i, tok in enumerate(sequence):
-        r, g, b, _ = m.to_rgba(attrs[i]) # ignore alpha
-        r, g, b = 255*r, 255*g, 255*b # rescale
-        html_text.append("<span style='font-weight:bold;background-color:rgb(%d,%d,%d)'>%s </span>" % (r, g, b, tok))
+    return [TOKEN_HTML % (r, g, b, tok) for tok, (r, g, b) in zip(sequence, colors.tolist())]
 
 
-    html_text.append("</div><br>")
-    
-    return html_text
\ No newline at end of file
+def attributions_to_strings(attrs, precision=4):
+    # Compact export of the attributions (rows, positions) as comma separated numbers
+    formatted = np.char.mod(f'%.{precision}g', np.asarray(attrs))
+    return [','.join(row) for row in formatted]
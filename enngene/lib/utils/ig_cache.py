@@ -0,0 +1,101 @@
+"""Persistent cache of the integrated gradients attributions, stored in a single sqlite file.
+
+An entry is keyed by the cache version, the hash of the model file, the branches, the target class, the IG method
+with all its parameters and the input itself, thus it is reused only by the very same computation. The least recently
+used entries are evicted once the stored attributions exceed the size limit.
+"""
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+logger = logging.getLogger('root')
+
+CACHE_FILE = 'ig_cache.sqlite'
+# To be raised whenever the attributions computed by the same method and parameters change (e.g. the noise seeding)
+CACHE_VERSION = 1
+
+
+def file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def pack(arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, *arrays)
+    return buffer.getvalue()
+
+
+def unpack(blob):
+    with np.load(io.BytesIO(blob)) as data:
+        return [data[f'arr_{i}'] for i in range(len(data.files))]
+
+
+class AttributionCache:
+
+    def __init__(self, path, model_file, branches, method, max_mb=1024):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        # Everything but the target class and the input, shared by all the entries of the run
+        self.prefix = '|'.join([f'v{CACHE_VERSION}', file_hash(model_file), ','.join(branches),
+                                ','.join(f'{key}={value}' for key, value in sorted(method.items()))])
+        self.hits = 0
+        self.misses = 0
+        self.used = []
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS attributions '
+                                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS attributions_used ON attributions (used)')
+
+    def key(self, inputs, target_class):
+        sha = hashlib.sha256(f'{self.prefix}|{target_class}'.encode('utf-8'))
+        for input_ in inputs:
+            input_ = np.ascontiguousarray(input_, dtype=np.float32)
+            sha.update(str(input_.shape).encode('utf-8'))
+            sha.update(input_.tobytes())
+        return sha.hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute('SELECT value FROM attributions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append(key)
+        return unpack(row[0])
+
+    def put(self, key, arrays):
+        value = pack(arrays)
+        self.connection.execute('INSERT OR REPLACE INTO attributions (key, value, size, used) VALUES (?, ?, ?, ?)',
+                                (key, value, len(value), time.time()))
+
+    def close(self):
+        now = time.time()
+        self.connection.executemany('UPDATE attributions SET used = ? WHERE key = ?', [(now, key) for key in self.used])
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+        logger.info(f'IG cache {self.path}: {self.hits} attributions reused, {self.misses} computed.')
+
+    def evict(self):
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM attributions').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.connection.execute('SELECT key, size FROM attributions ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute('DELETE FROM attributions WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        logger.info(f'Evicted {evicted} least recently used attributions from the IG cache.')
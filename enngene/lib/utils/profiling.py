@@ -0,0 +1,105 @@
+import logging
+import sys
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger('root')
+
+
+def peak_rss_mb():
+    # High-water mark of the resident memory of the whole process (not resettable per span)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS, in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Span:
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.wall = None
+        self.cpu = None
+        self.peak_rss = None
+
+    @property
+    def throughput(self):
+        if not self.rows or not self.wall:
+            return None
+        return self.rows / self.wall
+
+    def to_dict(self):
+        return {'name': self.name,
+                'wall_s': self.wall,
+                'cpu_s': self.cpu,
+                'peak_rss_mb': self.peak_rss,
+                'rows': self.rows,
+                'rows_per_s': self.throughput}
+
+    def __str__(self):
+        text = f'{self.name}: {self.wall:.2f} s wall, {self.cpu:.2f} s CPU'
+        if self.peak_rss is not None:
+            text += f', peak RSS {self.peak_rss:.0f} MB'
+        if self.throughput is not None:
+            text += f', {self.rows} rows ({self.throughput:.1f} rows/s)'
+        return text
+
+
+class Profiler:
+    """Collects wall time, CPU time, peak RSS and row throughput of named stages of a task.
+
+    Usage:
+        with profiler.span('map_to_fasta', rows=len(df)) as span:
+            ...
+            span.rows = len(mapped_df)  # the row count may be also set (or corrected) inside the block
+    """
+
+    def __init__(self, log=None):
+        self.spans = []
+        self.log = log or logger
+
+    @contextmanager
+    def span(self, name, rows=None):
+        span = Span(name, rows)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield span
+        finally:
+            span.wall = time.perf_counter() - wall_start
+            span.cpu = time.process_time() - cpu_start
+            span.peak_rss = peak_rss_mb()
+            self.spans.append(span)
+            self.log.info(f'Stage {span}')
+
+    def to_dicts(self):
+        return [span.to_dict() for span in self.spans]
+
+    @staticmethod
+    def header():
+        return 'Stage wall time [s]\t' \
+               'Stage CPU time [s]\t' \
+               'Peak RSS [MB]\t' \
+               'Stage throughput [rows/s]\t'
+
+    def row(self):
+        def cell(attr, precision):
+            values = []
+            for span in self.spans:
+                value = getattr(span, attr)
+                if value is not None:
+                    values.append(f'{span.name}: {round(value, precision)}')
+            return ', '.join(values) if values else '-'
+
+        return f"{cell('wall', 2)}\t" \
+               f"{cell('cpu', 2)}\t" \
+               f"{cell('peak_rss', 0)}\t" \
+               f"{cell('throughput', 1)}\t"
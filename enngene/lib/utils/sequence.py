@@ -1,7 +1,12 @@
+import gzip
+import hashlib
 import numpy as np
+import os
 import streamlit as st
 import _io
 
+from itertools import groupby
+
 from . import file_utils as f
 from .exceptions import UserInputError
 
@@ -80,24 +85,224 @@ def parse_wig_header(line):
     return header
 
 
-def parse_wig_line(line, header):
-    parsed_line = {}
-    if header['file_type'] == 'variableStep':
-        parts = line.split()
-        start = int(parts[0]) - 1
-        value = float(parts[1])
-        for i in range(header['span']):
-            coord = start + i
-            parsed_line.update({coord: value})
-        header['start'] = start + header['span']
-    elif header['file_type'] == 'fixedStep':
-        value = float(line)
-        for i in range(header['span']):
-            coord = header['start'] + i
-            parsed_line.update({coord: value})
-        header['start'] += header['step']
+def open_text(path, mode='r'):
+    # Plain or gzipped text file ('r' or 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt' if mode == 'r' else mode)
+    return open(path, mode)
+
+
+def wig_section_blocks(header, lines, dtype=np.float64):
+    # Per base values of the lines of one wig section: [(0-based start, values)]
+    if header['file_type'] == 'fixedStep':
+        values = np.array(lines, dtype=dtype)
+        span = header['span']
+        step = header.get('step', 1)
+        start = header['start']
+        # The following lines of the same section continue after this chunk
+        header['start'] += len(values) * step
+        if step == span == 1:
+            return [(start, values)]
+        elif step >= span:
+            # Gaps between the spans (if any) are left as nan
+            dense = np.full((len(values), step), np.nan, dtype=dtype)
+            dense[:, :span] = values[:, np.newaxis]
+            return [(start, dense.ravel()[:((len(values) - 1) * step + span)])]
+        else:
+            # Overlapping spans, the later value applies
+            return [(start, np.concatenate([np.repeat(values, step), np.repeat(values[-1:], span - step)]))]
+    else:
+        # lines of str or bytes
+        data = np.array(lines[0][:0].join(lines).split(), dtype=dtype).reshape((-1, 2))
+        positions = data[:, 0].astype(np.int64) - 1
+        span = header['span']
+        # Split to the runs of adjacent positions
+        runs = np.split(np.arange(len(positions)), np.flatnonzero(np.diff(positions) != span) + 1)
+        return [(positions[run[0]], np.repeat(data[run, 1], span)) for run in runs]
+
+
+def wig_blocks(wig_file, chunk_lines=1000000, dtype=np.float64):
+    """
+    Yields (chrom, start, values) blocks of the wig file: 0-based start and a numpy array of the per base values.
+
+    Each fixedStep or variableStep section is converted to floats at once (in parts of up to chunk_lines lines),
+    the values are expanded by the span of the section. Adjacent positions of a variableStep section form a block,
+    gaps of a fixedStep section with the step larger than the span are filled by nan.
+    """
+    header = None
+    lines = []
+    with open_text(wig_file) as file:
+        for line in file:
+            if line.startswith(('fixedStep', 'variableStep')):
+                if lines:
+                    for start, values in wig_section_blocks(header, lines, dtype):
+                        yield header['chrom'], start, values
+                    lines = []
+                header = parse_wig_header(line)
+            elif line.startswith(('track', 'browser', '#')) or not line.strip():
+                continue
+            elif header is None:
+                raise UserInputError(f'File {wig_file} not starting with a proper wig header.')
+            else:
+                lines.append(line)
+                if len(lines) >= chunk_lines:
+                    for start, values in wig_section_blocks(header, lines, dtype):
+                        yield header['chrom'], start, values
+                    lines = []
+    if lines:
+        for start, values in wig_section_blocks(header, lines, dtype):
+            yield header['chrom'], start, values
+
+
+def wig_chromosomes(wig_file, chunk_lines=1000000, dtype=np.float64):
+    # Yields (chrom, iterator over the (start, values) blocks of the chromosome), as in itertools.groupby
+    blocks = wig_blocks(wig_file, chunk_lines, dtype)
+    for chrom, chrom_blocks in groupby(blocks, key=lambda block: block[0]):
+        yield chrom, ((start, values) for _, start, values in chrom_blocks)
+
+
+# Columns of the wig index entries
+WIG_INDEX = ['start', 'end', 'offset', 'lines', 'span', 'step']
+TRACK_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'enngene', 'track_index')
+
+
+def index_wig(wig_file, chunk_lines=1000000):
+    """
+    Coverage index of the wig file: {chrom: (entries, 6) array of the WIG_INDEX columns}, entries sorted by start.
+
+    An entry is a block of adjacent positions [start, end), with the byte offset of its first data line in the
+    (uncompressed) file and the number of its lines; step is 0 for the variableStep sections.
+    """
+    index = {}
+
+    def add_entries(header, lines, offsets):
+        if header['file_type'] == 'fixedStep':
+            start, span, step = header['start'], header['span'], header.get('step', 1)
+            header['start'] += len(lines) * step
+            entries = [(start, start + (len(lines) - 1) * step + span, offsets[0], len(lines), span, step)]
+        else:
+            positions = np.array([line.split(None, 1)[0] for line in lines], dtype=np.int64) - 1
+            runs = np.split(np.arange(len(positions)), np.flatnonzero(np.diff(positions) != header['span']) + 1)
+            entries = [(positions[run[0]], positions[run[-1]] + header['span'], offsets[run[0]], len(run), header['span'], 0)
+                       for run in runs]
+        index.setdefault(header['chrom'], []).extend(entries)
+
+    header = None
+    lines = []
+    offsets = []
+    offset = 0
+    with open_text(wig_file, 'rb') as file:
+        for line in file:
+            if line.startswith((b'fixedStep', b'variableStep')):
+                if lines:
+                    add_entries(header, lines, offsets)
+                    lines, offsets = [], []
+                header = parse_wig_header(line.decode('utf-8'))
+            elif line.startswith((b'track', b'browser', b'#')) or not line.strip():
+                pass
+            elif header is None:
+                raise UserInputError(f'File {wig_file} not starting with a proper wig header.')
+            else:
+                lines.append(line)
+                offsets.append(offset)
+                if len(lines) >= chunk_lines:
+                    add_entries(header, lines, offsets)
+                    lines, offsets = [], []
+            offset += len(line)
+    if lines:
+        add_entries(header, lines, offsets)
+
+    index = {chrom: np.array(entries, dtype=np.int64).reshape((-1, len(WIG_INDEX))) for chrom, entries in index.items()}
+    return {chrom: entries[np.argsort(entries[:, 0], kind='mergesort')] for chrom, entries in index.items()}
+
+
+def load_wig_index(wig_file):
+    return cached_index(wig_file, index_wig)
 
-    return [header, parsed_line]
+
+def cached_index(track_file, build):
+    # The index is built once per track file and kept in the user cache folder (not among the reference files)
+    path_hash = hashlib.sha256(os.path.abspath(track_file).encode('utf-8')).hexdigest()[:32]
+    index_file = os.path.join(TRACK_INDEX_DIR, f'{path_hash}.npz')
+    stat = os.stat(track_file)
+    signature = np.array([stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+    if os.path.isfile(index_file):
+        with np.load(index_file) as data:
+            if np.array_equal(data['signature'], signature):
+                return {chrom: data[f'index_{i}'] for i, chrom in enumerate(data['chroms'])}
+
+    index = build(track_file)
+    try:
+        os.makedirs(TRACK_INDEX_DIR, exist_ok=True)
+        np.savez(index_file, signature=signature, chroms=np.array(list(index.keys())),
+                 **{f'index_{i}': entries for i, entries in enumerate(index.values())})
+    except OSError:
+        pass
+    return index
+
+
+def read_wig_entry(file, entry, dtype=np.float64):
+    # Per base values of one index entry, file opened in the binary mode
+    start, end, offset, no_lines, span, step = (int(value) for value in entry)
+    file.seek(offset)
+    lines = [file.readline() for _ in range(no_lines)]
+    header = {'file_type': 'fixedStep' if step else 'variableStep', 'start': start, 'span': span, 'step': step}
+    return wig_section_blocks(header, lines, dtype)[0][1]
+
+
+def gather_wig(file, entries, starts, ends, dtype=np.float64, read_entry=read_wig_entry):
+    """
+    Values of the intervals [starts, ends) of one chromosome, in any order: a list of arrays, None for the intervals
+    not fully covered. Each entry is read once (by read_entry); the intervals starting in the same entry are
+    gathered at once.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    results = [None] * len(starts)
+    if len(entries) == 0 or len(starts) == 0:
+        return results
+
+    first_entry = np.searchsorted(entries[:, 0], starts, side='right') - 1
+    # The values of the consecutive entries, loaded as needed, starting with the entry [loaded_from]
+    loaded_from = None
+    loaded_to = None
+    values = None
+
+    for k in np.unique(first_entry[first_entry >= 0]):
+        group = np.flatnonzero(first_entry == k)
+        group = group[starts[group] < entries[k, 1]]
+        if len(group) == 0:
+            continue
+
+        if loaded_from is not None and loaded_from <= k < loaded_to:
+            # Keep the already loaded following entries
+            values = values[(entries[k, 0] - entries[loaded_from, 0]):]
+            loaded_from = k
+        else:
+            loaded_from, loaded_to = k, k + 1
+            values = read_entry(file, entries[k], dtype)
+        needed_end = ends[group].max()
+        while (entries[loaded_from, 0] + len(values) < needed_end and loaded_to < len(entries)
+               and entries[loaded_to, 0] == entries[loaded_from, 0] + len(values)):
+            # The intervals continue to the adjacent entry
+            values = np.concatenate([values, read_entry(file, entries[loaded_to], dtype)])
+            loaded_to += 1
+
+        covered = group[ends[group] <= entries[loaded_from, 0] + len(values)]
+        gather_intervals(values, entries[loaded_from, 0], starts, ends, covered, results)
+
+    return results
+
+
+def gather_intervals(values, values_start, starts, ends, indices, results):
+    # One gather of all the intervals of the same length from the values beginning at values_start
+    lengths = ends[indices] - starts[indices]
+    for length in np.unique(lengths):
+        same = indices[lengths == length]
+        gathered = values[(starts[same] - values_start)[:, np.newaxis] + np.arange(length)]
+        complete = ~np.isnan(gathered).any(axis=1)
+        for i, row in zip(same[complete], gathered[complete]):
+            results[i] = row
 
 
 def complement(sequence_list, dictionary):
@@ -116,6 +321,69 @@ def onehot_encode_alphabet(alphabet):
     return encoded_alphabet
 
 
+def encoding_table(encoding, dtype=np.float16):
+    # Lookup table of the encoding indexed by the ASCII codes, lower case characters translated as in translate()
+    width = len(next(iter(encoding.values())))
+    table = np.zeros((256, width), dtype=dtype)
+    valid = np.zeros(256, dtype=bool)
+    for char in list(encoding.keys()) + [key.lower() for key in encoding.keys()]:
+        if len(char) != 1 or ord(char) > 255 or valid[ord(char)]:
+            continue
+        table[ord(char)] = encoding[char] if char in encoding else encoding[char.upper()]
+        valid[ord(char)] = True
+    return table, valid
+
+
+def encode_strings(strings, encoding, dtype=np.float16):
+    """Encodes a batch of strings at once by a lookup table, returns an array of shape (n, length, width).
+
+    The one-hot values (0, 1 and 0.25 for N) are exact in float16, that halves the memory compared to float32
+    (the model casts its inputs to float32 within the graph).
+    """
+    strings = list(strings)
+    table, valid = encoding_table(encoding, dtype)
+    if not strings:
+        return np.zeros((0, 0, table.shape[1]), dtype=dtype)
+    codes = np.frombuffer(''.join(strings).encode('latin-1', errors='replace'), dtype=np.uint8)
+    invalid = ~valid[codes]
+    if invalid.any():
+        raise UserInputError(f"Invalid character '{chr(codes[np.argmax(invalid)])}' found, given encoding {encoding}. "
+                             "Provided encoding must contain all possible characters (case-insensitive).")
+    encoded = table[codes]
+
+    lengths = np.array([len(string) for string in strings])
+    if (lengths == lengths[0]).all():
+        return encoded.reshape((len(strings), lengths[0], table.shape[1]))
+    # Sequences of unequal length can not form a regular array
+    ragged = np.empty(len(strings), dtype=object)
+    for i, part in enumerate(np.split(encoded, np.cumsum(lengths)[:-1])):
+        ragged[i] = part
+    return ragged
+
+
+def parse_scores(strings, dtype=np.float32):
+    # Comma separated scores of equal counts parsed at once, channels (of a signal branch) separated by ';'
+    # Returns an array of shape (n, length, channels)
+    strings = list(strings)
+    if not strings:
+        return np.zeros((0, 0, 1), dtype=dtype)
+    # The shape is taken from the first row, any other row must have the same number of channels and scores in each
+    channels = np.char.count(np.array(strings), ';') + 1
+    bad = np.flatnonzero(channels != channels[0])
+    if len(bad) == 0:
+        parts = np.array(';'.join(strings).split(';')).reshape((len(strings), channels[0]))
+        lengths = np.char.count(parts, ',')
+        bad = np.flatnonzero((lengths != lengths[0, 0]).any(axis=1))
+    if len(bad) and bad[0] == 0:
+        raise UserInputError(f'Channels of the first row of the scores ({strings[0][:50]}) differ in the number of values.')
+    elif len(bad):
+        raise UserInputError(f'Scores of the row {bad[0] + 1} ({strings[bad[0]][:50]}) differ in the number of channels '
+                             f'or values from the first row ({strings[0][:50]}).')
+    values = np.array(','.join(strings).replace(';', ',').split(','), dtype=dtype)
+    channels = channels[0]
+    return values.reshape((len(strings), channels, -1)).transpose((0, 2, 1))
+
+
 def translate(char, encoding):
     if not char:
         return None
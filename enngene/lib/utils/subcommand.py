@@ -3,18 +3,16 @@ import logging
 import numpy as np
 import os
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
 import pandas as pd
 import shutil
 import streamlit as st
 import streamlit.components.v1 as stcomponents
-import tensorflow as tf
 from tqdm import tqdm
 import yaml
+import zlib
 
-from . import eval_plots
-from . import ig
+# TensorFlow, matplotlib and sklearn (through the ig and eval_plots modules) are imported only within the methods
+# used by the model related tasks, so that e.g. the Preprocess task starts without loading them
 from . import validators
 from .exceptions import UserInputError
 
@@ -26,16 +24,20 @@ class Subcommand:
 
     BRANCHES = {'Sequence': 'seq',
                 'Conservation score': 'cons',
-                'Secondary structure': 'fold'}
+                'Secondary structure': 'fold',
+                'Numeric signal': 'signal'}
     OPTIMIZERS = {'SGD': 'sgd',
                   'RMSprop': 'rmsprop',
                   'Adam': 'adam'}
     LR_OPTIMS = {'Fixed lr': 'fixed',
                  'LR scheduler': 'lr_scheduler',
-                 # 'LR finder': 'lr_finder',
+                 'LR finder': 'lr_finder',
                  'One cycle policy': 'one_cycle'}
     WIN_PLACEMENT = {'Centered': 'center',
                      'Randomized': 'rand'}
+    IG_SCOPES = {'Top k sequences per class': 'top_k',
+                 'Sequences with the highest score over a threshold': 'threshold',
+                 'All sequences': 'all'}
 
     def general_options(self):
         self.params_loaded = False
@@ -125,6 +127,9 @@ class Subcommand:
                             training_params['no_klasses'] = len(klasses)
                             training_params['klasses'] = klasses
                             training_params['branches'] = user_params['Train']['branches']
+                            if 'signal' in training_params['branches']:
+                                training_params['train_signal_tracks'] = user_params['Train'].get(
+                                    'signal_tracks', user_params['Preprocess'].get('signal_tracks'))
                         except:
                             missing_params = True
                             st.markdown('#### Sorry, could not read the parameters from given folder. '
@@ -141,7 +146,9 @@ class Subcommand:
                                         f"* Window size: {training_params['win']}\n"
                                         f"* No. of classes: {training_params['no_klasses']}\n"
                                         f"* Class labels: {', '.join(training_params['klasses'])}\n"
-                                        f"* Branches: {', '.join([self.get_dict_key(b, self.BRANCHES) for b in training_params['branches']])}")
+                                        f"* Branches: {', '.join([self.get_dict_key(b, self.BRANCHES) for b in training_params['branches']])}" +
+                                        (f"\n* Signal tracks: {', '.join(training_params['train_signal_tracks'])}"
+                                         if training_params.get('train_signal_tracks') else ''))
                             self.params.update(training_params)
                     if len(previous_param_files) > 1:
                         missing_params = True
@@ -172,18 +179,31 @@ class Subcommand:
 
         self.validation_hash['is_model_file'].append(self.params['model_file'])
 
+    def evaluation_options(self):
+        self.params['render_plots'] = st.checkbox('Render the evaluation plots (otherwise only the curves are exported)',
+                                                  value=self.defaults['render_plots'])
+        self.params['bootstrap'] = st.checkbox('Calculate bootstrap confidence intervals of the evaluation metrics',
+                                               value=self.defaults['bootstrap'])
+        if self.params['bootstrap']:
+            self.params['bootstrap_samples'] = int(st.number_input(
+                'Number of bootstrap resamples', min_value=100, value=self.defaults['bootstrap_samples'], step=100))
+
     def sequence_options(self, seq_types, evaluation):
-        if 'cons' in self.params['branches']:
+        if 'cons' in self.params['branches'] or 'signal' in self.params['branches']:
             if evaluation:
-                seq_types = {'BED file': 'bed', 'Blackbox dataset': 'blackbox'}
+                seq_types = {'BED file': 'bed', 'Blackbox dataset': 'blackbox', 'Pre-encoded dataset': 'encoded'}
                 self.params['seq_type'] = seq_types[st.radio(
                     'Select a source of the sequences:',
                     list(seq_types.keys()), index=self.get_dict_index(self.defaults['seq_type'], seq_types))]
             else:
                 # to map to the conservation files we need the coordinates
-                self.params['seq_type'] = 'bed'
+                seq_types = {'BED file': 'bed', 'Pre-encoded dataset': 'encoded'}
+                self.params['seq_type'] = seq_types[st.radio(
+                    'Select a source of the sequences:',
+                    list(seq_types.keys()), index=self.get_dict_index(self.defaults['seq_type'], seq_types))]
                 st.markdown(
-                    '###### Note: Only BED files allowed when Conservation score branch is applied (the coordinates are necessary).')
+                    '###### Note: Only BED files or pre-encoded datasets allowed when Conservation score or Numeric signal branch is applied '
+                    '(the coordinates are necessary).')
         else:
             self.params['seq_type'] = seq_types[st.radio(
                 'Select a source of the sequences:',
@@ -208,10 +228,19 @@ class Subcommand:
                 self.references.update({'seq': self.params['fasta_ref'], 'fold': self.params['fasta_ref']})
                 self.validation_hash['is_fasta'].append(self.params['fasta_ref'])
             if 'cons' in self.params['branches']:
-                self.params['cons_dir'] = st.text_input('Path to folder containing reference conservation files',
+                self.params['cons_dir'] = st.text_input('Path to the reference conservation track (folder of wig files, bedGraph or bigWig file)',
                                                         value=self.defaults['cons_dir'])
                 self.references.update({'cons': self.params['cons_dir']})
-                self.validation_hash['is_wig_dir'].append(self.params['cons_dir'])
+                self.validation_hash['is_cons_track'].append(self.params['cons_dir'])
+            if 'signal' in self.params['branches']:
+                train_tracks = self.params.get('train_signal_tracks')
+                signal_tracks = st.text_area('Paths to the signal tracks (one per line, each a folder of wig files, bedGraph or bigWig file)',
+                                             value='\n'.join(self.defaults['signal_tracks'] or train_tracks or []))
+                self.validation_hash['is_signal_tracks'].append(signal_tracks)
+                if train_tracks:
+                    self.validation_hash['is_signal_channels'].append({'tracks': signal_tracks, 'train_tracks': train_tracks})
+                self.params['signal_tracks'] = [line.strip() for line in signal_tracks.strip().split('\n') if line.strip()]
+                self.references.update({'signal': self.params['signal_tracks']})
 
         elif self.params['seq_type'] == 'fasta' or self.params['seq_type'] == 'text':
             st.markdown('###### WARNING: Sequences shorter than the window size will be padded with Ns (may affect '
@@ -238,6 +267,18 @@ class Subcommand:
                 'or the parameters must match at least (e.g. class names, window size, branches...).')
 
             self.validation_hash['is_blackbox'].append(self.params['seq_source'])
+        elif self.params['seq_type'] == 'encoded':
+            self.params['seq_source'] = st.text_input(
+                'Path to the pre-encoded dataset folder exported from the Preprocess module '
+                '(e.g. final_datasets/blackbox_encoded)', value=self.defaults['seq_source'])
+            st.markdown(
+                '###### Note: The encoded data are read from the disk batch by batch, thus even large datasets can be '
+                'processed with a limited memory. Dataset should come from the same data as those used for training '
+                'the model, or the parameters must match at least (e.g. class names, window size, branches...).')
+            self.params['batch_size'] = int(st.number_input('Batch size', min_value=1, value=self.defaults['batch_size']))
+            self.validation_hash['is_encoded_dir'].append({'folder': self.params['seq_source'],
+                                                           'branches': self.params['branches'],
+                                                           'evaluation': evaluation})
 
         if 'fold' in self.params['branches']:
             # currently used only as an option for RNAfold
@@ -248,25 +289,76 @@ class Subcommand:
             self.ncpu = 1
 
     def evaluate_model(self, encoded_labels, model, test_x, test_y, params, out_dir):
-        test_results = model.evaluate(
-            test_x,
-            test_y,
-            verbose=1,
-            sample_weight=None)
-        y_pred = model.predict(test_x, verbose=1)
+        from . import eval_plots
+        from .encoded_sequence import EncodedSequence
+
+        if isinstance(test_x, EncodedSequence):
+            # Memory-mapped dataset streamed in batches, the labels are provided by the sequence itself
+            test_results = model.evaluate(test_x, verbose=1)
+            y_pred = model.predict(test_x.inputs_only(), verbose=1)
+        else:
+            test_results = model.evaluate(
+                test_x,
+                test_y,
+                verbose=1,
+                sample_weight=None)
+            y_pred = model.predict(test_x, verbose=1)
 
         self.log_eval_metrics(test_results, params)
 
+        if test_y.ndim == 1:
+            # Sparse labels (class indices) expanded for the plots
+            test_y = np.eye(len(encoded_labels))[test_y]
+
         # Plot evaluation metrics
         # categorical_labels = {key: i for i, (key, _) in enumerate(encoded_labels.items())}
-        aucs = eval_plots.plot_multiclass_roc_curve(test_y, y_pred, encoded_labels, out_dir)
-        avg_precisions = eval_plots.plot_multiclass_prec_recall_curve(test_y, y_pred, encoded_labels, out_dir)
+        # Curves are exported right away, the figures rendered in the background
+        render_mode = 'background' if params.get('render_plots', True) else None
+        # Renders of this run only, the server may run more sessions at once
+        if not hasattr(self, 'pending_plots'):
+            self.pending_plots = []
+        aucs = eval_plots.plot_multiclass_roc_curve(test_y, y_pred, encoded_labels, out_dir, render_mode, self.pending_plots)
+        avg_precisions = eval_plots.plot_multiclass_prec_recall_curve(test_y, y_pred, encoded_labels, out_dir, render_mode,
+                                                                      self.pending_plots)
         # FIXME
         # eval_plots.plot_eval_cfm(np.argmax(test_y, axis=1), np.argmax(y_pred, axis=1), categorical_labels, out_dir)
         self.log_plotted_metrics(aucs, avg_precisions, params)
 
+        if params.get('bootstrap'):
+            from . import bootstrap
+            acc_ci, auc_cis, ap_cis = bootstrap.confidence_intervals(
+                np.argmax(test_y, axis=1), y_pred, resamples=params['bootstrap_samples'])
+            self.log_confidence_intervals(acc_ci, auc_cis, ap_cis, list(encoded_labels.keys()), params)
+
         return y_pred
 
+    def wait_for_plots(self):
+        from . import eval_plots
+        eval_plots.wait_for_rendering(getattr(self, 'pending_plots', []))
+
+    @staticmethod
+    def log_confidence_intervals(acc_ci, auc_cis, ap_cis, klasses, params):
+        def interval(bounds):
+            return f'{round(bounds[0], 4)}-{round(bounds[1], 4)}'
+
+        params['acc_ci'] = interval(acc_ci)
+        params['auc_ci'] = ', '.join(f'{klass}: {interval(bounds)}' for klass, bounds in zip(klasses, auc_cis))
+        params['ap_ci'] = ', '.join(f'{klass}: {interval(bounds)}' for klass, bounds in zip(klasses, ap_cis))
+
+        logger.info('Accuracy 95% CI: ' + params['acc_ci'])
+        logger.info('AUC 95% CI: ' + params['auc_ci'])
+        logger.info('Average precision 95% CI: ' + params['ap_ci'])
+
+        st.text(f"95% confidence intervals ({params['bootstrap_samples']} bootstrap resamples) \n"
+                f"Accuracy: {params['acc_ci']} \n"
+                f"AUC: {params['auc_ci']} \n"
+                f"Average precision: {params['ap_ci']}")
+
+    @staticmethod
+    def uses_sparse_labels(model):
+        losses = model.loss if isinstance(model.loss, (list, tuple)) else [model.loss]
+        return any('sparse' in str(getattr(loss, '__name__', loss)) for loss in losses)
+
     @staticmethod
     def get_klass(predicted, klasses):
         #TODO give the user choice of the tresshold value? - would have to specify per each class, if the highest scoring class would be above its threshold, then we would call it, otherwise uncertain
@@ -368,118 +460,167 @@ class Subcommand:
         return list(dictionary.keys())[index]
 
 
+    CONS_SYMBOLS = np.array(['- '] + [f'{level} ' for level in range(10)] + ['+ '])
+
     @staticmethod
     def cons_to_symbol(cons):
-        cons = np.round((cons / 0.5) + 5)
-        if cons > 9:
-            return "+ "
-        elif cons < 0:
-            return "- "
-        else:
-            return str(int(cons)) + " "
-    
-    
+        return Subcommand.cons_to_symbols([cons])[0]
+
+    @staticmethod
+    def cons_to_symbols(scores):
+        # Levels 0-9 by half a point around zero, '-' and '+' beyond
+        levels = np.clip(np.round((np.asarray(scores, dtype=np.float64) / 0.5) + 5), -1, 10).astype(int)
+        return Subcommand.CONS_SYMBOLS[levels + 1]
+
     @staticmethod
     def visualize_specifier(branches):
+        from . import ig
         LETTER_HEIGHT = 20
-               
-        def visualize(row):
-            sub_viz = []
-            _max = -np.inf
-            _min = np.inf
-            
-            for branch in branches:
-                _max = max(_max, row[branch + "_ig"].max()) 
-                _min = min(_max, row[branch + "_ig"].min())
-                
-            
-            visualisation = {
-                branch: ig.visualize_token_attrs(row[branch], row[branch+"_ig"], _min, _max) for branch in branches
-            }
-            
-            sequence_len = len(row[branches[0]]) # just get sequence length, should be equal across all branches
+        ROW_LENGTH = 25
+
+        def tokens(row, branch):
+            if branch == 'cons':
+                scores = row['cons'].split(',') if isinstance(row['cons'], str) else row['cons']
+                return Subcommand.cons_to_symbols(scores)
+            elif branch == 'signal':
+                # Channels of different scales, only the attributions are shown
+                return ['&bull; '] * len(row['signal_ig'])
+            return row[branch]
+
+        def visualize(rows):
+            if len(rows) == 0:
+                return
+            # Colors of all the rows and branches at once, each row normalized to its own range over the branches
+            attrs = {branch: np.array([np.asarray(a, dtype=np.float64) for a in rows[branch + '_ig']]) for branch in branches}
+            _max = np.max([attrs[branch].max(axis=1) for branch in branches], axis=0)
+            _min = np.min([attrs[branch].min(axis=1) for branch in branches], axis=0)
+            colors = {branch: ig.attribution_colors(attrs[branch], _min, _max) for branch in branches}
+
+            sequence_len = attrs[branches[0]].shape[1]  # should be equal across all branches
             max_text_len = len(str(sequence_len)) + 1
-        
-            display_rows_count = sequence_len//25
-            
-            
-            for sequence_pos in range(display_rows_count):
-                start = str(sequence_pos*25) 
-                end = str((sequence_pos+1)*25) 
-                
-                sub_viz.append("<div style='font-family: monospace, monospace'>")
-                
-                # funky sort to ensure seq -> fold -> cons order
-                for i_branch, branch in enumerate(sorted(branches)[::-1]):
-                    if i_branch == 0:
-                        sub_viz.append(start + '<span style="opacity:0;">' + (max_text_len-len(start))*"_" +'</span>')
-                        sub_viz.extend(visualisation[branch][sequence_pos*25:(sequence_pos+1)*25])
-                        sub_viz.append( '<span style="opacity:0;">' + (max_text_len-len(end))*"_" +'</span>' + end)
-                    else:
-                        sub_viz.append('<span style="opacity:0;">' + max_text_len*"_" +'</span>')
-                        sub_viz.extend(visualisation[branch][sequence_pos*25:(sequence_pos+1)*25])
-                        sub_viz.append('<span style="opacity:0;">' + max_text_len*"_" +'</span>')
-                        
-                    sub_viz.append(" " + branch)                    
-                    sub_viz.append("<br>")
-                
-                sub_viz.append("</div>")
-                sub_viz.append("<br>")
-                
-            
-            sub_viz.append("<hr>")
-            stcomponents.html("".join(sub_viz), height=LETTER_HEIGHT*(len(branches)+1)*(display_rows_count))
-            sub_viz = []
-                
-        
+            display_rows_count = sequence_len // ROW_LENGTH
+            padding = '<span style="opacity:0;">%s</span>'
+            full_padding = padding % (max_text_len * '_')
+            # funky sort to ensure seq -> fold -> cons order
+            ordered_branches = sorted(branches)[::-1]
+
+            for i, (_, row) in enumerate(rows.iterrows()):
+                visualisation = {branch: ig.visualize_token_attrs(tokens(row, branch), colors[branch][i]) for branch in branches}
+                sub_viz = []
+                for sequence_pos in range(display_rows_count):
+                    start = str(sequence_pos * ROW_LENGTH)
+                    end = str((sequence_pos + 1) * ROW_LENGTH)
+                    part = slice(sequence_pos * ROW_LENGTH, (sequence_pos + 1) * ROW_LENGTH)
+
+                    sub_viz.append("<div style='font-family: monospace, monospace'>")
+                    for i_branch, branch in enumerate(ordered_branches):
+                        if i_branch == 0:
+                            sub_viz.append(start + padding % ((max_text_len - len(start)) * '_'))
+                            sub_viz.extend(visualisation[branch][part])
+                            sub_viz.append(padding % ((max_text_len - len(end)) * '_') + end)
+                        else:
+                            sub_viz.append(full_padding)
+                            sub_viz.extend(visualisation[branch][part])
+                            sub_viz.append(full_padding)
+                        sub_viz.append(f' {branch}<br>')
+                    sub_viz.append('</div><br>')
+
+                sub_viz.append('<hr>')
+                stcomponents.html(''.join(sub_viz), height=LETTER_HEIGHT*(len(branches)+1)*(display_rows_count))
+
         return visualize
-    
+
     @staticmethod
-    def calculate_ig(dataset, model, predict_x, klasses, branches, use_smoothgrad=False):
+    def calculate_ig(dataset, model, predict_x, klasses, branches, use_smoothgrad=False, out_dir=None,
+                     adaptive=False, tolerance=0.01, model_file=None, cache_dir=None, cache_size=1024,
+                     rows=None):
+        # rows: indices of the samples to calculate the IG for (see ig_rows), all of them by default
+        import tensorflow as tf
+        from . import ig
+        from .ig_cache import AttributionCache, CACHE_FILE
+
         if not isinstance(predict_x, list):
-            logger.info("predict_x is not a list, wrapping in an array")
-            predict_x = (np.array(predict_x),)
+            # no np.array here, that would load the whole memory-mapped input at once
+            predict_x = (predict_x,)
                         
         # baseline of zeros in equal shape as inputs
         baselines = [tf.zeros(shape=x[0].shape) for x in predict_x]
         top_klasses = [klasses.index(klass) for klass in dataset.df['highest scoring class']]
+        rows = np.arange(len(dataset.df)) if rows is None else np.asarray(rows)
+        if len(rows) == 0:
+            logger.warning('No sequences selected for the integrated gradients calculation (e.g. none over the threshold).')
+            for branch in branches:
+                dataset.df[branch + "_ig"] = ''
+            return
 
         ig_per_branch = { branch: [] for branch in branches }
-      
+        ig_steps = []
+        ig_residuals = []
+        adaptive = adaptive and not use_smoothgrad
+
+        cache = None
+        if model_file and cache_dir:
+            function = ig.smoothgrad if use_smoothgrad else (ig.adaptive_integrated_gradients if adaptive else ig.integrated_gradients)
+            # All the parameters the attributions depend on, not to reuse them once any of them changes
+            method = {'function': function.__name__, **ig.default_parameters(function)}
+            if adaptive:
+                method['tolerance'] = tolerance
+            cache = AttributionCache(os.path.join(cache_dir, CACHE_FILE), model_file, branches, method, cache_size)
 
         # take each prediction, unprocessed data and count IG
-        for inputs, target_class in tqdm(zip(zip(*predict_x), top_klasses), total=len(predict_x[0])): 
-            # zip(*predict_x) decompress a list of n lists into a single list of tuples
-            # e. g. [[a,b], [c,d]] becomes [(a,c), (b,d)] ; [[a, b, c]] becomes [(a,), (b,), (c,)]
-            
-            # return tensor of shape: (window width(sequence length), encoded base shape)
-            inputs = [tf.convert_to_tensor(_input, dtype=tf.float32) for _input in inputs]
-            
-            # contain significance of each base in sequence
-            if use_smoothgrad:
-                ig_method = ig.smoothgrad
+        for row in tqdm(rows):
+            # one sample of each branch input
+            inputs = [np.asarray(x[row], dtype=np.float32) for x in predict_x]
+            target_class = top_klasses[row]
+            key = cache.key(inputs, target_class) if cache else None
+            cached = cache.get(key) if cache else None
+            if cached is not None:
+                selected_ig_atributions = cached[:len(branches)]
+                if adaptive:
+                    steps, residual = cached[-1]
+                    ig_steps.append(int(steps))
+                    ig_residuals.append(float(residual))
             else:
-                ig_method = ig.integrated_gradients
-            
-            ig_atributions = ig_method(model, baselines, inputs, target_class)
+                selected_ig_atributions = Subcommand.sample_ig(ig, model, baselines, inputs, target_class, use_smoothgrad,
+                                                               adaptive, tolerance, ig_steps, ig_residuals)
+                if cache:
+                    extra = [np.array([ig_steps[-1], ig_residuals[-1]])] if adaptive else []
+                    cache.put(key, [np.asarray(x, dtype=np.float32) for x in selected_ig_atributions] + extra)
 
-            # choose attribution for specific encoded base
-            selected_ig_atributions = ig.choose_validation_points(ig_atributions)
-            
             for branch, ig_atribution in zip(branches, selected_ig_atributions):
                 ig_per_branch[branch].append(ig_atribution)
 
-        for branch in branches:
-            dataset.df[branch + "_ig"] = ig_per_branch[branch]
-            
+        no_rows = len(dataset.df)
+        for branch, x in zip(branches, predict_x):
+            ig_per_branch[branch] = np.array(ig_per_branch[branch], dtype=np.float32).reshape((len(rows), x.shape[1]))
+            # Samples without the IG calculated are left empty (nan)
+            full = np.full((no_rows, ig_per_branch[branch].shape[1]), np.nan, dtype=np.float32)
+            full[rows] = ig_per_branch[branch]
+            dataset.df[branch + "_ig"] = list(full)
+        if cache:
+            cache.close()
+        if adaptive:
+            # Number of steps used and the completeness residual |sum(attributions) - (f(input) - f(baseline))|
+            steps = np.full(no_rows, np.nan)
+            steps[rows] = ig_steps
+            residuals = np.full(no_rows, np.nan)
+            residuals[rows] = np.round(ig_residuals, 6)
+            dataset.df['ig_steps'] = pd.array(np.where(np.isnan(steps), None, steps), dtype='Int64')
+            dataset.df['ig_residual'] = residuals
+            logger.info(f'Adaptive IG: {np.mean(ig_steps):.1f} steps on average, '
+                        f'{np.sum(np.array(ig_residuals) > tolerance)} samples over the tolerance at the maximum of steps.')
+        if out_dir:
+            # Attributions of the calculated samples, one array per branch, and their row numbers in the results.tsv
+            np.savez_compressed(os.path.join(out_dir, 'ig_attributions.npz'), rows=rows, **ig_per_branch)
+
         # Show ten best predictions per class in the application window
         st.markdown('---')
         st.markdown('### Integrated Gradients Visualisation')
         st.markdown('Below are ten sequences with highest predicted score per each class. \n'
-                    'You can find html visualisation code for all the sequences in the results.tsv file.\n\n'
+                    'You can find the attributions of all the sequences in the results.tsv file (and ig_attributions.npz).\n\n'
                     'The higher is the attribution of the sequence to the prediction, the more pronounced is its red color. '
                     'On the other hand, the blue color means low level of attribution.')
-        best = dataset.df[klasses + [branch+'_ig' for branch in branches] + branches]
+        best = dataset.df.iloc[rows][klasses + [branch+'_ig' for branch in branches] + branches]
 
         visualize = Subcommand.visualize_specifier(branches)
         
@@ -487,15 +628,56 @@ class Subcommand:
             st.markdown(f'#### {klass}')
             best_ten = best.sort_values(by=klass, ascending=False, inplace=False)[:10]
             
-            for _, row in best_ten.iterrows():    
-                if 'cons' in branches:
-                    row['cons'] = [Subcommand.cons_to_symbol(cons_score) for cons_score in  row['cons']] 
-                visualize(row)
+            visualize(best_ten)
+
+        for branch in branches:
+            # Exported as compact comma separated numbers
+            strings = np.full(no_rows, '', dtype=object)
+            strings[rows] = ig.attributions_to_strings(ig_per_branch[branch])
+            dataset.df[branch + "_ig"] = strings
 
     @staticmethod
-    def finalize_run(logger, out_dir, user_params, csv_header, csv_row, placeholder=None, previous_param_file=None):
-        place = placeholder or st.empty()
-        place.text(f'You can find your results at {out_dir}')
+    def ig_rows(predicted, scope='top_k', k=10, threshold=0.5):
+        # Indices of the samples to calculate the IG for: the k best scoring per class, scoring over the threshold, or all
+        predicted = np.asarray(predicted)
+        if scope == 'all':
+            return np.arange(len(predicted))
+        elif scope == 'top_k':
+            k = min(k, len(predicted))
+            if k == 0:
+                return np.arange(0)
+            # partial sort of each class column, no full sort of the whole prediction matrix
+            return np.unique(np.argpartition(-predicted, k - 1, axis=0)[:k])
+        elif scope == 'threshold':
+            return np.flatnonzero(predicted.max(axis=1) >= threshold)
+        else:
+            raise ValueError(f'Unknown IG scope {scope}.')
+
+    @staticmethod
+    def sample_ig(ig, model, baselines, inputs, target_class, use_smoothgrad, adaptive, tolerance, ig_steps, ig_residuals):
+        import tensorflow as tf
+
+        # return tensor of shape: (window width(sequence length), encoded base shape)
+        tensors = [tf.convert_to_tensor(_input) for _input in inputs]
+
+        # contain significance of each base in sequence
+        if use_smoothgrad:
+            # noise seeded by the sample content, for reproducible (and cacheable) attributions
+            seed = (42, zlib.crc32(b''.join(_input.tobytes() for _input in inputs)))
+            ig_atributions = ig.smoothgrad(model, baselines, tensors, target_class, seed=seed)
+        elif adaptive:
+            ig_atributions, steps, residual = ig.adaptive_integrated_gradients(
+                model, baselines, tensors, target_class, tolerance=tolerance)
+            ig_steps.append(steps)
+            ig_residuals.append(residual)
+        else:
+            ig_atributions = ig.integrated_gradients(model, baselines, tensors, target_class)
+
+        # choose attribution for specific encoded base
+        return ig.choose_validation_points(ig_atributions)
+
+    @staticmethod
+    def save_params(out_dir, user_params, previous_param_file=None):
         params = user_params.copy()
         task = params.pop('task')
         params = {task: user_params}
@@ -507,14 +689,31 @@ class Subcommand:
         with open(os.path.join(out_dir, 'parameters.yaml'), 'w') as file:
             yaml.dump(params, file)
 
+    @staticmethod
+    def append_to_table(out_dir, csv_header, csv_row):
+        # The table collects rows of all the runs within the parent folder. Runs with different columns (e.g. by another
+        # version of the application) are collected in the next table (parameters_2.tsv etc.), not to shift the columns.
         parent_dir = Path(out_dir).parent
         table_file = os.path.join(parent_dir, 'parameters.tsv')
-        if table_file:
-            write_header = not os.path.isfile(table_file)
-            with open(table_file, 'a') as file:
-                file.write(csv_header) if write_header else None
-                file.write(csv_row)
-                pass
+        number = 1
+        while os.path.isfile(table_file):
+            with open(table_file, 'r') as file:
+                if file.readline().rstrip('\n') == csv_header.rstrip('\n'):
+                    break
+            number += 1
+            table_file = os.path.join(parent_dir, f'parameters_{number}.tsv')
+        write_header = not os.path.isfile(table_file)
+        with open(table_file, 'a') as file:
+            file.write(csv_header) if write_header else None
+            file.write(csv_row)
+
+    @staticmethod
+    def finalize_run(logger, out_dir, user_params, csv_header, csv_row, placeholder=None, previous_param_file=None):
+        place = placeholder or st.empty()
+        place.text(f'You can find your results at {out_dir}')
+        Subcommand.save_params(out_dir, user_params, previous_param_file)
+        if csv_row:
+            Subcommand.append_to_table(out_dir, csv_header, csv_row)
 
         file_handler = [handler for handler in logger.handlers if type(handler) == logging.FileHandler]
         if file_handler:
@@ -566,6 +765,9 @@ class Subcommand:
                'Evaluation accuracy\t' \
                'AUC\t' \
                'Average precision\t' \
+               'Accuracy CI\t' \
+               'AUC CI\t' \
+               'Average precision CI\t' \
                'Training loss\t' \
                'Training accuracy\t' \
                'Validation loss\t' \
@@ -587,6 +789,9 @@ class Subcommand:
                f"{params['eval_acc']}\t" \
                f"{params['auc']}\t" \
                f"{params['avg_precision']}\t" \
+               f"{params.get('acc_ci', '-')}\t" \
+               f"{params.get('auc_ci', '-')}\t" \
+               f"{params.get('ap_ci', '-')}\t" \
                f"{params['train_loss']}\t" \
                f"{params['train_acc']}\t" \
                f"{params['val_loss']}\t" \
@@ -609,6 +814,9 @@ class Subcommand:
                'Evaluation accuracy\t' \
                'AUC\t' \
                'Average precision\t' \
+               'Accuracy CI\t' \
+               'AUC CI\t' \
+               'Average precision CI\t' \
                'Model file\t' \
                'Evaluation branches\t' \
                'Window\t' \
@@ -627,6 +835,9 @@ class Subcommand:
                f"{params['eval_acc']}\t" \
                f"{params['auc']}\t" \
                f"{params['avg_precision']}\t" \
+               f"{params.get('acc_ci', '-')}\t" \
+               f"{params.get('auc_ci', '-')}\t" \
+               f"{params.get('ap_ci', '-')}\t" \
                f"{params['model_file']}\t" \
                f"{params['branches']}\t" \
                f"{params['win']}\t" \
@@ -0,0 +1,249 @@
+"""Readers of the per base numeric tracks (e.g. the conservation scores) in the supported formats.
+
+Every reader gives the values of a batch of intervals of one chromosome by values(chrom, starts, ends): a list of
+numpy arrays, None for the intervals not fully covered by the track. The file stays open until close(), the chromosomes
+are best read in the order of offset(chrom). Use open_track to get the reader by the path.
+    WigTrack - folder of per chromosome wig files (or a single wig file), plain or gzipped
+    BedGraphTrack - bedGraph file, plain or gzipped
+    BigWigTrack - bigWig file, requires the optional pyBigWig package
+"""
+import logging
+import numpy as np
+import os
+import re
+
+from .exceptions import UserInputError
+from . import file_utils as f
+from . import sequence as seq
+
+logger = logging.getLogger('root')
+
+WIG_EXTENSIONS = ('.wig', '.wig.gz')
+BEDGRAPH_EXTENSIONS = ('.bedgraph', '.bedgraph.gz', '.bg', '.bg.gz')
+BIGWIG_EXTENSIONS = ('.bw', '.bigwig')
+
+
+def open_track(path):
+    lower = path.lower()
+    if os.path.isdir(path) or lower.endswith(WIG_EXTENSIONS):
+        return WigTrack(path)
+    elif lower.endswith(BEDGRAPH_EXTENSIONS):
+        return BedGraphTrack(path)
+    elif lower.endswith(BIGWIG_EXTENSIONS):
+        return BigWigTrack(path)
+    else:
+        raise UserInputError(f'Unknown format of the track {path}. '
+                             f'Provide a folder of wig files, a bedGraph or a bigWig file.')
+
+
+class TrackReader:
+
+    def values(self, chrom, starts, ends):
+        raise NotImplementedError
+
+    def chromosomes(self):
+        raise NotImplementedError
+
+    def offset(self, chrom):
+        # Position of the chromosome within the file, reading the chromosomes in this order the file is passed forward
+        return 0
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WigTrack(TrackReader):
+
+    def __init__(self, path):
+        self.path = path
+        self.files = f.list_files_in_dir(path, 'wig') if os.path.isdir(path) else [path]
+        # Kept open across the chromosomes, a gzipped file can not seek back without decompressing it again
+        self.handles = {}
+        self.indexes = {}
+
+    def index(self, file):
+        if file not in self.indexes:
+            self.indexes[file] = seq.load_wig_index(file)
+        return self.indexes[file]
+
+    def handle(self, file):
+        if file not in self.handles:
+            self.handles[file] = seq.open_text(file, 'rb')
+        return self.handles[file]
+
+    def chrom_file(self, chrom):
+        if not os.path.isdir(self.path):
+            return self.path
+        files = list(filter(lambda file: f"{chrom}." in os.path.basename(file), self.files))
+        if len(files) == 1:
+            return files[0]
+        # TODO or rather raise an exception to let user fix it?
+        if len(files) == 0:
+            logger.warning(f"Didn't find appropriate conservation file for {chrom}, skipping the chromosome.")
+        else:
+            logger.warning(f"Found multiple conservation files for {chrom}, skipping the chromosome.")
+        return None
+
+    def values(self, chrom, starts, ends):
+        file = self.chrom_file(chrom)
+        if file is None:
+            return [None] * len(starts)
+        # Random access by the coverage index of the file, any order of the intervals
+        index = self.index(file)
+        if chrom not in index:
+            logger.warning(f'No scores for {chrom} found in {file}, skipping the chromosome.')
+            return [None] * len(starts)
+        return seq.gather_wig(self.handle(file), index[chrom], starts, ends)
+
+    def offset(self, chrom):
+        # Every chromosome has its own file in the folder
+        if os.path.isdir(self.path) or chrom not in self.index(self.path):
+            return 0
+        return int(self.index(self.path)[chrom][:, 2].min())
+
+    def chromosomes(self):
+        if not os.path.isdir(self.path):
+            return list(self.index(self.path).keys())
+        chromosomes = []
+        for file in self.files:
+            match = re.search(r'.*\.*.*(chr[^.]*)\..*', os.path.basename(file))
+            if match and match.group(1):
+                chromosomes.append(match.group(1))
+        return list(set(chromosomes))
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+
+def index_bedgraph(bedgraph_file, chunk_lines=1000000):
+    """
+    Coverage index of the bedGraph file, in the format of seq.index_wig (span and step are 0).
+
+    An entry is a run of adjacent intervals (of up to chunk_lines lines), with the byte offset of its first line.
+    """
+    index = {}
+
+    def add_entries(chrom, lines, offsets):
+        fields = np.array(b''.join(lines).split()).reshape((-1, 4))
+        starts = fields[:, 1].astype(np.int64)
+        ends = fields[:, 2].astype(np.int64)
+        runs = np.split(np.arange(len(starts)), np.flatnonzero(starts[1:] != ends[:-1]) + 1)
+        index.setdefault(chrom, []).extend(
+            [(starts[run[0]], ends[run[-1]], offsets[run[0]], len(run), 0, 0) for run in runs])
+
+    chrom = None
+    lines = []
+    offsets = []
+    offset = 0
+    with seq.open_text(bedgraph_file, 'rb') as file:
+        for line in file:
+            if not (line.startswith((b'track', b'browser', b'#')) or not line.strip()):
+                line_chrom = line.split(None, 1)[0].decode('utf-8')
+                if (line_chrom != chrom or len(lines) >= chunk_lines) and lines:
+                    add_entries(chrom, lines, offsets)
+                    lines, offsets = [], []
+                chrom = line_chrom
+                lines.append(line)
+                offsets.append(offset)
+            offset += len(line)
+    if lines:
+        add_entries(chrom, lines, offsets)
+
+    index = {chrom: np.array(entries, dtype=np.int64).reshape((-1, len(seq.WIG_INDEX))) for chrom, entries in index.items()}
+    return {chrom: entries[np.argsort(entries[:, 0], kind='mergesort')] for chrom, entries in index.items()}
+
+
+def read_bedgraph_entry(file, entry, dtype=np.float64):
+    # Per base values of one index entry (a run of adjacent intervals), file opened in the binary mode
+    file.seek(int(entry[2]))
+    lines = [file.readline() for _ in range(int(entry[3]))]
+    fields = np.array(b''.join(lines).split()).reshape((-1, 4))
+    lengths = fields[:, 2].astype(np.int64) - fields[:, 1].astype(np.int64)
+    return np.repeat(fields[:, 3].astype(dtype), lengths)
+
+
+class BedGraphTrack(TrackReader):
+
+    def __init__(self, path):
+        self.path = path
+        self.index = seq.cached_index(path, index_bedgraph)
+        self.file = None
+
+    def values(self, chrom, starts, ends):
+        if chrom not in self.index:
+            logger.warning(f'No scores for {chrom} found in {self.path}, skipping the chromosome.')
+            return [None] * len(starts)
+        if self.file is None:
+            self.file = seq.open_text(self.path, 'rb')
+        return seq.gather_wig(self.file, self.index[chrom], starts, ends, read_entry=read_bedgraph_entry)
+
+    def offset(self, chrom):
+        return int(self.index[chrom][:, 2].min()) if chrom in self.index else 0
+
+    def chromosomes(self):
+        return list(self.index.keys())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BigWigTrack(TrackReader):
+    # Nearby intervals are read from the file at once, up to the MAX_SPAN bases
+    MAX_GAP = 10000
+    MAX_SPAN = 1000000
+
+    def __init__(self, path):
+        try:
+            import pyBigWig
+        except ImportError:
+            raise UserInputError('Reading the bigWig files requires the pyBigWig package (pip install pyBigWig).')
+        self.path = path
+        self.file = pyBigWig.open(path)
+        if self.file is None:
+            raise UserInputError(f'Could not open the bigWig file {path}.')
+
+    def values(self, chrom, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        results = [None] * len(starts)
+        chrom_length = self.file.chroms().get(chrom)
+        if chrom_length is None:
+            logger.warning(f'No scores for {chrom} found in {self.path}, skipping the chromosome.')
+            return results
+
+        valid = np.flatnonzero((starts >= 0) & (ends <= chrom_length) & (ends > starts))
+        order = valid[np.argsort(starts[valid], kind='mergesort')]
+        cluster = []
+        cluster_start = cluster_end = None
+        for i in order:
+            if cluster and (starts[i] > cluster_end + self.MAX_GAP or ends[i] - cluster_start > self.MAX_SPAN):
+                self.read_cluster(chrom, cluster_start, cluster_end, starts, ends, np.array(cluster), results)
+                cluster = []
+            if not cluster:
+                cluster_start, cluster_end = starts[i], ends[i]
+            cluster.append(i)
+            cluster_end = max(cluster_end, ends[i])
+        if cluster:
+            self.read_cluster(chrom, cluster_start, cluster_end, starts, ends, np.array(cluster), results)
+        return results
+
+    def read_cluster(self, chrom, cluster_start, cluster_end, starts, ends, indices, results):
+        # Bases not covered by the file are returned as nan
+        values = np.array(self.file.values(chrom, int(cluster_start), int(cluster_end)), dtype=np.float64)
+        seq.gather_intervals(values, cluster_start, starts, ends, indices, results)
+
+    def chromosomes(self):
+        return list(self.file.chroms().keys())
+
+    def close(self):
+        self.file.close()
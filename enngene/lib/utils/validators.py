@@ -1,13 +1,15 @@
-import h5py
 import os
 import subprocess
 
 from .dataset import Dataset
 from . import file_utils as f
+from . import sequence as seq
+from . import tracks
 
 BRANCHES_REV = {'seq': 'Sequence',
                 'cons': 'Conservation score',
-                'fold': 'Secondary structure'}
+                'fold': 'Secondary structure',
+                'signal': 'Numeric signal'}
 
 
 def not_empty_branches(branches):
@@ -112,35 +114,138 @@ def is_blackbox(file_path):
     return warning if invalid else None
 
 
-def is_wig_dir(folder):
-    # Checks just one random (first found) wig file
+def is_encoded_dir(folder, branches, evaluation):
     invalid = False
 
     if len(folder) == 0:
         invalid = True
-        warning = 'You must provide the conservation reference directory.'
+        warning = 'You must provide the folder with the pre-encoded dataset.'
+    elif not os.path.isfile(os.path.join(folder, Dataset.ENCODED_INFO)):
+        invalid = True
+        warning = f"Given folder does not contain the '{Dataset.ENCODED_INFO}' file. " \
+                  'Make sure to provide the pre-encoded dataset folder exported from the Preprocess module.'
     else:
-        if os.path.isdir(folder):
-            files = f.list_files_in_dir(folder, 'wig')
-            one_wig = next((file for file in files if 'wig' in file), None)
-            if one_wig:
-                try:
-                    wig_file, zipped = f.unzip_if_zipped(one_wig)
-                    line1 = f.read_decoded_line(wig_file, zipped)
+        try:
+            _, values, labels, _ = Dataset.load_encoded(folder)
+            missing = [BRANCHES_REV[branch] for branch in branches if branch not in values.keys()]
+            if missing:
+                invalid = True
+                warning = f"Given pre-encoded dataset does not contain selected branches: {', '.join(missing)}."
+            elif evaluation and labels is None:
+                invalid = True
+                warning = 'Given pre-encoded dataset does not contain class labels necessary for the evaluation.'
+        except Exception:
+            invalid = True
+            warning = 'Sorry, could not read given pre-encoded dataset. Please check the folder.'
+
+    return warning if invalid else None
+
+
+def is_cons_track(path):
+    # Checks just one random (first found) wig file of a folder, or the given bedGraph, bigWig or wig file
+    invalid = False
+
+    if len(path) == 0:
+        invalid = True
+        warning = 'You must provide the conservation reference (a folder of wig files, a bedGraph or a bigWig file).'
+    elif os.path.isdir(path) or (os.path.isfile(path) and path.lower().endswith(tracks.WIG_EXTENSIONS)):
+        files = f.list_files_in_dir(path, 'wig') if os.path.isdir(path) else [path]
+        one_wig = next((file for file in files if 'wig' in file), None)
+        if one_wig:
+            try:
+                with seq.open_text(one_wig) as wig_file:
+                    line1 = wig_file.readline()
+                    while line1.startswith(('track', 'browser', '#')):
+                        line1 = wig_file.readline()
                     if not ('fixedStep' in line1 or 'variableStep' in line1) or not ('chrom' in line1):
                         invalid = True
                         warning = f"Provided wig file {one_wig} starts with unknown header."
-                    line2 = f.read_decoded_line(wig_file, zipped)
-                    float(line2)
-                except Exception:
-                    invalid = True
-                    warning = f"Tried to look at a provided wig file: {one_wig} and failed to properly read it. Please check the format."
-            else:
+                    line2 = wig_file.readline()
+                    float(line2.split()[-1])
+            except Exception:
                 invalid = True
-                warning = "I don't see any WIG file in conservation reference directory."
+                warning = f"Tried to look at a provided wig file: {one_wig} and failed to properly read it. Please check the format."
         else:
             invalid = True
-            warning = 'Provided conservation reference directory does not exist.'
+            warning = "I don't see any WIG file in conservation reference directory."
+    elif os.path.isfile(path) and path.lower().endswith(tracks.BEDGRAPH_EXTENSIONS):
+        try:
+            with seq.open_text(path) as bedgraph_file:
+                line = bedgraph_file.readline()
+                while line.startswith(('track', 'browser', '#')):
+                    line = bedgraph_file.readline()
+                chrom, start, end, value = line.split()
+                int(start), int(end), float(value)
+        except Exception:
+            invalid = True
+            warning = f"Tried to look at the provided bedGraph file: {path} and failed to properly read it. Please check the format."
+    elif os.path.isfile(path) and path.lower().endswith(tracks.BIGWIG_EXTENSIONS):
+        try:
+            import pyBigWig
+            bigwig = pyBigWig.open(path)
+            if bigwig is None or not bigwig.isBigWig():
+                invalid = True
+                warning = f"Provided file {path} is not a valid bigWig file."
+            else:
+                bigwig.close()
+        except ImportError:
+            invalid = True
+            warning = 'Reading the bigWig files requires the pyBigWig package (pip install pyBigWig).'
+    elif os.path.isfile(path):
+        invalid = True
+        warning = 'Unknown format of the conservation reference, provide a folder of wig files, a bedGraph or a bigWig file.'
+    else:
+        invalid = True
+        warning = 'Provided conservation reference does not exist.'
+
+    return warning if invalid else None
+
+
+def is_signal_tracks(text):
+    invalid = False
+    paths = [line.strip() for line in text.strip().split('\n') if line.strip()]
+
+    if len(paths) == 0:
+        invalid = True
+        warning = 'You must provide at least one signal track (one per line).'
+    else:
+        for path in paths:
+            track_warning = is_cons_track(path)
+            if track_warning:
+                invalid = True
+                warning = f'Signal track {path}: {track_warning}'
+                break
+
+    return warning if invalid else None
+
+
+def is_signal_channels(tracks, train_tracks):
+    # The channels of the model are given by the number and order of the tracks used for its training
+    invalid = False
+    paths = [line.strip() for line in tracks.strip().split('\n') if line.strip()]
+    names = [os.path.basename(os.path.normpath(path)) for path in paths]
+    train_names = [os.path.basename(os.path.normpath(path)) for path in train_tracks]
+
+    if len(paths) != len(train_tracks):
+        invalid = True
+        warning = f'The model was trained on {len(train_tracks)} signal track(s), provide the same number of tracks ' \
+                  f'in the same order: {", ".join(train_tracks)}.'
+    elif sorted(names) == sorted(train_names) and names != train_names:
+        invalid = True
+        warning = f'Provide the signal tracks in the same order as used for training the model: {", ".join(train_tracks)}.'
+
+    return warning if invalid else None
+
+
+def is_mapped_run_dir(folder):
+    invalid = False
+
+    if len(folder) == 0:
+        invalid = True
+        warning = 'You must provide a folder from the previous run to reuse the mapped samples.'
+    elif not os.path.isfile(os.path.join(folder, 'full_datasets', 'merged_all.tsv.zip')):
+        invalid = True
+        warning = "Given folder does not contain the 'full_datasets/merged_all.tsv.zip' file from the previous run."
 
     return warning if invalid else None
 
@@ -247,6 +352,72 @@ def not_empty_chromosomes(chromosomes_list):
     return warning if invalid else None
 
 
+def is_sweep_spec(text, branches):
+    # Imported here, not to load the train package with the validators
+    from ..train import sweep
+
+    invalid = False
+    try:
+        spec = sweep.parse_spec(text)
+    except Exception:
+        return 'Sorry, could not parse the sweep specification. Please check the yaml format.'
+
+    unknown = [key for key in spec.keys() if key not in sweep.SWEEP_KEYS + ['search', 'samples']]
+    if unknown:
+        invalid = True
+        warning = f"Unknown parameters in the sweep specification: {', '.join(unknown)}."
+    elif spec.get('search', 'grid') not in sweep.SEARCH_TYPES:
+        invalid = True
+        warning = f"Search type of the sweep must be one of: {', '.join(sweep.SEARCH_TYPES)}."
+    elif any(not isinstance(spec[key], list) or len(spec[key]) == 0 for key in sweep.SWEEP_KEYS if key in spec):
+        invalid = True
+        warning = 'Each parameter of the sweep specification must be given as a non-empty list of values.'
+    elif any(isinstance(lr, bool) or not isinstance(lr, (int, float)) or not 0 < lr < float('inf') for lr in spec.get('lr', [])) or \
+            any(not isinstance(batch_size, int) or batch_size < 1 for batch_size in spec.get('batch_size', [])):
+        invalid = True
+        warning = 'Learning rates must be positive numbers (e.g. 0.001 or 1e-3) and batch sizes positive integers.'
+    elif any(optimizer not in ['sgd', 'rmsprop', 'adam'] for optimizer in spec.get('optimizer', [])):
+        invalid = True
+        warning = 'Available optimizers are: sgd, rmsprop, adam.'
+    elif any(not isinstance(layers, dict) or any(branch not in layers for branch in branches)
+             for layers in spec.get('branches_layers', [])):
+        invalid = True
+        warning = 'Each option of branches_layers must define the layers of all the selected branches.'
+
+    return warning if invalid else None
+
+
+def is_checkpoint_dir(folder):
+    invalid = False
+
+    if len(folder) == 0:
+        invalid = True
+        warning = 'You must provide the folder of the training to be resumed.'
+    elif not all(os.path.isfile(os.path.join(folder, 'checkpoint', file)) for file in ['model.h5', 'state.pkl']):
+        invalid = True
+        warning = 'Given folder does not contain a checkpoint (checkpoint/model.h5 and checkpoint/state.pkl files) to resume the training from.'
+
+    return warning if invalid else None
+
+
+def is_worker_list(text):
+    invalid = False
+    workers = [line.strip() for line in text.strip().split('\n') if line.strip()]
+
+    if len(workers) < 2:
+        invalid = True
+        warning = 'Distributed training requires at least two workers (one per line, as host:port).'
+    elif any(len(worker.split(':')) != 2 or not worker.split(':')[0] or not worker.split(':')[1].isdigit()
+             for worker in workers):
+        invalid = True
+        warning = 'Workers must be given one per line as host:port (e.g. localhost:12345).'
+    elif len(set(workers)) != len(workers):
+        invalid = True
+        warning = 'Each worker must have a unique host:port address.'
+
+    return warning if invalid else None
+
+
 def is_model_file(file_path):
     invalid = False
     if len(file_path) == 0:
@@ -254,6 +425,7 @@ def is_model_file(file_path):
         warning = 'You must provide the hdf5 file with a trained model.'
     else:
         if os.path.isfile(file_path):
+            import h5py
             if not h5py.is_hdf5(file_path):
                 invalid = True
                 warning = 'Given file does not seem to be a valid model (requires hdf5 format).'